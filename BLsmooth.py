@@ -26,10 +26,13 @@ import optparse
 import logging
 import numpy as np
 from scipy.ndimage import gaussian_filter1d as gfilter
+from scipy.signal import fftconvolve, lfilter
 
 import casacore.tables as pt
 
-from lib_multiproc import multiprocManager
+from lib_multiproc import multiprocPool, sharedArray
+import lib_timer
+from lib_timer import Timer, timed
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s: %(message)s')
 logging.info('BL-based smoother - Francesco de Gasperin, Henrik Edler')
@@ -48,7 +51,96 @@ def addcol(ms, incol, outcol):
         pt.taql("UPDATE $ms SET "+outcol+"="+incol)
 
 
-def smooth_baseline(in_bl, data, weights, std_t, std_f, outQueue=None):
+def gauss_kernel(std, truncate=3):
+    """
+    Normalised Gaussian kernel, the same used by gfilter
+    """
+    radius = int(truncate * float(std) + 0.5)
+    x = np.arange(-radius, radius+1)
+    kernel = np.exp(-0.5 / std**2 * x**2)
+    return kernel / kernel.sum()
+
+
+def pad_axis(data, radius, axis):
+    """
+    Pad an axis reflecting the edges (same as mode='reflect' of gfilter)
+    """
+    pad = [(0, 0)] * data.ndim
+    pad[axis] = (radius, radius)
+    return np.pad(data, pad, mode='symmetric')
+
+
+def gfilter_fft(data, std, axis):
+    """
+    Same as gfilter(data, std, axis=axis, truncate=3) but convolving with FFTs,
+    the cost does not depend on std. Works also on complex data.
+    """
+    kernel = gauss_kernel(std)
+    radius = len(kernel) // 2
+    if radius == 0: return data
+    shape = [1] * data.ndim
+    shape[axis] = len(kernel)
+    return fftconvolve(pad_axis(data, radius, axis), kernel.reshape(shape), mode='valid', axes=axis)
+
+
+def gfilter_recursive(data, std, axis):
+    """
+    Recursive approximation of a Gaussian filter (Young & van Vliet 1995): a causal and an
+    anti-causal 3rd order IIR filter, the cost does not depend on std. Works also on complex data.
+    The kernel is not truncated, so results differ slightly from gfilter (~1%).
+    """
+    if std < 0.5: return data
+    if std < 2.5:
+        q = 3.97156 - 4.14554 * np.sqrt(1 - 0.26891 * std)
+    else:
+        q = 0.98711 * std - 0.96330
+    b0 = 1.57825 + 2.44413*q + 1.4281*q**2 + 0.422205*q**3
+    b1 = 2.44413*q + 2.85619*q**2 + 1.26661*q**3
+    b2 = -(1.4281*q**2 + 1.26661*q**3)
+    b3 = 0.422205*q**3
+    a = [1, -b1/b0, -b2/b0, -b3/b0]
+    b = [1 - (b1+b2+b3)/b0]
+    # reflected edges, long enough for the filter to settle
+    radius = int(4 * std + 0.5)
+    data = lfilter(b, a, pad_axis(data, radius, axis), axis=axis)
+    data = np.flip(lfilter(b, a, np.flip(data, axis), axis=axis), axis)
+    return np.take(data, np.arange(radius, data.shape[axis]-radius), axis=axis)
+
+
+def smooth_tf(data, std_t, std_f):
+    """
+    Smooth in time (first axis) and frequency (second last axis) with the selected backend.
+    """
+    for std, axis, skip in [(std_t, 0, options.notime), (std_f, -2, options.nofreq)]:
+        if skip: continue
+        if options.backend == 'fft':
+            data = gfilter_fft(data, std, axis)
+        elif options.backend == 'recursive':
+            data = gfilter_recursive(data, std, axis)
+        else:
+            data = gfilter(data, std, axis=axis, truncate=3)
+    return data
+
+
+def smooth(data, weights, std_t, std_f):
+    """
+    Smooth weighted data and weights of one or more baselines (time is the first axis,
+    frequency the second last) and divide the smoothed data by the smoothed weights.
+    """
+    if options.onlyamp: # smooth only amplitudes
+        dataAMP, dataPH = np.abs(data), np.angle(data)
+        dataAMP = smooth_tf(dataAMP, std_t, std_f)
+        data = dataAMP * (np.cos(dataPH) + 1j * np.sin(dataPH)) # recreate data
+    elif options.backend == 'gauss': # gfilter works on real arrays
+        data = smooth_tf(np.real(data), std_t, std_f) + 1j*smooth_tf(np.imag(data), std_t, std_f) # recreate data
+    else:
+        data = smooth_tf(data, std_t, std_f)
+    weights = smooth_tf(weights, std_t, std_f)
+    data[(weights != 0)] /= weights[(weights != 0)]  # avoid divbyzero
+    return data, weights
+
+
+def smooth_baseline(data, weights, std_t, std_f, data_out, weights_out=None):
     """
     Smooth one baseline.
     Multiply every element of the data by the weights, convolve both the
@@ -60,8 +152,6 @@ def smooth_baseline(in_bl, data, weights, std_t, std_f, outQueue=None):
 
     Parameters
     ----------
-    in_bl: boolean ndarray
-        Mask for everything not in this baseline.
     data: ndarray
         Data for one baseline that is to be smoothed.
     weights: ndarray
@@ -70,47 +160,43 @@ def smooth_baseline(in_bl, data, weights, std_t, std_f, outQueue=None):
         Standard deviation in samples to use for time-smoothing.
     std_f: float
         Standard deviation in samples to use for freq-smoothing.
-
-    Returns
-    -------
-    in_bl: boolean ndarray
-        Mask for everything not in this baseline.
-    data: ndarray.
-        Smoothed ata for one baseline.
-    weights: ndarray
-        Weight output.
+    data_out: ndarray
+        Where to write the smoothed data for this baseline (shared with the main process).
+    weights_out: ndarray, optional
+        Where to write the weights for this baseline (shared with the main process).
     """
     data = np.nan_to_num(data * weights) # set bad data to 0 so nans don't propagate
     if np.isnan(data).all():
-        return in_bl, data, weights # flagged ants
+        data_out[...] = data
+        if weights_out is not None: weights_out[...] = weights
+        return # flagged ants
     # smear weighted data and weights
-    if options.onlyamp: # smooth only amplitudes
-        dataAMP, dataPH = np.abs(data), np.angle(data)
-        if not options.notime:
-            dataAMP = gfilter(dataAMP, std_t, axis=0, truncate=3)
-        if not options.nofreq:
-            dataAMP = gfilter(dataAMP, std_f, axis=1, truncate=3)
-        data = dataAMP * (np.cos(dataPH) + 1j * np.sin(dataPH)) # recreate data
-    else:
-        dataR, dataI = np.real(data), np.imag(data)
-        if not options.notime:
-            dataR = gfilter(dataR, std_t, axis=0, truncate=3)
-            dataI = gfilter(dataI, std_t, axis=0, truncate=3)
-        if not options.nofreq:
-            dataR = gfilter(dataR, std_f, axis=1, truncate=3)
-            dataI = gfilter(dataI, std_f, axis=1, truncate=3)
-        data = dataR + 1j*dataI # recreate data
-    if not options.notime:
-        weights = gfilter(weights, std_t, axis=0, truncate=3)
-    if not options.nofreq:
-        weights = gfilter(weights, std_f, axis=1, truncate=3)
-    data[(weights != 0)] /= weights[(weights != 0)]  # avoid divbyzero
+    data, weights = smooth(data, weights, std_t, std_f)
+    data_out[...] = data
+    if weights_out is not None: weights_out[...] = weights
+
 
-    # print( np.count_nonzero(data[~flags[in_bl]]), np.count_nonzero(data[flags[in_bl]]), 100*np.count_nonzero(data[flags[in_bl]])/np.count_nonzero(data))
-    # print( "NANs in flagged data: ", np.count_nonzero(np.isnan(data[flags[in_bl]])))
-    # print( "NANs in unflagged data: ", np.count_nonzero(np.isnan(data[~flags[in_bl]])))
-    # print( "NANs in weights: ", np.count_nonzero(np.isnan(weights)))
-    outQueue.put([in_bl, data, weights])
+def smooth_baselines(data, weights, idx, std_t, std_f, weights_out=None):
+    """
+    Smooth together a group of baselines with the same std (see smooth_baseline).
+
+    Parameters
+    ----------
+    data: ndarray
+        Data of the whole chunk (time, baseline, chan, pol), smoothed in place.
+    weights: ndarray
+        Weights of the whole chunk.
+    idx: list
+        Baselines to smooth.
+    std_t, std_f: float
+        Standard deviation in samples to use for time/freq-smoothing.
+    weights_out: ndarray, optional
+        Where to write the weights of the whole chunk.
+    """
+    w = weights[:, idx]
+    d, w = smooth(np.nan_to_num(data[:, idx] * w), w, std_t, std_f)
+    data[:, idx] = d
+    if weights_out is not None: weights_out[:, idx] = w
 
 
 
@@ -126,7 +212,12 @@ opt.add_option('-a', '--onlyamp', help='Smooth only amplitudes [default: smooth
 opt.add_option('-t', '--notime', help='Do not do smoothing in time [default: False]', action="store_true", default=False)
 opt.add_option('-q', '--nofreq', help='Do not do smoothing in frequency [default: False]', action="store_true", default=False)
 opt.add_option('-c', '--chunks', help='Split the I/O in n chunks. If you run out of memory, set this to a value > 2.', default=8, type='int')
+opt.add_option('-m', '--maxmem', help='Process the MS in time blocks so to use at most this memory, e.g. 16G [default: read all times at once]', default=None, type='string')
+opt.add_option('-k', '--backend', help='Smoothing backend: gauss (direct convolution), fft (same result, cost independent of the kernel size), recursive (IIR approximation, cost independent of the kernel size) [default: gauss]', type='choice', choices=['gauss','fft','recursive'], default='gauss')
+opt.add_option('-g', '--sigmabin', help='Smooth together baselines whose kernel std differs less than this fraction, using the same std [default: 0, smooth each baseline with its own std]', default=0., type='float')
 opt.add_option('-n', '--ncpu', help='Number of cores', default=4, type='int')
+opt.add_option('-T', '--timing', help='Write a timing report of the main steps in this file (.json or .csv) [default: no report]', default=None, type='string')
+opt.add_option('-P', '--profile', help='Profile (cProfile and tracemalloc) the main steps, slow [default: False]', action="store_true", default=False)
 (options, msfile) = opt.parse_args()
 
 if msfile == []:
@@ -136,6 +227,7 @@ msfile = msfile[0]
 if not os.path.exists(msfile):
     logging.error("Cannot find MS file {}.".format(msfile))
     sys.exit(1)
+lib_timer.configure(profile=options.profile, trace_memory=options.profile)
 # open input/output MS
 ms = pt.table(msfile, readonly=False, ack=False)
 
@@ -148,7 +240,6 @@ with pt.table(msfile + '::SPECTRAL_WINDOW', ack=False) as freqtab:
 with pt.taql("SELECT ANTENNA1,ANTENNA2,sqrt(sumsqr(UVW)),GCOUNT() FROM $ms GROUPBY ANTENNA1,ANTENNA2") as BL:
     ants1, ants2 = BL.getcol('ANTENNA1'), BL.getcol('ANTENNA2')
     dists = BL.getcol('Col_3')/1e3 # baseleline length in km
-    n_t = BL.getcol('Col_4')[0] # number of timesteps
     n_bl = len(ants1)
 
 # check if ms is time-ordered
@@ -167,62 +258,237 @@ if 'WEIGHT_SPECTRUM_ORIG' in ms.colnames() and options.restore:
 elif options.weight and not options.nobackup:
     addcol(ms, 'WEIGHT_SPECTRUM', 'WEIGHT_SPECTRUM_ORIG')
 
-# Iterate over chunks of baselines
-for c, idx in enumerate(np.array_split(np.arange(n_bl), options.chunks)):
-    logging.debug('### Fetching chunk {}/{}'.format(c+1,options.chunks))
 
-    # get input data for this chunk
-    ants1_chunk, ants2_chunk = ants1[idx], ants2[idx]
-    chunk = pt.taql("SELECT FROM $ms WHERE any(ANTENNA1== $ants1_chunk && ANTENNA2==$ants2_chunk)")
-    data_chunk = chunk.getcol(options.incol)
-    weights_chunk = chunk.getcol('WEIGHT_SPECTRUM')
+def make_rowmap(ms):
+    """
+    Index of the MS rows: rowmap[time, baseline] = row number (-1 if missing).
+    Baselines are in the same order of ants1/ants2.
+    """
+    logging.debug('Indexing MS rows...')
+    _, t_idx = np.unique(ms.getcol('TIME'), return_inverse=True)
+    bl_lookup = -np.ones((max(ants1.max(), ants2.max())+1,)*2, dtype=int)
+    bl_lookup[ants1, ants2] = np.arange(n_bl)
+    bl_idx = bl_lookup[ms.getcol('ANTENNA1'), ms.getcol('ANTENNA2')]
+    rowmap = -np.ones((t_idx.max()+1, n_bl), dtype=int)
+    rowmap[t_idx, bl_idx] = np.arange(ms.nrows())
+    if (rowmap < 0).any():
+        logging.warning('Some (time, baseline) rows are missing, they will be considered flagged.')
+    return rowmap
+
+
+# max number of baselines smoothed together by a worker with --sigmabin
+max_group = 16
+
+
+def get_std(dist):
+    """
+    Return the std of the Gaussian kernel in time and frequency (in samples) for a baseline length (km)
+    """
+    std_t = options.ionfactor * (25.e3 / dist) ** options.bscalefactor * (freq / 60.e6)  # in sec
+    std_t = std_t / timepersample  # in samples
+    # TODO: for freq this is hardcoded, it should be thought better
+    # However, the limitation is probably smearing here
+    std_f = 1e6 / dist  # Hz
+    std_f = std_f / freqpersample  # in samples
+    return std_t, std_f
+
+
+def parse_size(size):
+    """
+    Convert a string like 500M or 16G to bytes
+    """
+    units = {'K':1024, 'M':1024**2, 'G':1024**3, 'T':1024**4}
+    size = size.strip().upper().rstrip('B')
+    if size[-1] in units:
+        return float(size[:-1]) * units[size[-1]]
+    return float(size)
+
+
+def make_jobs():
+    """
+    Split the MS in chunks of baselines and, if --maxmem is set, in blocks of time.
+    Each time block is read with a halo of 3 sigma_t samples on each side (the truncation
+    of the Gaussian kernel), so that smoothing the block gives the same result as smoothing
+    all times. Only the central part of the block is then written.
+    """
+    n_times = rowmap.shape[0]
+    cell = ms.getcell(options.incol, 0)
+    cellsize = cell.size
+    # bytes per (time, baseline) kept in memory: data, weights, flags (while reading), new weights
+    rowbytes = cellsize * (cell.itemsize + 4 + 1 + (4 if options.weight else 0))
+    jobs = []
+    for c, idx in enumerate(np.array_split(np.arange(n_bl), options.chunks)):
+        halo = 0
+        if not options.notime:
+            stds = [get_std(dist)[0] for dist, ant1, ant2 in zip(dists[idx], ants1[idx], ants2[idx]) \
+                        if ant1 != ant2 and not np.isnan(dist)]
+            stds = [std_t for std_t in stds if std_t >= 0.5]
+            if len(stds) > 0: halo = min(n_times, int(3 * max(stds) + 0.5)) # same truncation of gfilter
+        if options.maxmem is None:
+            ntimes_block = n_times
+        else:
+            # two blocks are in memory at once (pipeline) plus ~10 float64 temporary arrays per baseline in each worker
+            bytes_per_time = 2 * len(idx) * rowbytes + options.ncpu * cellsize * 80 * (max_group if options.sigmabin > 0 else 1)
+            ntimes_block = int(parse_size(options.maxmem) / bytes_per_time) - 2*halo
+            # a block is read before the previous one is written, but the halo must not reach
+            # blocks already written (the MS is modified with -w or if incol == outcol)
+            if ntimes_block < max(1, halo):
+                logging.warning('Chunk {}: --maxmem too small for a halo of {} samples, increase --chunks.'.format(c+1, halo))
+                ntimes_block = max(1, halo)
+        for t0 in range(0, n_times, ntimes_block):
+            t1 = min(t0 + ntimes_block, n_times)
+            jobs.append({'c':c, 'idx':idx, 't0':t0, 't1':t1, 'h0':max(0, t0-halo), 'h1':min(n_times, t1+halo)})
+    if options.maxmem is not None:
+        logging.info('Processing in {} blocks of baselines/times.'.format(len(jobs)))
+    return jobs
+
+
+def read_col(chunk, colname, shared=True):
+    """
+    Read a column for the rows of a chunk into a (time, baseline, chan, pol) array.
+    Rows are read with a single getcolnp into a preallocated buffer (in shared memory if shared).
+    Missing rows are left to zero (False for flags).
+    """
+    cell = ms.getcell(colname, 0)
+    shape = chunk['rows'].shape + cell.shape
+    if shared:
+        buf = sharedArray(shape=shape, dtype=cell.dtype)
+        array = buf.array
+    else:
+        buf = array = np.zeros(shape, dtype=cell.dtype)
+    if chunk['complete']:
+        # the buffer is filled directly and seen as (time, baseline, chan, pol) without copies
+        chunk['table'].getcolnp(colname, array.reshape((-1,)+cell.shape))
+    else:
+        array[chunk['valid']] = chunk['table'].getcol(colname)
+    return buf
+
+
+def write_col(chunk, colname, array):
+    """
+    Write a (time, baseline, chan, pol) array into a column for the rows of a chunk.
+    Only the times outside the halo are written.
+    """
+    array = array[chunk['t0']-chunk['h0']:chunk['t1']-chunk['h0']]
+    if chunk['complete']:
+        chunk['table_out'].putcol(colname, array.reshape((-1,)+array.shape[2:]))
+    else:
+        valid = chunk['valid'][chunk['t0']-chunk['h0']:chunk['t1']-chunk['h0']]
+        chunk['table_out'].putcol(colname, array[valid])
+
+
+@timed('read')
+def read_chunk(j):
+    """
+    Read a chunk of baselines (and times, including the halo) and prepare input/output arrays in shared memory.
+    """
+    chunk = dict(jobs[j])
+    chunk['j'] = j
+    logging.debug('### Fetching chunk {}/{} (times {}-{})'.format(chunk['c']+1, options.chunks, chunk['t0'], chunk['t1']))
+    chunk['rows'] = rowmap[chunk['h0']:chunk['h1'], chunk['idx']]
+    chunk['valid'] = chunk['rows'] >= 0
+    chunk['complete'] = chunk['valid'].all()
+    # rows are selected directly, in (time, baseline) order, no need to scan the MS
+    chunk['table'] = ms.selectrows(chunk['rows'][chunk['valid']])
+    rows_out = rowmap[chunk['t0']:chunk['t1'], chunk['idx']]
+    chunk['table_out'] = ms.selectrows(rows_out[rows_out >= 0])
+    chunk['data'] = read_col(chunk, options.incol)
+    chunk['weights'] = read_col(chunk, 'WEIGHT_SPECTRUM')
     # flag NaNs and set weights to zero
-    flags = chunk.getcol('FLAG')
-    flags[np.isnan(data_chunk)] = True
-    weights_chunk[flags] = 0
+    flags = read_col(chunk, 'FLAG', shared=False)
+    flags[np.isnan(chunk['data'].array)] = True
+    chunk['weights'].array[flags] = 0
     del flags
-    # prepare output cols
-    smoothed_data = data_chunk.copy()
+    # prepare output cols, data are smoothed in place
     if options.weight:
-        new_weights = np.zeros_like(weights_chunk)
+        chunk['new_weights'] = sharedArray(shape=chunk['weights'].shape, dtype=chunk['weights'].dtype)
+    return chunk
 
-    # Iterate on each baseline in this chunk
-    mpm = multiprocManager(options.ncpu, smooth_baseline)
-    for i_chunk, (ant1, ant2, dist) in enumerate(zip(ants1_chunk, ants2_chunk, dists[idx])):
+
+def smooth_chunk(chunk):
+    """
+    Send all baselines of a chunk to the workers, return an iterator on the (unordered) results
+    """
+    ants1_chunk, ants2_chunk, dists_chunk = ants1[chunk['idx']], ants2[chunk['idx']], dists[chunk['idx']]
+    tasks = []
+    groups = {}
+    for i_chunk, (ant1, ant2, dist) in enumerate(zip(ants1_chunk, ants2_chunk, dists_chunk)):
         if ant1 == ant2:
             continue  # skip autocorrelations
         elif np.isnan(dist):
             continue  # fix for missing antennas
         logging.debug('Working on baseline: {} - {} (dist = {:.2f}km)'.format(ant1, ant2, dist))
 
-        in_bl = slice(i_chunk, -1, len(ants1_chunk))  # All times for 1 BL
-        data, weights= data_chunk[in_bl], weights_chunk[in_bl]
+        in_bl = np.s_[:, i_chunk]  # All times for 1 BL
 
-        std_t = options.ionfactor * (25.e3 / dist) ** options.bscalefactor * (freq / 60.e6)  # in sec
-        std_t = std_t / timepersample  # in samples
-        # TODO: for freq this is hardcoded, it should be thought better
-        # However, the limitation is probably smearing here
-        std_f = 1e6 / dist  # Hz
-        std_f = std_f / freqpersample  # in samples
+        std_t, std_f = get_std(dist)
         logging.debug("-Time: sig={:.1f} samples ({:.1f}s) -Freq: sig={:.1f} samples ({:.2f}MHz)".format(
             std_t, timepersample * std_t, std_f, freqpersample * std_f / 1e6))
         if std_t < 0.5: continue  # avoid very small smoothing and flagged ants
-        # fill queue
-        mpm.put([in_bl, data, weights, std_t, std_f])
-
-    mpm.wait() # run queue
-    # reconstruct chunk column
-    for in_bl, data, weights in mpm.get():
-        smoothed_data[in_bl] = data
-        if options.weight:
-            new_weights[in_bl] = weights
-    # write to ms
-    logging.info('Writing %s column.' % options.outcol)
-    chunk.putcol(options.outcol, smoothed_data)
+        if options.sigmabin > 0:
+            # bin std in log space, baselines in the same bin are smoothed together
+            step = np.log1p(options.sigmabin)
+            key = (0 if options.notime else int(np.round(np.log(std_t)/step)), 0 if options.nofreq else int(np.round(np.log(std_f)/step)))
+            groups.setdefault(key, []).append(i_chunk)
+            continue
+        # only handles to the shared arrays are sent to the workers
+        weights_out = chunk['new_weights'][in_bl] if options.weight else None
+        tasks.append([chunk['data'][in_bl], chunk['weights'][in_bl], std_t, std_f, chunk['data'][in_bl], weights_out])
+
+    if options.sigmabin > 0:
+        weights_out = chunk['new_weights'] if options.weight else None
+        for (k_t, k_f), idx in groups.items():
+            std_t, std_f = np.exp(k_t*step), np.exp(k_f*step)
+            # split large groups to limit the memory of each worker
+            for i in range(0, len(idx), max_group):
+                tasks.append([chunk['data'], chunk['weights'], idx[i:i+max_group], std_t, std_f, weights_out])
+        logging.debug('Smoothing {} groups of baselines.'.format(len(tasks)))
+        return pool.imap(tasks, funct=smooth_baselines, ordered=False)
+
+    return pool.imap(tasks, ordered=False)
+
+
+@timed('write')
+def write_chunk(chunk):
+    """
+    Write a smoothed chunk to the MS and free its memory.
+    """
+    logging.info('Writing %s column (chunk %i/%i, times %i-%i).' % (options.outcol, chunk['c']+1, options.chunks, chunk['t0'], chunk['t1']))
+    write_col(chunk, options.outcol, chunk['data'].array)
     if options.weight:
         logging.warning('Writing WEIGHT_SPECTRUM column.')
-        chunk.putcol('WEIGHT_SPECTRUM', new_weights)
-    chunk.close()
+        write_col(chunk, 'WEIGHT_SPECTRUM', chunk['new_weights'].array)
+        chunk['new_weights'].close()
+    chunk['table'].close()
+    chunk['table_out'].close()
+    for col in ['data', 'weights']:
+        chunk[col].close()
+
+
+with Timer('index'):
+    rowmap = make_rowmap(ms)
+    jobs = make_jobs()
+# Iterate over chunks of baselines/times with a read/compute/write pipeline:
+# the next chunk is read while the current one is smoothed, and a chunk
+# is written while the following one is smoothed. The same workers are used for all chunks.
+pool = multiprocPool(options.ncpu, smooth_baseline)
+chunk = read_chunk(0)
+workers_cpu = pool.cpu_time()
+results = smooth_chunk(chunk)
+for j in range(len(jobs)):
+    next_chunk = read_chunk(j+1) if j+1 < len(jobs) else None
+    with Timer('smooth') as timer:
+        for r in results: pass # wait for this chunk to be smoothed
+        # the workers only smoothed this chunk since it was sent
+        timer.add_cpu(pool.cpu_time() - workers_cpu)
+    if next_chunk is not None:
+        workers_cpu = pool.cpu_time()
+        results = smooth_chunk(next_chunk)
+    write_chunk(chunk)
+    chunk = next_chunk
+pool.close()
 
 ms.close()
+if options.timing is not None:
+    lib_timer.report(options.timing)
 logging.info("Done.")
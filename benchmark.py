@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 - Francesco de Gasperin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Usage: benchmark.py [--options]
+# Create synthetic inputs (a MS and sets of FITS images), time BLsmooth.py, mosaic.py,
+# spidxmap.py and the main lib_fits steps, and append the results (one JSON per line)
+# to a file, e.g.:
+# benchmark.py --nant 30 --ntimes 1000 --imsize 1024 --label v1.2
+
+import os, sys, time, json, shutil, argparse, logging, subprocess, platform, tempfile
+import numpy as np
+
+scriptdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, scriptdir)
+from lib_timer import Timer
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s: %(message)s')
+
+benchmarks = ['blsmooth', 'mosaic', 'spidxmap', 'convolve_to', 'regrid_common', 'calc_noise']
+
+parser = argparse.ArgumentParser(description='Benchmark on synthetic data, e.g. benchmark.py --nant 20 --imsize 512')
+parser.add_argument('--only', dest='only', nargs='+', choices=benchmarks, help='Run only these benchmarks (default: all)')
+parser.add_argument('--nant', dest='nant', default=20, type=int, help='Number of antennas of the MS (default: 20)')
+parser.add_argument('--ntimes', dest='ntimes', default=600, type=int, help='Number of timesteps of the MS (default: 600)')
+parser.add_argument('--nchan', dest='nchan', default=32, type=int, help='Number of channels of the MS (default: 32)')
+parser.add_argument('--imsize', dest='imsize', default=512, type=int, help='Size in pixels of the images (default: 512)')
+parser.add_argument('--nimages', dest='nimages', default=4, type=int, help='Number of images (frequencies for spidxmap, pointings for mosaic) (default: 4)')
+parser.add_argument('--ncpu', dest='ncpu', default=4, type=int, help='Number of cpus given to the scripts (default: 4)')
+parser.add_argument('--workdir', dest='workdir', help='Where to create the synthetic data (default: a temporary dir, removed at the end)')
+parser.add_argument('--label', dest='label', default='', help='Label saved with the results, e.g. a release name')
+parser.add_argument('--output', dest='output', default=os.path.join(scriptdir, 'bench_output.txt'), help='File where results are appended (default: bench_output.txt)')
+
+
+def make_ms(msname, nant, ntimes, nchan, seed=0):
+    """
+    Create a MS with all baselines (including autocorrelations) of nant antennas,
+    ntimes timesteps of 4 s and nchan channels at 60 MHz. DATA is gaussian noise,
+    WEIGHT_SPECTRUM is 1 and 1% of FLAG is set.
+    """
+    import casacore.tables as pt
+    if os.path.exists(msname): shutil.rmtree(msname)
+    rng = np.random.default_rng(seed)
+    ms = pt.default_ms(msname)
+    desc = pt.maketabdesc([pt.makearrcoldesc('DATA', 0j, ndim=2, shape=[nchan,4], valuetype='complex'),
+                           pt.makearrcoldesc('WEIGHT_SPECTRUM', 0., ndim=2, shape=[nchan,4], valuetype='float')])
+    ms.addcols(desc)
+    ants1, ants2 = np.triu_indices(nant)
+    nbl = len(ants1)
+    pos = rng.normal(0, 2000, (nant,3)) # m
+    ms.addrows(nbl*ntimes)
+    # write one timestep at a time to keep memory low
+    for t in range(ntimes):
+        rows = slice(t*nbl, (t+1)*nbl)
+        time_t = np.full(nbl, 4.8e9 + 4.*t)
+        ms.putcol('TIME', time_t, startrow=rows.start, nrow=nbl)
+        ms.putcol('TIME_CENTROID', time_t, startrow=rows.start, nrow=nbl)
+        ms.putcol('INTERVAL', np.full(nbl, 4.), startrow=rows.start, nrow=nbl)
+        ms.putcol('ANTENNA1', ants1, startrow=rows.start, nrow=nbl)
+        ms.putcol('ANTENNA2', ants2, startrow=rows.start, nrow=nbl)
+        ms.putcol('UVW', pos[ants2]-pos[ants1], startrow=rows.start, nrow=nbl)
+        data = rng.normal(size=(nbl,nchan,4)) + 1j*rng.normal(size=(nbl,nchan,4))
+        ms.putcol('DATA', data.astype(np.complex64), startrow=rows.start, nrow=nbl)
+        ms.putcol('WEIGHT_SPECTRUM', np.ones((nbl,nchan,4), dtype=np.float32), startrow=rows.start, nrow=nbl)
+        ms.putcol('FLAG', rng.random((nbl,nchan,4)) < 0.01, startrow=rows.start, nrow=nbl)
+    ms.close()
+    chanwidth = 48828.125
+    with pt.table(msname+'/SPECTRAL_WINDOW', readonly=False, ack=False) as spw:
+        spw.addrows(1)
+        spw.putcell('REF_FREQUENCY', 0, 60e6)
+        spw.putcell('NUM_CHAN', 0, nchan)
+        spw.putcell('CHAN_FREQ', 0, 60e6+np.arange(nchan)*chanwidth)
+        for col in ['RESOLUTION', 'CHAN_WIDTH', 'EFFECTIVE_BW']:
+            spw.putcell(col, 0, np.full(nchan, chanwidth))
+    return nbl*ntimes*nchan*4 # visibilities
+
+
+def make_images(dirname, prefix, freqs, centers, size, seed=0):
+    """
+    Create one image (4 axes: ra, dec, freq, stokes) per frequency/center (ra, dec in deg)
+    with a few gaussian sources (spectral index -0.8), a restoring beam that
+    scales with frequency and gaussian noise. Return the list of filenames.
+    """
+    from astropy.io import fits as pyfits
+    from astropy.wcs import WCS as pywcs
+    rng = np.random.default_rng(seed)
+    cdelt = 1.5/3600 # deg
+    yy, xx = np.mgrid[:size,:size]
+    # sources at fixed sky positions, so they are the same in all images
+    src_radec = [(centers[0][0] + dx*cdelt*size/4, centers[0][1] + dy*cdelt*size/4, s)
+                 for dx, dy, s in rng.uniform([-1,-1,0.1], [1,1,1], (10,3))]
+    filenames = []
+    for i, (freq, (ra, dec)) in enumerate(zip(freqs, centers)):
+        w = pywcs(naxis=4)
+        w.wcs.ctype = ['RA---SIN','DEC--SIN','FREQ','STOKES']
+        w.wcs.cdelt = [-cdelt, cdelt, 1e6, 1]
+        w.wcs.crval = [ra, dec, freq, 1]
+        w.wcs.crpix = [size/2, size/2, 1, 1]
+        w.wcs.cunit = ['deg','deg','Hz','']
+        header = w.to_header()
+        beam = 6*cdelt * (freqs[0]/freq)**0.5
+        header['BMAJ'] = beam
+        header['BMIN'] = beam*0.8
+        header['BPA'] = 30.
+        data = rng.normal(0, 1e-3, (size,size))
+        sigma = beam/cdelt/2.355
+        for src_ra, src_dec, flux in src_radec:
+            x, y = w.celestial.wcs_world2pix(src_ra, src_dec, 0)
+            data += flux * (freq/freqs[0])**-0.8 * np.exp(-((xx-x)**2+(yy-y)**2)/(2*sigma**2))
+        filename = os.path.join(dirname, '%s%02i.fits' % (prefix, i))
+        pyfits.writeto(filename, data[np.newaxis,np.newaxis].astype(np.float32), header, overwrite=True)
+        filenames.append(filename)
+    return filenames
+
+
+def run_script(cmd, workdir):
+    """
+    Run a script in a subprocess, return wall time (s) and peak memory (MB) of the subprocess.
+    """
+    logging.info('Running: %s' % ' '.join(cmd))
+    start = time.time()
+    with open(os.path.join(workdir, 'log_'+os.path.basename(cmd[1])+'.txt'), 'w') as log:
+        p = subprocess.Popen(cmd, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+        pid, status, rusage = os.wait4(p.pid, 0)
+    wall = time.time() - start
+    if os.waitstatus_to_exitcode(status) != 0:
+        logging.error('%s failed, see the log in %s.' % (cmd[1], workdir))
+        sys.exit(1)
+    return wall, rusage.ru_maxrss/1024.
+
+
+def bench_blsmooth(workdir, args):
+    msname = os.path.join(workdir, 'bench.MS')
+    with Timer('make_ms'):
+        nvis = make_ms(msname, args.nant, args.ntimes, args.nchan)
+    wall, maxrss = run_script([sys.executable, os.path.join(scriptdir, 'BLsmooth.py'), '-n', str(args.ncpu), '-w', msname], workdir)
+    return {'wall':wall, 'maxrss':maxrss, 'throughput':nvis/wall, 'unit':'vis/s'}
+
+
+def bench_mosaic(workdir, args):
+    # pointings on a line, overlapping by half image
+    step = 1.5/3600*args.imsize/2
+    centers = [(150.+i*step, 30.) for i in range(args.nimages)]
+    images = make_images(workdir, 'pointing', [144e6]*args.nimages, centers, args.imsize)
+    wall, maxrss = run_script([sys.executable, os.path.join(scriptdir, 'mosaic.py'), '--images']+images+ \
+                              ['--find_noise', '--output', os.path.join(workdir, 'mosaic.fits')], workdir)
+    return {'wall':wall, 'maxrss':maxrss, 'throughput':args.nimages*args.imsize**2/wall, 'unit':'pix/s'}
+
+
+def bench_spidxmap(workdir, args):
+    images = get_freq_images(workdir, args)
+    wall, maxrss = run_script([sys.executable, os.path.join(scriptdir, 'spidxmap.py')]+images+ \
+                              ['--noise', '--ncpu', str(args.ncpu), '--output', os.path.join(workdir, 'spidx.fits')], workdir)
+    return {'wall':wall, 'maxrss':maxrss, 'throughput':args.nimages*args.imsize**2/wall, 'unit':'pix/s'}
+
+
+def get_freq_images(workdir, args):
+    """ Multi-frequency set of images, created once """
+    freqs = np.logspace(np.log10(50e6), np.log10(1.4e9), args.nimages)
+    filenames = [os.path.join(workdir, 'freq%02i.fits' % i) for i in range(args.nimages)]
+    if not all([os.path.exists(f) for f in filenames]):
+        filenames = make_images(workdir, 'freq', freqs, [(150., 30.)]*args.nimages, args.imsize)
+    return filenames
+
+
+def bench_lib_fits(step, workdir, args):
+    """
+    Time a lib_fits step in this process.
+    """
+    from lib_fits import AllImages
+    all_images = AllImages(get_freq_images(workdir, args))
+    if step == 'regrid_common':
+        all_images.convolve_to()
+    with Timer(step) as timer:
+        if step == 'convolve_to':
+            all_images.convolve_to()
+        elif step == 'regrid_common':
+            all_images.regrid_common(action='regrid')
+        elif step == 'calc_noise':
+            for image in all_images:
+                image.calc_noise(force_recalc=True)
+    rec = timer.record
+    return {'wall':rec['wall'], 'cpu':rec['cpu'], 'maxrss':rec['maxrss'], 'rss_change':rec['rss_change'],
+            'throughput':args.nimages*args.imsize**2/rec['wall'], 'unit':'pix/s'}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=scriptdir, stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return ''
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix='benchmark_')
+    os.makedirs(workdir, exist_ok=True)
+    info = {'date':time.strftime('%Y-%m-%d %H:%M:%S'), 'label':args.label, 'revision':git_revision(),
+            'host':platform.node(), 'python':platform.python_version(), 'numpy':np.__version__,
+            'nant':args.nant, 'ntimes':args.ntimes, 'nchan':args.nchan, 'imsize':args.imsize,
+            'nimages':args.nimages, 'ncpu':args.ncpu}
+
+    results = []
+    for name in (args.only if args.only is not None else benchmarks):
+        logging.info('Benchmark: %s' % name)
+        if name in ['convolve_to', 'regrid_common', 'calc_noise']:
+            res = bench_lib_fits(name, workdir, args)
+        else:
+            res = globals()['bench_'+name](workdir, args)
+        res = dict(info, benchmark=name, **res)
+        results.append(res)
+        logging.info('%s: %.2f s, %.3g %s, max mem: %i MB' % (name, res['wall'], res['throughput'], res['unit'], res['maxrss']))
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(res)+'\n')
+
+    logging.info('Results appended to %s.' % args.output)
+    if args.workdir is None:
+        shutil.rmtree(workdir)
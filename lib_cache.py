@@ -22,9 +22,83 @@
 # @diskcached("filename_to_save")
 # def your_function():
 #    ...
+#
+# or, for a cache shared by many processes/runs (one file per entry, bounded in size):
+#
+# @diskcache("cache_dir", maxsize=10*1024**3, maxage=30*86400)
+# def your_function(image_path, array, option=1):
+#    ...
+# your_function.cache.stats() # -> {'hits':.., 'misses':.., 'entries':.., 'size':..}
+#
+# cache = diskCache("cache_dir")
+# key = cache.key('reproject', header, data)
+# try:
+#     value = cache.get(key) # KeyError if missing, or cache.get(key, default)
+# except KeyError:
+#     value = ...
+#     cache.set(key, value)
 
+import os, time, fcntl, hashlib, tempfile, logging
 from functools import wraps
 import pickle
+import numpy as np
+
+# get() without a default raises KeyError on a miss, so that a stored None is a hit
+_missing = object()
+
+# default directory for the caches of the scripts
+default_cachedir = os.environ.get('SCRIPTS_CACHEDIR', os.path.join(os.path.expanduser('~'), '.cache', 'scripts'))
+
+def _update_hash(h, obj):
+    """
+    Feed obj to the hash h in a way that is stable across processes and runs.
+    numpy arrays are hashed by content, strings that are paths to existing files
+    also by modification time and size, containers recursively, other objects by their pickle.
+    Raise TypeError for objects that cannot be pickled: a key from their repr (memory address)
+    would change at every run and the cache would always miss.
+    """
+    if isinstance(obj, np.ndarray):
+        h.update(b'ndarray' + obj.dtype.str.encode() + str(obj.shape).encode())
+        h.update(np.ascontiguousarray(obj).view(np.uint8).data if obj.size else b'')
+    elif isinstance(obj, str):
+        h.update(b'str' + obj.encode())
+        if os.path.exists(obj):
+            st = os.stat(obj)
+            h.update(b'file%i-%i' % (st.st_mtime_ns, st.st_size))
+    elif isinstance(obj, bytes):
+        h.update(b'bytes' + obj)
+    elif isinstance(obj, (list, tuple)):
+        h.update(type(obj).__name__.encode() + b'%i' % len(obj))
+        for item in obj:
+            _update_hash(h, item)
+    elif isinstance(obj, (set, frozenset)):
+        # the order of a set changes between runs
+        h.update(type(obj).__name__.encode() + b'%i' % len(obj))
+        for digest in sorted(hash_args(item) for item in obj):
+            h.update(digest.encode())
+    elif isinstance(obj, dict):
+        h.update(b'dict%i' % len(obj))
+        for k in sorted(obj, key=repr):
+            _update_hash(h, k)
+            _update_hash(h, obj[k])
+    elif obj is None or isinstance(obj, (bool, int, float, complex, np.generic)):
+        h.update(type(obj).__name__.encode() + repr(obj).encode())
+    elif hasattr(obj, 'tostring') and hasattr(obj, 'cards'): # astropy header
+        h.update(b'header' + obj.tostring().encode())
+    else:
+        try:
+            h.update(type(obj).__name__.encode() + pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            raise TypeError('Cannot make a stable cache key from %s object: %s' % (type(obj).__name__, e))
+
+def hash_args(*args, **kwargs):
+    """
+    Return a stable hex digest of the arguments (see _update_hash)
+    """
+    h = hashlib.sha1()
+    _update_hash(h, args)
+    _update_hash(h, kwargs)
+    return h.hexdigest()
 
 def diskcached(cachefile, saveafter=1):
     def cacheondisk(fn):
@@ -37,21 +111,252 @@ def diskcached(cachefile, saveafter=1):
 
         @wraps(fn)
         def usingcache(*args, **kwargs):
-            try:
-                key = hash((args, kwargs))
-            except TypeError:
-                key = repr((args, kwargs))
+            # hash() of strings changes at every run, use a stable hash
+            key = hash_args(*args, **kwargs)
             try:
                 ret = cache[key]
             except KeyError:
                 ret = cache[key] = fn(*args, **kwargs)
                 unsaved[0] += 1
                 if unsaved[0] >= saveafter:
-                    with open(cachefile, 'wb') as f:
-                        pickle.dump(cache, f)
+                    # a temporary file of our own, other jobs may be saving the same cache
+                    fd, tmpfile = tempfile.mkstemp(prefix=os.path.basename(cachefile)+'.tmp', dir=os.path.dirname(os.path.abspath(cachefile)))
+                    try:
+                        with os.fdopen(fd, 'wb') as f:
+                            pickle.dump(cache, f)
+                        os.replace(tmpfile, cachefile)
+                    except:
+                        if os.path.exists(tmpfile): os.remove(tmpfile)
+                        raise
                     unsaved[0] = 0
             return ret
 
         return usingcache
 
     return cacheondisk
+
+
+class diskCache(object):
+    """
+    Cache on disk with one pickle file per entry, safe to share among processes.
+    Entries are written atomically (temporary file + rename) holding a lock on the cache directory,
+    reading needs no lock. The last access time of an entry is its file mtime: entries not used
+    for more than maxage seconds are removed and then the least recently used ones
+    until the cache is smaller than maxsize bytes.
+    The size of the cache is tracked in a file updated by set(), the cache is scanned only when
+    it grows over maxsize or at most every scan_interval seconds (for maxage and leftover temporary files).
+    """
+    scan_interval = 3600
+
+    def __init__(self, cachedir, maxsize=None, maxage=None):
+        """
+        cachedir: directory of the cache (created if needed)
+        maxsize: max size of the cache in bytes (default: no limit)
+        maxage: remove entries not used for this number of seconds (default: no limit)
+        """
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        self.maxage = maxage
+        self.hits = 0
+        self.misses = 0
+        self.lastscan = 0
+        os.makedirs(cachedir, exist_ok=True)
+
+    def key(self, *args, **kwargs):
+        return hash_args(*args, **kwargs)
+
+    def _path(self, key):
+        return os.path.join(self.cachedir, key[:2], key+'.pkl')
+
+    def _lock(self):
+        """
+        Return an open file holding an exclusive lock on the cache, close it to release.
+        """
+        f = open(os.path.join(self.cachedir, '.lock'), 'a')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def _sizefile(self):
+        return os.path.join(self.cachedir, '.size')
+
+    def _read_size(self):
+        """
+        Return the tracked size of the cache in bytes (None if unknown), call it holding the lock.
+        """
+        try:
+            with open(self._sizefile()) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def _write_size(self, size):
+        with open(self._sizefile(), 'w') as f:
+            f.write('%i' % size)
+
+    def get(self, key, default=_missing):
+        """
+        Return the value of an entry, if missing return default or raise KeyError if no default is given.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            if default is _missing: raise KeyError(key)
+            return default
+        try:
+            os.utime(path) # last access
+        except OSError:
+            pass
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """
+        Store an entry and evict old entries if needed.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmpfile = tempfile.mkstemp(prefix='.tmp', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            lock = self._lock()
+            try:
+                try:
+                    oldsize = os.stat(path).st_size
+                except OSError:
+                    oldsize = 0
+                os.replace(tmpfile, path)
+                size = self._read_size()
+                if size is not None:
+                    size += os.stat(path).st_size - oldsize
+                    self._write_size(size)
+                if size is None or (self.maxsize is not None and size > self.maxsize) or \
+                   time.time() - self.lastscan > self.scan_interval:
+                    self._evict()
+            finally:
+                lock.close()
+        except:
+            if os.path.exists(tmpfile): os.remove(tmpfile)
+            raise
+
+    def _entries(self, tmpfiles=None):
+        """
+        Return a list of (last access, size, path) of all entries.
+        tmpfiles: if a list, add (mtime, size, path) of the temporary files to it
+        """
+        entries = []
+        for d in os.scandir(self.cachedir):
+            if not d.is_dir(): continue
+            for e in os.scandir(d.path):
+                if e.name.endswith('.pkl'): files = entries
+                elif e.name.startswith('.tmp') and tmpfiles is not None: files = tmpfiles
+                else: continue
+                try:
+                    st = e.stat()
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, e.path))
+        return entries
+
+    def _evict(self):
+        """
+        Scan the cache: apply maxsize/maxage, remove old temporary files left by killed processes
+        and store the size. Call it holding the lock.
+        """
+        tmpfiles = []
+        entries = sorted(self._entries(tmpfiles))
+        size = sum(e[1] for e in entries)
+        now = time.time()
+        removed = 0
+        for mtime, esize, path in entries:
+            if (self.maxage is None or now - mtime <= self.maxage) and \
+               (self.maxsize is None or size <= self.maxsize):
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= esize
+            removed += 1
+        if removed > 0:
+            logging.debug('Cache %s: removed %i entries.' % (self.cachedir, removed))
+        # temporary files being written now are recent
+        for mtime, esize, path in tmpfiles:
+            if now - mtime > self.scan_interval:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        self._write_size(size)
+        self.lastscan = now
+
+    def evict(self):
+        """
+        Apply maxsize/maxage now.
+        """
+        lock = self._lock()
+        try:
+            self._evict()
+        finally:
+            lock.close()
+
+    def delete(self, key):
+        lock = self._lock()
+        try:
+            path = self._path(key)
+            esize = os.stat(path).st_size
+            os.remove(path)
+            size = self._read_size()
+            if size is not None: self._write_size(max(size - esize, 0))
+        except OSError:
+            pass
+        finally:
+            lock.close()
+
+    def clear(self):
+        lock = self._lock()
+        try:
+            for mtime, size, path in self._entries():
+                os.remove(path)
+            self._write_size(0)
+        finally:
+            lock.close()
+
+    def stats(self):
+        """
+        Return hits and misses of this instance, number of entries and size (bytes) of the cache.
+        """
+        entries = self._entries()
+        return {'hits':self.hits, 'misses':self.misses, 'entries':len(entries), 'size':sum(e[1] for e in entries)}
+
+
+def diskcache(cachedir, maxsize=None, maxage=None):
+    """
+    Decorator that caches the results of a function in a diskCache.
+    The key is the function name and a content hash of the arguments.
+    The cache is available as function.cache
+    """
+    def cacheondisk(fn):
+        cache = diskCache(cachedir, maxsize=maxsize, maxage=maxage)
+        name = fn.__module__+'.'+fn.__qualname__
+        missing = object()
+
+        @wraps(fn)
+        def usingcache(*args, **kwargs):
+            key = cache.key(name, *args, **kwargs)
+            ret = cache.get(key, missing)
+            if ret is missing:
+                ret = fn(*args, **kwargs)
+                cache.set(key, ret)
+            return ret
+
+        usingcache.cache = cache
+        return usingcache
+
+    return cacheondisk
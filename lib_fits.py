@@ -19,6 +19,7 @@
 
 import numpy as np
 import os, sys, logging, re, copy
+from functools import lru_cache
 
 from astropy.wcs import WCS as pywcs
 from astropy.io import fits as pyfits
@@ -28,21 +29,35 @@ from astropy.coordinates import match_coordinates_sky, SkyCoord
 from astropy.convolution import Gaussian2DKernel
 import pyregion
 import astropy.units as u
+from lib_cache import hash_args
 
-def flatten(filename, channel=0, stokes=0):
-    """ Flatten a fits file so that it becomes a 2D image. Return new header and data """
+# precision of image data, weights and reprojected arrays and of the written images, see set_precision()
+precision = 'double'
+
+def set_precision(prec):
+    """
+    Set the floating point precision used for the image data, weights and reprojected arrays:
+    single (float32, images written with BITPIX=-32) halves memory and I/O, double (default) is float64
+    but keeps the data read from files in their own type.
+    Sums over many images (e.g. mosaics) should be accumulated in float64 in any case.
+    """
+    global precision
+    if prec not in ['single', 'double']:
+        raise ValueError('Precision must be single or double, not %s.' % prec)
+    precision = prec
+
+def float_type():
+    """ Floating point type of the current precision """
+    return np.float32 if precision == 'single' else np.float64
 
-    f = pyfits.open(filename)
-    header_init = f[0].header
+def flatten_header(header_init, channel=0, stokes=0):
+    """ Return the 2D header of a fits header and the slice to get the 2D data from the original data """
 
     naxis = header_init['NAXIS']
     if naxis<2:
         raise RadioError('Can\'t make map from this')
-    if naxis==2:
-        pass
-        #return f[0].header,f[0].data
 
-    w = pywcs(f[0].header)
+    w = pywcs(header_init)
     wn = pywcs(naxis=2)
 
     wn.wcs.crpix[0]=w.wcs.crpix[0]
@@ -54,11 +69,11 @@ def flatten(filename, channel=0, stokes=0):
 
     header = wn.to_header()
     header["NAXIS"]=2
-    header["NAXIS1"]=f[0].header['NAXIS1']
-    header["NAXIS2"]=f[0].header['NAXIS2']
+    header["NAXIS1"]=header_init['NAXIS1']
+    header["NAXIS2"]=header_init['NAXIS2']
     copy=('EQUINOX','EPOCH')
     for k in copy:
-        r=f[0].header.get(k)
+        r=header_init.get(k)
         if r:
             header[k]=r
 
@@ -76,20 +91,404 @@ def flatten(filename, channel=0, stokes=0):
             dataslice.append(0)
 
     # add freq
-    freq = find_freq(f[0].header)
+    freq = find_freq(header_init)
     if freq is not None:
         header["FREQ"] = freq
 
     # add beam if present
     try:
-        header["BMAJ"]=f[0].header['BMAJ']
-        header["BMIN"]=f[0].header['BMIN']
-        header["BPA"]=f[0].header['BPA']
+        header["BMAJ"]=header_init['BMAJ']
+        header["BMIN"]=header_init['BMIN']
+        header["BPA"]=header_init['BPA']
     except:
         pass
 
+    return header, tuple(dataslice)
+
+
+def read_plane(hdu, dataslice, section=None):
+    """
+    Read a 2D plane (and optionally only a section: a (y, x) tuple of slices) of a memory-mapped hdu into memory,
+    as float32 in single precision
+    """
+    if section is not None:
+        dataslice = dataslice[:-2] + tuple(section)
+    data = hdu.data[dataslice]
+    dtype = np.float32 if precision == 'single' else data.dtype.newbyteorder('=')
+    return np.array(data, dtype=dtype) # copy, so the file can be closed
+
+
+def flatten(filename, channel=0, stokes=0):
+    """ Flatten a fits file so that it becomes a 2D image. Return new header and data """
+
+    # the file is memory mapped, only the needed plane is read
+    with pyfits.open(filename, memmap=True) as f:
+        header, dataslice = flatten_header(f[0].header, channel=channel, stokes=stokes)
+        data = read_plane(f[0], dataslice)
+
     # slice=(0,)*(naxis-2)+(np.s_[:],)*2
-    return header, f[0].data[tuple(dataslice)]
+    return header, data
+
+
+def _median(data, work):
+    """
+    Median of data using work (same size) as buffer, O(N) with np.partition
+    """
+    n = len(data)
+    np.copyto(work, data)
+    if n % 2:
+        work.partition(n//2)
+        return work[n//2]
+    work.partition([n//2-1, n//2])
+    return 0.5*(work[n//2-1] + work[n//2])
+
+
+def clipped_rms(data, niter=1000, eps=1e-3, sigma=5, logname=''):
+    """
+    Robust rms: iteratively remove values with |data| > sigma*MAD until the MAD changes less than eps
+    (relative), then return the std of the remaining data, their number and the initial number.
+    The MAD is found with np.partition and the same buffers are used for all iterations.
+    """
+    n = initial_len = len(data)
+    buf = np.array(data) # copy
+    work = np.empty_like(buf)
+    mask = np.empty(n, dtype=bool)
+    mad_old = 0.
+    for i in range(niter):
+        med = _median(buf[:n], work[:n])
+        np.subtract(buf[:n], med, out=work[:n])
+        np.abs(work[:n], out=work[:n])
+        mad = _median(work[:n], work[:n])
+        logging.debug('%s: MAD noise: %f uJy on %f%% data' % (logname, mad*1e6, 100*n/initial_len))
+        if np.isnan(mad): break
+        if np.abs(mad_old-mad)/mad < eps:
+            return np.std(buf[:n]), n, initial_len
+
+        np.abs(buf[:n], out=work[:n])
+        np.less(work[:n], sigma*mad, out=mask[:n])
+        m = np.count_nonzero(mask[:n])
+        np.compress(mask[:n], buf[:n], out=work[:m])
+        buf, work = work, buf
+        n = m
+        mad_old = mad
+    raise Exception('Noise estimation failed to converge.')
+
+
+@lru_cache(maxsize=16)
+def convolution_kernel(stddev_maj, stddev_min, theta):
+    """
+    Elliptical gaussian kernel (stddev in pixels, theta in rad) used by Image.convolve, cached
+    since images with the same beam and pixel size are convolved with the same kernel
+    """
+    from lib_beamdeconv import EllipticalGaussian2DKernel
+    return EllipticalGaussian2DKernel(stddev_maj, stddev_min, theta).array
+
+
+def kernel_halfsize(stddev_maj, stddev_min, theta):
+    """
+    Half size (y, x) of the convolution_kernel() array, without building it
+    """
+    from astropy.modeling.utils import ellipse_extent
+    extent = np.max(ellipse_extent(stddev_maj, stddev_min, theta))
+    size = int(np.ceil(16 * extent)) # 8 stddev support, rounded up to odd
+    return (size + 1 - size % 2) // 2, (size + 1 - size % 2) // 2
+
+
+def kernel_fft(stddev_maj, stddev_min, theta, fshape, analytic=False):
+    """
+    rfft2 of the convolution kernel on a grid of shape fshape, with the kernel center in (0, 0).
+    If analytic, the Fourier transform of the (not truncated) elliptical gaussian is computed directly.
+    Not cached: it is as large as the image, only the real-space kernel is (see convolution_kernel).
+    """
+    from scipy import fft
+    if analytic:
+        # covariance of the gaussian in pixels (x along columns)
+        c, s = np.cos(theta), np.sin(theta)
+        cxx = (stddev_maj*c)**2 + (stddev_min*s)**2
+        cyy = (stddev_maj*s)**2 + (stddev_min*c)**2
+        cxy = (stddev_maj**2 - stddev_min**2) * s * c
+        fy = fft.fftfreq(fshape[0])[:, np.newaxis]
+        fx = fft.rfftfreq(fshape[1])[np.newaxis, :]
+        return np.exp(-2 * np.pi**2 * (cxx*fx**2 + 2*cxy*fx*fy + cyy*fy**2))
+    kernel = convolution_kernel(stddev_maj, stddev_min, theta)
+    ky, kx = kernel.shape
+    # kernel center moved to (0, 0)
+    kpad = np.zeros(fshape)
+    kpad[:ky, :kx] = kernel
+    kpad = np.roll(kpad, (-(ky//2), -(kx//2)), axis=(0, 1))
+    return fft.rfft2(kpad, fshape)
+
+
+def fft_convolve(data, stddev_maj, stddev_min, theta, analytic=False):
+    """
+    Convolve with the elliptical gaussian of convolution_kernel() using FFTs.
+    Same as astropy convolve(data, kernel, boundary=None, preserve_nan=True):
+    NaNs are ignored (normalising by the kernel sum on the valid pixels) and kept,
+    pixels closer to the edge than half kernel are set to 0.
+    """
+    from scipy import fft
+    ny, nx = data.shape
+    hy, hx = kernel_halfsize(stddev_maj, stddev_min, theta)
+    # zero padding avoids wrapping around, fast FFT lengths
+    fshape = (fft.next_fast_len(ny + hy, real=True), fft.next_fast_len(nx + hx, real=True))
+    kft = kernel_fft(stddev_maj, stddev_min, theta, fshape, analytic)
+    nans = np.isnan(data)
+    conv = fft.irfft2(fft.rfft2(np.where(nans, 0, data), fshape) * kft, fshape)[:ny, :nx]
+    if nans.any():
+        norm = fft.irfft2(fft.rfft2(~nans, fshape) * kft, fshape)[:ny, :nx]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            conv /= norm
+        conv[norm < 1e-8] = np.nan
+    else:
+        conv /= kft[0, 0].real # kernel sum
+    # (not conv[-hy:], that is the whole array for a sub-pixel kernel with hy = 0)
+    conv[:hy] = 0; conv[ny-hy:] = 0
+    conv[:, :hx] = 0; conv[:, nx-hx:] = 0
+    conv[nans] = np.nan
+    return conv.astype(data.dtype, copy=False) if data.dtype.kind == 'f' else conv
+
+
+def regrid_footprint(hdr_in, hdr_out):
+    """
+    Return the box (y0, y1, x0, x1) of the output grid covered by the input image, None if no overlap
+    """
+    w_in, w_out = pywcs(hdr_in), pywcs(hdr_out)
+    ny, nx = hdr_in['NAXIS2'], hdr_in['NAXIS1']
+    # sample the border of the input image
+    edge_x = np.linspace(-0.5, nx-0.5, 200)
+    edge_y = np.linspace(-0.5, ny-0.5, 200)
+    x = np.concatenate([edge_x, edge_x, np.full(200, -0.5), np.full(200, nx-0.5)])
+    y = np.concatenate([np.full(200, -0.5), np.full(200, ny-0.5), edge_y, edge_y])
+    ra, dec = w_in.all_pix2world(x, y, 0)
+    with np.errstate(invalid='ignore'):
+        xo, yo = w_out.all_world2pix(ra, dec, 0)
+    good = np.isfinite(xo) & np.isfinite(yo)
+    if not good.any(): return None
+    # one pixel margin
+    x0, x1 = max(0, int(np.floor(xo[good].min()))-1), min(hdr_out['NAXIS1'], int(np.ceil(xo[good].max()))+2)
+    y0, y1 = max(0, int(np.floor(yo[good].min()))-1), min(hdr_out['NAXIS2'], int(np.ceil(yo[good].max()))+2)
+    if x0 >= x1 or y0 >= y1: return None
+    return y0, y1, x0, x1
+
+
+def regrid_map(hdr_in, hdr_out, cache=None):
+    """
+    Return the footprint box on the output grid and, for each output pixel in the box,
+    the position on the input image (the same used by reproject_interp). Positions
+    outside the input image are moved far away, so they are blanked by the interpolation.
+    cache: a lib_cache.diskCache, the map is computed once for each (input, output) grid.
+    """
+    from astropy.wcs.utils import pixel_to_pixel
+    if cache is not None:
+        key = cache.key('regrid_map', hdr_in, hdr_out)
+        try:
+            return cache.get(key)
+        except KeyError:
+            pass
+    bbox = regrid_footprint(hdr_in, hdr_out)
+    coords = None
+    if bbox is not None:
+        y0, y1, x0, x1 = bbox
+        yy, xx = np.mgrid[y0:y1, x0:x1]
+        x_in, y_in = pixel_to_pixel(pywcs(hdr_out), pywcs(hdr_in), xx.astype(float), yy.astype(float))
+        coords = np.array([y_in, x_in])
+        # as reproject: positions in the outer half of the border pixels get the border value
+        outside = ~np.all(np.isfinite(coords), axis=0)
+        for axis, n in enumerate([hdr_in['NAXIS2'], hdr_in['NAXIS1']]):
+            with np.errstate(invalid='ignore'):
+                outside |= (coords[axis] < -0.5) | (coords[axis] > n-0.5)
+            np.clip(coords[axis], 0, n-1, out=coords[axis])
+        coords[:, outside] = -10
+    plan = {'bbox':bbox, 'coords':coords}
+    if cache is not None: cache.set(key, plan)
+    return plan
+
+
+def regrid_method(hdr_in, hdr_out):
+    """
+    Choose the reprojection algorithm from the ratio of output to input pixel size:
+    interp if output pixels are not larger than 1.2 input pixels, adaptive (anti-aliased)
+    up to 3 input pixels, exact (flux conserving) for larger output pixels.
+    """
+    ratio = np.abs(hdr_out['CDELT2'] / hdr_in['CDELT2'])
+    if ratio <= 1.2: return 'interp'
+    elif ratio <= 3: return 'adaptive'
+    return 'exact'
+
+
+def make_tiles(shape, tilesize):
+    """
+    Split a (ny, nx) grid in tiles of at most tilesize x tilesize pixels, return a list of boxes (y0, y1, x0, x1)
+    """
+    ny, nx = shape
+    return [(y0, min(y0+tilesize, ny), x0, min(x0+tilesize, nx)) for y0 in range(0, ny, tilesize) for x0 in range(0, nx, tilesize)]
+
+
+def sub_header(header, box):
+    """
+    Return the header of the part box = (y0, y1, x0, x1) of the 2D grid of header
+    """
+    y0, y1, x0, x1 = box
+    header = header.copy()
+    header['NAXIS1'] = x1 - x0
+    header['NAXIS2'] = y1 - y0
+    header['CRPIX1'] -= x0
+    header['CRPIX2'] -= y0
+    return header
+
+
+def create_fits(filename, header, dtype=None):
+    """
+    Create a fits file with header and (not initialised) data without holding them in memory,
+    return the data memory mapped for writing. dtype: default of the current precision (see set_precision)
+    """
+    if dtype is None: dtype = float_type()
+    shape = tuple(header['NAXIS%i' % i] for i in range(header['NAXIS'], 0, -1))
+    # header with the structural keywords of a small image, then the actual sizes
+    hdr = pyfits.PrimaryHDU(data=np.zeros((1,)*len(shape), dtype=dtype)).header
+    for i, n in enumerate(shape[::-1]):
+        hdr['NAXIS%i' % (i+1)] = n
+    hdr.extend([card for card in header.cards if card.keyword not in ('SIMPLE', 'BITPIX', 'EXTEND') and not card.keyword.startswith('NAXIS')])
+    hdr.tofile(filename, overwrite=True)
+    offset = len(hdr.tostring())
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    with open(filename, 'rb+') as f:
+        # data are padded to blocks of 2880 bytes
+        f.seek(offset + int(np.ceil(nbytes / 2880.)) * 2880 - 1)
+        f.write(b'\0')
+    return np.memmap(filename, dtype=np.dtype(dtype).newbyteorder('>'), mode='r+', offset=offset, shape=shape)
+
+
+def match_catalogues(ref_ra, ref_dec, cats):
+    """
+    Cross-match a reference catalogue with many catalogues: for each reference source find the nearest
+    source of each catalogue, as match_coordinates_sky(ref, cat) but with the reference converted once
+    and plain KD-trees on unit vectors.
+    ref_ra, ref_dec: deg; cats: list of (ra, dec) in deg
+    Returns a list of (idx, sep) per catalogue, sep in deg (idx = 0 and sep = inf if the catalogue is empty)
+    """
+    from scipy.spatial import cKDTree
+    ref = _xyz(ref_ra, ref_dec)
+    matches = []
+    for ra, dec in cats:
+        if len(ra) == 0:
+            matches.append((np.zeros(len(ref), dtype=int), np.full(len(ref), np.inf)))
+            continue
+        dist, idx = cKDTree(_xyz(ra, dec)).query(ref)
+        matches.append((idx, _chord2deg(dist)))
+    return matches
+
+
+def _xyz(ra, dec):
+    """ Unit vectors of ra, dec (deg) """
+    ra, dec = np.radians(np.asarray(ra, dtype=float)), np.radians(np.asarray(dec, dtype=float))
+    return np.column_stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)])
+
+
+def _chord2deg(dist):
+    """ Chord between unit vectors to angle (deg) """
+    return np.degrees(2*np.arcsin(np.minimum(dist/2, 1)))
+
+
+def angular_sep(ra1, dec1, ra2, dec2):
+    """
+    Angular separation (deg) between ra1, dec1 and ra2, dec2 (deg, arrays are broadcast), haversine formula
+    """
+    ra1, dec1, ra2, dec2 = [np.radians(x) for x in [ra1, dec1, ra2, dec2]]
+    return np.degrees(2*np.arcsin(np.sqrt(np.sin((dec2-dec1)/2)**2 + np.cos(dec1)*np.cos(dec2)*np.sin((ra2-ra1)/2)**2)))
+
+
+def isolation(ra, dec):
+    """
+    Distance (deg) of each source to its nearest neighbour in the same catalogue,
+    as match_coordinates_sky(cat, cat, nthneighbor=2) (inf if there is only one source)
+    """
+    from scipy.spatial import cKDTree
+    if len(ra) < 2: return np.full(len(ra), np.inf)
+    xyz = _xyz(ra, dec)
+    dist, idx = cKDTree(xyz).query(xyz, k=2)
+    return _chord2deg(dist[:,1])
+
+
+class catalogueIndex(object):
+    """
+    Spatial index of a (large) reference catalogue.
+    Sources are sorted by declination, with the distance to the nearest neighbour in the whole
+    catalogue (column ISOL, deg), so a query reads only the declination band it needs.
+    If cachedir is given the index is built once and kept there as one .npy file per column,
+    memory mapped by later runs, otherwise it is built in memory.
+    """
+
+    def __init__(self, catalogue, columns=[], cachedir=None):
+        """
+        catalogue: fits catalogue with RA and DEC columns (deg)
+        columns: other columns to keep
+        cachedir: directory to keep the index in, (default: None, in memory only)
+        """
+        self.columns = ['RA', 'DEC', 'ISOL'] + list(columns)
+        if cachedir is None:
+            self.data = self._build(catalogue)
+            return
+        # the catalogue by path, mtime and size
+        self.indexdir = os.path.join(cachedir, hash_args(os.path.abspath(catalogue), self.columns))
+        if not os.path.exists(self.indexdir):
+            self._save(self._build(catalogue), cachedir)
+        self.data = {name: np.load(os.path.join(self.indexdir, name+'.npy'), mmap_mode='r') for name in self.columns}
+
+    def _build(self, catalogue):
+        from astropy.table import Table
+        logging.info('Building index of %s...' % catalogue)
+        t = Table.read(catalogue)
+        order = np.argsort(np.asarray(t['DEC'], dtype=float), kind='stable')
+        data = {'RA': np.asarray(t['RA'], dtype=float)[order], 'DEC': np.asarray(t['DEC'], dtype=float)[order]}
+        data['ISOL'] = isolation(data['RA'], data['DEC'])
+        for name in self.columns[3:]:
+            data[name] = np.asarray(t[name])[order]
+        return data
+
+    def _save(self, data, cachedir):
+        import tempfile
+        os.makedirs(cachedir, exist_ok=True)
+        tmpdir = tempfile.mkdtemp(dir=cachedir)
+        for name in self.columns:
+            np.save(os.path.join(tmpdir, name+'.npy'), data[name])
+        try:
+            os.rename(tmpdir, self.indexdir)
+        except OSError:
+            # made at the same time by another process
+            import shutil
+            shutil.rmtree(tmpdir)
+
+    def __len__(self):
+        return len(self.data['DEC'])
+
+    def cone(self, ra, dec, radius):
+        """
+        Return a dict with the columns of the sources within radius (deg) of ra, dec (deg)
+        """
+        lo, hi = np.searchsorted(self.data['DEC'], [dec-radius, dec+radius])
+        near = angular_sep(ra, dec, self.data['RA'][lo:hi], self.data['DEC'][lo:hi]) < radius
+        return {name: np.asarray(col[lo:hi][near]) for name, col in self.data.items()}
+
+
+@lru_cache(maxsize=4)
+def get_catalogue_index(catalogue, columns=(), cachedir=None):
+    """
+    The catalogueIndex of catalogue, opened once per process
+    """
+    return catalogueIndex(catalogue, columns, cachedir)
+
+
+def run_bdsf(imagefile, img_cat):
+    """
+    Extract sources with PyBDSF, write the catalogue (fits) img_cat and the gaussian skymodel (bbs) used by Image.make_catalogue
+    """
+    import bdsf
+    bdsf_img = bdsf.process_image(imagefile, rms_box=(100,30), \
+                                  thresh_pix=5, thresh_isl=3, atrous_do=False, \
+                                  adaptive_rms_box=True, adaptive_thresh=100, rms_box_bright=(30,10), quiet=True)
+    bdsf_img.write_catalog(outfile=img_cat, catalog_type='srl', format='fits', clobber=True)
+    bdsf_img.write_catalog(outfile=img_cat.replace('.cat', '.skymodel'), catalog_type='gaul', format='bbs', bbs_patches='source', clobber=True, srcroot='src')
 
 
 def correct_beam_header(header):
@@ -128,7 +527,12 @@ def find_freq(header):
  
 class AllImages():
 
-    def __init__(self, filenames, channel=0, stokes=0):
+    def __init__(self, filenames, channel=0, stokes=0, lazy=False):
+        """
+        filenames: list of fits files
+        channel, stokes: plane to use for cubes
+        lazy: read the data of each image only when used (see Image)
+        """
         if len(filenames) == 0:
             logging.error('Cannot find images!')
             raise ValueError()
@@ -137,10 +541,12 @@ class AllImages():
         self.images = []
         img_list, freqs = [], []
         for filename in filenames:
-            img_list.append(Image(filename))
+            img_list.append(Image(filename, channel=channel, stokes=stokes, lazy=lazy))
             freqs.append(img_list[-1].freq)
         self.images = [img_list[i] for i in np.argsort(freqs)]
         self.freqs = np.sort(freqs)
+        # identity of the current products (see run_step), starts from the input files (path, mtime, size), plane and precision
+        self.product_key = hash_args([os.path.abspath(filename) for filename in filenames], channel, stokes, precision)
 
 
     def __len__(self):
@@ -161,8 +567,24 @@ class AllImages():
     def __getitem__(self, x):
         return self.images[x]
 
-    def align_catalogue(self):
+    def make_catalogues(self, ncpu=1):
+        """
+        Run make_catalogue on all images, the source extraction of up to ncpu images at a time in different processes
+        """
+        todo = [image for image in self if not os.path.exists(image.imagefile+'.cat')]
+        if ncpu > 1 and len(todo) > 1:
+            from lib_multiproc import multiprocPool
+            logging.info('Extracting sources from %i images (%i at a time)...' % (len(todo), min(ncpu, len(todo))))
+            with multiprocPool(min(ncpu, len(todo)), run_bdsf) as pool:
+                list(pool.imap([[image.imagefile, image.imagefile+'.cat'] for image in todo], ordered=False))
         [image.make_catalogue() for image in self]
+
+    def align_catalogue(self, ncpu=1):
+        """
+        Shift all images to the catalogue of the one with the lowest (scaled) noise
+        ncpu: number of source extractions to run at the same time
+        """
+        self.make_catalogues(ncpu=ncpu)
         # ref cat - use lowest scaled noise as reference.
         noise = [image.calc_noise()*(image.get_freq()/(54.e6))**0.8 for image in self]
         ref_idx = np.argmin(noise)
@@ -170,15 +592,15 @@ class AllImages():
         logging.info(f'Reference cat: {self[ref_idx].imagefile}')
         # keep only point sources
         target_beam = self.common_beam(circbeam=True)
+        # cross match all catalogues with the reference
+        matches = match_catalogues(ref_cat['RA'], ref_cat['DEC'], [(image.cat['RA'], image.cat['DEC']) for image in self])
         for i, image in enumerate(self):
             if i == ref_idx:
                 # skip ref_cat
                 continue
-            # cross match
-            idx_match, sep, _ = match_coordinates_sky(SkyCoord(ref_cat['RA'], ref_cat['DEC']), \
-                                                      SkyCoord(image.cat['RA'], image.cat['DEC']))
-            idx_matched_ref = np.arange(0, len(ref_cat))[sep < target_beam[0] * u.degree]
-            idx_matched_img = idx_match[sep < target_beam[0] * u.degree]
+            idx_match, sep = matches[i]
+            idx_matched_ref = np.arange(0, len(ref_cat))[sep < target_beam[0]]
+            idx_matched_img = idx_match[sep < target_beam[0]]
 
             # find & apply shift
             if len(idx_match) < 5:
@@ -245,7 +667,19 @@ class AllImages():
             target_beam = [common_beam.major.to_value('deg'), common_beam.minor.to_value('deg'), common_beam.pa.to_value('deg')]
         return target_beam
 
-    def convolve_to(self, beam=None, circbeam=False):
+    def target_beam(self, beam=None, circbeam=False):
+        """
+        Return the beam [bmaj, bmin, bpa] in deg to convolve to: beam ([asec, asec, deg]) or, if None, the smallest common beam
+        """
+        if beam is None:
+            target_beam = self.common_beam(circbeam=circbeam)
+        else:
+            target_beam = [beam[0] / 3600., beam[1] / 3600., beam[2]]
+        logging.info('Final beam: %.1f" %.1f" (pa %.1f deg)' \
+                     % (target_beam[0] * 3600., target_beam[1] * 3600., target_beam[2]))
+        return target_beam
+
+    def convolve_to(self, beam=None, circbeam=False, method='fft'):
         """
         Convolve all images to a common beam. By default, convolve to smallest common beam.
 
@@ -255,19 +689,14 @@ class AllImages():
             Beam parameters [b_major, b_minor, b_pa] in [asec, asec, deg]. None: find smallest common beam
         circbeam: bool, optional. Default = False
             Force circular beam
+        method: str, optional. Default = 'fft'
+            Convolution method, see Image.convolve
         """
-
-        if beam is None:
-            target_beam = self.common_beam(circbeam=circbeam)
-        else:
-            target_beam = [beam[0] / 3600., beam[1] / 3600., beam[2]]
-        logging.info('Final beam: %.1f" %.1f" (pa %.1f deg)' \
-                     % (target_beam[0] * 3600., target_beam[1] * 3600., target_beam[2]))
-
+        target_beam = self.target_beam(beam=beam, circbeam=circbeam)
         for image in self.images:
-            image.convolve(target_beam)
+            image.convolve(target_beam, method=method)
 
-    def regrid_common(self, size=None, region=None, pixscale=None, radec=None, square=False, action='regrid'):
+    def regrid_common(self, size=None, region=None, pixscale=None, radec=None, square=False, action='regrid', method='exact', cache=None, ncpu=1, maxmem=None):
         """
         Move all images to a common grid
         Parameters
@@ -283,6 +712,14 @@ class AllImages():
             If False, do not force square image.
         action: regrid, header, regrid_header
             The function can perform the regrid or just return the common header or both
+        method: exact, interp, adaptive, auto. Default = exact
+            Reprojection algorithm, auto chooses for each image from the pixel size ratio (see regrid_method)
+        cache: lib_cache.diskCache, optional. Default = None
+            Cache for the reprojection maps and results, re-running on the same images/grid does not reproject again.
+        ncpu: int, optional. Default = 1
+            Number of images to regrid at the same time
+        maxmem: float, optional. Default = None
+            Max memory (bytes) for the images regridded at the same time (limits ncpu)
         """
 
         rwcs = pywcs(naxis=2)
@@ -297,13 +734,13 @@ class AllImages():
             mra = radec[0]
             mdec = radec[1]
         else:
-            midpix = np.array(self.images[0].img_data.shape)/2
+            midpix = np.array(self.images[0].shape)/2
             mra, mdec = self.images[0].get_wcs().all_pix2world(midpix[1], midpix[0], 0, ra_dec_order=True)
         rwcs.wcs.crval = [mra, mdec]
 
         if region:
             r = pyregion.open(region)
-            mask = r.get_mask(header=self.images[0].img_hdr, shape=self.images[0].img_data.shape)
+            mask = r.get_mask(header=self.images[0].img_hdr, shape=self.images[0].shape)
             intermediate = pyfits.PrimaryHDU(mask.astype(float), self.images[0].img_hdr)
             intermediate.writeto('__mask.fits', overwrite=True)
             w = self.images[0].get_wcs()
@@ -318,7 +755,7 @@ class AllImages():
         # Calculate sizes of all images to find smallest size that fits all images
         sizes = np.empty((len(self.images), 2))
         for i, image in enumerate(self.images):
-            sizes[i] = np.array(image.img_data.shape) * image.get_degperpixel()
+            sizes[i] = np.array(image.shape) * image.get_degperpixel()
         if size:
             size = np.array(size)
             if np.any(np.min(sizes, axis=1) < np.min(size)):
@@ -334,8 +771,8 @@ class AllImages():
             size = np.repeat(size, 2)
 
         # fits file are ordered the opposite way: (dec,ra)
-        ysize = int(np.rint(np.array([size[0]]) / cdelt))
-        xsize = int(np.rint(np.array([size[-1]]) / cdelt))
+        ysize = int(np.rint(size[0] / cdelt))
+        xsize = int(np.rint(size[-1] / cdelt))
         if xsize % 2 != 0: xsize += 1
         if ysize % 2 != 0: ysize += 1
         rwcs.wcs.crpix = [xsize / 2, ysize / 2]
@@ -349,11 +786,140 @@ class AllImages():
 
         logging.info(f'Regridded image size: {size} deg ({ysize:.0f},{xsize:.0f} pixels))')
         if action == 'regrid' or action == 'regrid_header':
-            for image in self.images:
-                image.regrid(regrid_hdr)
+            # input, output and ~3 output-sized temporary arrays per image
+            mem = max([image.img_data.nbytes for image in self.images]) + 4*8*xsize*ysize
+            nthreads = min(ncpu, len(self.images))
+            if maxmem is not None:
+                nthreads = max(1, min(nthreads, int(maxmem // mem)))
+            if nthreads > 1:
+                from concurrent.futures import ThreadPoolExecutor
+                logging.debug('Regridding %i images at a time.' % nthreads)
+                with ThreadPoolExecutor(nthreads) as executor:
+                    # reproject_exact would start other processes for each image
+                    list(executor.map(lambda image: image.regrid(regrid_hdr, method=method, cache=cache, parallel=False), self.images))
+            else:
+                for image in self.images:
+                    image.regrid(regrid_hdr, method=method, cache=cache)
         if action == 'header' or action == 'regrid_header':
             return regrid_hdr
 
+    def convolve_regrid_tiled(self, regrid_hdr, filenames, target_beam=None, tilesize=1024, method='exact', conv_method='fft', ncpu=1):
+        """
+        Out-of-core convolve_to + regrid: the common grid is split in tiles that are made one at a time
+        reading only the part of each image they need (see Image.get_tile) and written to memory mapped fits files.
+        Then the images use the data of these files, that are read only when needed.
+
+        Parameters
+        ----------
+        regrid_hdr: header of the common grid (e.g. from regrid_common(action='header'))
+        filenames: list of fits files to write, one per image (same order of the images)
+        target_beam: [bmaj, bmin, bpa] in deg, None: do not convolve
+        tilesize: int, optional. Default = 1024
+            Size of the tiles in pixels of the common grid
+        method: exact, interp, adaptive, auto. Reprojection algorithm (see Image.regrid)
+        conv_method: Convolution method (see Image.convolve)
+        ncpu: int, optional. Default = 1
+            Number of tiles to make at the same time
+        """
+        tiles = make_tiles((regrid_hdr['NAXIS2'], regrid_hdr['NAXIS1']), tilesize)
+        logging.info('Convolve+regrid in %i tiles of %i pixels.' % (len(tiles), tilesize))
+        outs = []
+        for image, filename in zip(self.images, filenames):
+            hdr = copy.copy(regrid_hdr)
+            for key in ['BMAJ', 'BMIN', 'BPA', 'FREQ', 'RESTFREQ']:
+                if key in image.img_hdr: hdr[key] = image.img_hdr[key]
+            if target_beam is not None:
+                hdr['BMAJ'], hdr['BMIN'], hdr['BPA'] = target_beam
+            outs.append(create_fits(filename, hdr))
+
+        def make_tile(box):
+            tile_hdr = sub_header(regrid_hdr, box)
+            y0, y1, x0, x1 = box
+            for image, out in zip(self.images, outs):
+                out[y0:y1, x0:x1] = image.get_tile(tile_hdr, target_beam=target_beam, method=method, conv_method=conv_method)
+
+        if ncpu > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(ncpu) as executor:
+                list(executor.map(make_tile, tiles))
+        else:
+            for box in tiles:
+                make_tile(box)
+
+        for image, out, filename in zip(self.images, outs, filenames):
+            out.flush()
+            del out
+            # copy-on-write memory map: changes of img_data are not written back
+            image.img_hdr = pyfits.getheader(filename)
+            image.img_data = pyfits.getdata(filename, memmap=True)
+            image.get_degperpixel()
+
+    def run_step(self, store, step, funct, *params):
+        """
+        Run a single step, see run_steps. Return what funct returns.
+        """
+        return self.run_steps(store, [(step, funct, params)])[0]
+
+    def run_steps(self, store, steps):
+        """
+        Run steps that modify all images in place (e.g. convolve, regrid, shift), or restore their products from store.
+        Products are keyed by a hash of the step name, of all params and of the key of the previous products,
+        so changing an input file or a parameter of this or of any earlier step gives a new entry.
+        Only the products of the last step found in store are read and earlier steps are skipped,
+        but for steps with an "after" function, that need their own products.
+
+        Parameters
+        ----------
+        store: lib_cache.diskCache or None
+            Where to keep the products, None to always run the steps
+        steps: list of (step, funct, params) or (step, funct, params, after)
+            step: name of the step
+            funct: callable that runs the step, what it returns is stored and restored with the images
+            params: everything else that affects the products (files are hashed by path, mtime and size)
+            after: callable run after the step (or its restore) e.g. to write the images, or None
+
+        Returns
+        -------
+        List of what each funct returns
+        """
+        steps = [tuple(step) + (None,)*(4-len(step)) for step in steps]
+        keys = []
+        for step, funct, params, after in steps:
+            keys.append(hash_args(step, keys[-1] if keys else self.product_key, *params))
+        values = [None]*len(steps)
+        start = 0
+        while store is not None and start < len(steps):
+            # the products of intermediate steps are needed up to the first step with an after function
+            last = next((i for i in range(start, len(steps)) if steps[i][3] is not None), len(steps)-1)
+            restored = False
+            for j in range(last, start-1, -1):
+                if keys[j] not in store: continue
+                # return values are small and kept apart, to read only the images of step j
+                stored = [store.get(hash_args(key, 'value'), None) for key in keys[start:j+1]]
+                product = store.get(keys[j], None)
+                if product is None or any(value is None for value in stored): continue
+                logging.info('Restoring %s products (%s).' % (steps[j][0], keys[j][:8]))
+                for image, (img_hdr, img_data) in zip(self.images, product['images']):
+                    image.img_hdr = img_hdr
+                    image.img_data = img_data
+                    image.get_degperpixel()
+                values[start:j+1] = [value['value'] for value in stored]
+                self.product_key = keys[j]
+                if steps[j][3] is not None: steps[j][3]()
+                start = j+1
+                restored = True
+                break
+            if not restored: break
+        for i in range(start, len(steps)):
+            step, funct, params, after = steps[i]
+            values[i] = funct()
+            self.product_key = keys[i]
+            if store is not None:
+                store.set(keys[i], {'images':[(image.img_hdr, image.img_data) for image in self.images]})
+                store.set(hash_args(keys[i], 'value'), {'value':values[i]})
+            if after is not None: after()
+        return values
+
     def suffix_exists(self, suffix):
         """ Check if suffix exists for all images"""
         return np.all([os.path.exists(name.replace('.fits', f'-{suffix}.fits')) for name in self.filenames])
@@ -366,14 +932,20 @@ class AllImages():
 
 class Image(object):
 
-    def __init__(self, imagefile, channel=0, stokes=0):
+    def __init__(self, imagefile, channel=0, stokes=0, lazy=False):
         """
         imagefile: name of the fits file
+        channel, stokes: plane to use for cubes
+        lazy: read only the header, the data plane is read when img_data is first used
         """
 
         logging.info(f"Open {imagefile}")
         self.imagefile = imagefile
-        header = pyfits.open(imagefile)[0].header
+        # the header is parsed once and the data are memory mapped, then the file is closed
+        with pyfits.open(imagefile, memmap=True) as f:
+            header = f[0].header.copy()
+            self.img_hdr, self._dataslice = flatten_header(header, channel=channel, stokes=stokes)
+            self._img_data = None if lazy else read_plane(f[0], self._dataslice)
         header = correct_beam_header(header)
         self.img_hdr_orig = header
 
@@ -398,15 +970,57 @@ class Image(object):
             self.mhz = None
 
         self.noise = None
-        self.img_hdr, self.img_data = flatten(self.imagefile, channel=channel, stokes=stokes)
-        self.img_hdu = pyfits.ImageHDU(data=self.img_data, header=self.img_hdr)
         self.set_beam(beam)
         self.set_freq(freq)
         self.ra = self.img_hdr['CRVAL1']
         self.dec = self.img_hdr['CRVAL2']
         self.get_degperpixel() # sets self.degperpixel (faster to call, no WCS call)
 
+    @property
+    def img_data(self):
+        if self._img_data is None:
+            logging.debug('%s: reading data.' % self.imagefile)
+            with pyfits.open(self.imagefile, memmap=True) as f:
+                self._img_data = read_plane(f[0], self._dataslice)
+        return self._img_data
+
+    @img_data.setter
+    def img_data(self, data):
+        self._img_data = data
+
+    @property
+    def img_hdr(self):
+        return self._img_hdr
+
+    @img_hdr.setter
+    def img_hdr(self, header):
+        self._img_hdr = header
+        self._wcs = None # see get_wcs
+
+    @property
+    def shape(self):
+        """ (ny, nx) of the image, from the header """
+        return (self.img_hdr['NAXIS2'], self.img_hdr['NAXIS1'])
+
+    @property
+    def img_hdu(self):
+        return pyfits.ImageHDU(data=self.img_data, header=self.img_hdr)
+
+    def is_loaded(self):
+        """
+        False if the data were not read yet (lazy mode)
+        """
+        return self._img_data is not None
 
+    def get_data(self, section=None):
+        """
+        Return the data, or only a section of them, i.e. a (y, x) tuple of slices, e.g. np.s_[100:200,:].
+        If the data are not in memory yet, only the section is read from the file.
+        """
+        if section is None: return self.img_data
+        if self._img_data is not None: return self._img_data[section]
+        with pyfits.open(self.imagefile, memmap=True) as f:
+            return read_plane(f[0], self._dataslice, section)
 
     def write(self, filename=None, inflate=False):
         """
@@ -465,6 +1079,7 @@ class Image(object):
             pyfits.writeto(filename, self.img_data, self.img_hdr, overwrite=True, output_verify='fix')
 
     def set_beam(self, beam):
+        self._wcs = None
         self.img_hdr['BMAJ'] = beam[0]
         self.img_hdr['BMIN'] = beam[1]
         self.img_hdr['BPA'] = beam[2]
@@ -474,6 +1089,7 @@ class Image(object):
 
     def set_freq(self, freq):
         if freq:
+            self._wcs = None # RESTFREQ is part of the WCS
             self.img_hdr['RESTFREQ'] = freq
             self.img_hdr['FREQ'] = freq
             self.freq = freq
@@ -504,7 +1120,31 @@ class Image(object):
 
 
     def get_wcs(self):
-        return pywcs(self.img_hdr)
+        """
+        Return the WCS of img_hdr. It is made once and kept until img_hdr is replaced or changed
+        by the methods of Image (after changing img_hdr in place in other ways, set self._wcs = None).
+        The returned WCS is shared, do not modify it.
+        """
+        if self._wcs is None:
+            self._wcs = pywcs(self.img_hdr)
+        return self._wcs
+
+    def get_corners(self, nonzero=False):
+        """
+        Return ra, dec (deg) of the 4 corner pixels of the image, or, if nonzero, of the smallest box that contains
+        all pixels that are not 0 (NaNs included). None if nonzero and there are no such pixels.
+        """
+        if nonzero:
+            data = self.img_data
+            rows = np.flatnonzero(np.any(data, axis=1))
+            if len(rows) == 0: return None
+            y0, y1 = rows[0], rows[-1]
+            cols = np.flatnonzero(np.any(data[y0:y1+1], axis=0))
+            x0, x1 = cols[0], cols[-1]
+        else:
+            y0, x0 = 0, 0
+            y1, x1 = self.shape[0]-1, self.shape[1]-1
+        return self.get_wcs().all_pix2world([x0, x1, x0, x1], [y0, y0, y1, y1], 0)
 
     def apply_region(self, regionfile, blankvalue=np.nan, invert=False):
         """
@@ -540,13 +1180,15 @@ class Image(object):
         nans_after = np.sum(np.isnan(self.img_data))
         logging.debug('%s: Blanked pixels %i -> %i' % (self.imagefile, nans_before, nans_after))
 
-    def calc_noise(self, niter=1000, eps=None, sigma=5, bg_reg=None, force_recalc=False):
+    def calc_noise(self, niter=1000, eps=None, sigma=5, bg_reg=None, force_recalc=False, subsample=None):
         """
         Return the rms of all the pixels in an image
         niter : robust rms estimation
         eps : convergency criterion, if None is 1% of initial rms
         bg_reg : If ds9 region file provided, use this as background region
         force_recalc : recalculate noise even if already set
+        subsample : use only this number of random pixels (faster for large images), the
+                    standard error of the rms is in self.noise_err
         """
         if not self.noise is None and force_recalc == False:
             print('WARNING: Noise already set, and force_recalc=False.')
@@ -563,42 +1205,59 @@ class Image(object):
             self.noise = np.nanstd(self.img_data[mask])
             logging.info('%s: Noise: %.3f mJy/b' % (self.imagefile, self.noise * 1e3))
         else:
-            from astropy.stats import median_absolute_deviation
             if eps == None: eps = 1e-3
             data = self.img_data[ ~np.isnan(self.img_data) & (self.img_data != 0) ] # remove nans and 0s
-            initial_len = len(data)
-            if initial_len == 0: return 0
-            mad_old = 0.
-            for i in range(niter):
-                 mad = median_absolute_deviation(data)
-                 logging.debug('%s: MAD noise: %f uJy on %f%% data' % (self.imagefile, mad*1e6, 100*len(data)/initial_len))
-                 if np.isnan(mad): break
-                 if np.abs(mad_old-mad)/mad < eps:
-                     rms = np.nanstd( data )
-                     self.noise = rms
-                     #print('%s: Noise: %.3f mJy/b' % (self.imagefile, self.noise*1e3))
-                     logging.debug('%s: Noise: %.3f mJy/b (data len: %i -> %i - %.2f%%)' % (self.imagefile, self.noise*1e3, initial_len, len(data), 100*len(data)/initial_len))
-                     return rms
-    
-                 data = data[np.abs(data) < (sigma*mad)]
-                 mad_old = mad
-            raise Exception('Noise estimation failed to converge.')
-
-
-    def convolve(self, target_beam, stokes=True):
+            if len(data) == 0: return 0
+            if subsample is not None and len(data) > subsample:
+                data = data[np.random.default_rng(0).integers(0, len(data), int(subsample))]
+            rms, n, initial_len = clipped_rms(data, niter=niter, eps=eps, sigma=sigma, logname=self.imagefile)
+            self.noise = rms
+            # standard error of the rms of n gaussian samples
+            self.noise_err = rms / np.sqrt(2*(n-1)) if n > 1 else np.inf
+            logging.debug('%s: Noise: %.3f +/- %.3f mJy/b (data len: %i -> %i - %.2f%%)' % (self.imagefile, self.noise*1e3, self.noise_err*1e3, initial_len, n, 100*n/initial_len))
+            return rms
+
+    def calc_noise_map(self, box=100, niter=1000, eps=None, sigma=5, minpix=100):
         """
-        Convolve *to* this rsolution
-        beam = [bmaj, bmin, bpa]
+        Return a map of the local rms: the rms is estimated as in calc_noise in tiles of box x box pixels and
+        interpolated (bilinear) at each pixel. Tiles with less than minpix valid pixels get the median rms of the others.
         """
-        from lib_beamdeconv import deconvolve_ell, EllipticalGaussian2DKernel
-        from astropy import convolution
+        from scipy.ndimage import map_coordinates
+        if eps == None: eps = 1e-3
+        ny, nx = self.img_data.shape
+        ys, xs = np.arange(0, ny, box), np.arange(0, nx, box)
+        rms_tiles = np.full((len(ys), len(xs)), np.nan)
+        for i, y in enumerate(ys):
+            for j, x in enumerate(xs):
+                tile = self.img_data[y:y+box, x:x+box]
+                data = tile[ ~np.isnan(tile) & (tile != 0) ]
+                if len(data) < minpix: continue
+                try:
+                    rms_tiles[i,j] = clipped_rms(data, niter=niter, eps=eps, sigma=sigma)[0]
+                except Exception:
+                    continue
+        if np.isnan(rms_tiles).all():
+            logging.warning('%s: Not enough data to make a noise map.' % self.imagefile)
+            return np.full((ny, nx), np.nan)
+        rms_tiles[np.isnan(rms_tiles)] = np.nanmedian(rms_tiles)
+        # tile centers are at (i+0.5)*box-0.5 pixels
+        yy, xx = np.mgrid[0:ny, 0:nx].astype(float)
+        coords = [(yy + 0.5)/box - 0.5, (xx + 0.5)/box - 0.5]
+        return map_coordinates(rms_tiles, coords, order=1, mode='nearest')
+
+    def kernel_pars(self, target_beam):
+        """
+        Return the parameters (stddev_maj, stddev_min in pixels, theta in rad) of the gaussian
+        to convolve this image *to* target_beam = [bmaj, bmin, bpa], None if the beam is already the same
+        """
+        from lib_beamdeconv import deconvolve_ell
 
         # if difference between beam is negligible <1%, skip - it mostly happens when beams are exactly the same
         beam = self.get_beam()
         try:
             if (np.abs((target_beam[0]/beam[0])-1) < 1e-2) and (np.abs((target_beam[1]/beam[1])-1) < 1e-2) and (np.abs(target_beam[2] - beam[2]) < 1):
                 logging.debug('%s: do not convolve. Same beam.' % self.imagefile)
-                return
+                return None
             elif (target_beam[0] < beam[0]) or target_beam[1] < beam[1]:
                 raise ValueError('%s: target beam is smaller than current beam. Cannot convolve!.' % self.imagefile)
         except ZeroDivisionError: pass  # catch case where we have delta scale beam (model image)
@@ -609,34 +1268,105 @@ class Image(object):
             sys.exit(1)
         logging.debug('%s: Convolve beam: %.3f" %.3f" (pa %.1f deg)' \
                 % (self.imagefile, convolve_beam[0]*3600, convolve_beam[1]*3600, convolve_beam[2]))
-        # do convolution on data
         bmaj, bmin, bpa = convolve_beam
         #print(self.imagefile,self.img_hdr['CDELT1'], self.img_hdr['CDELT2'])
         assert abs(self.img_hdr['CDELT1']) == abs(self.img_hdr['CDELT2'])
         pixsize = abs(self.img_hdr['CDELT1'])
         fwhm2sigma = 1./np.sqrt(8.*np.log(2.))
-        gauss_kern = EllipticalGaussian2DKernel((bmaj*fwhm2sigma)/pixsize, (bmin*fwhm2sigma)/pixsize, (90+bpa)*np.pi/180.) # bmaj and bmin are in pixels
-        self.img_data = convolution.convolve(self.img_data, gauss_kern, boundary=None, preserve_nan=True)
+        return ((bmaj*fwhm2sigma)/pixsize, (bmin*fwhm2sigma)/pixsize, (90+bpa)*np.pi/180.) # bmaj and bmin are in pixels
+
+    def convolve(self, target_beam, stokes=True, method='fft'):
+        """
+        Convolve *to* this rsolution
+        beam = [bmaj, bmin, bpa]
+        method: fft (default), analytic (FFT with the kernel computed directly in Fourier space)
+                or direct (astropy convolution in the image domain, slow for large kernels)
+        """
+        from astropy import convolution
+
+        kernel_pars = self.kernel_pars(target_beam)
+        if kernel_pars is None: return
+        beam = self.get_beam()
+        # do convolution on data
+        if method == 'direct':
+            self.img_data = convolution.convolve(self.img_data, convolution_kernel(*kernel_pars), boundary=None, preserve_nan=True)
+        else:
+            self.img_data = fft_convolve(self.img_data, *kernel_pars, analytic=(method == 'analytic'))
         if stokes: # if not stokes image (e.g. spectral index, do not renormalize)
             self.img_data *= (target_beam[0]*target_beam[1])/(beam[0]*beam[1]) # since we are in Jy/b we need to renormalise
 
         self.set_beam(target_beam) # update beam
 
-    def regrid(self, regrid_hdr):
-        """ Regrid image to new header """
-        from reproject import reproject_interp, reproject_exact
-        reproj = reproject_exact
+    def regrid(self, regrid_hdr, method='exact', cache=None, parallel=True):
+        """
+        Regrid image to new header
+        method: interp, adaptive, exact or auto (see regrid_method)
+        cache: lib_cache.diskCache where to keep the reprojection maps (interp) and results (adaptive/exact)
+        parallel: use more processes for reproject_exact
+        """
+        from reproject import reproject_adaptive, reproject_exact
+        from scipy.ndimage import map_coordinates
         # store some info so to reconstruct headers
         beam = self.get_beam()
         freq = self.get_freq()
-        logging.debug('%s: regridding' % (self.imagefile))
-        self.img_data, __footprint = reproj((self.img_data, self.img_hdr), regrid_hdr, parallel=True)
+        if method == 'auto': method = regrid_method(self.img_hdr, regrid_hdr)
+        logging.debug('%s: regridding (%s)' % (self.imagefile, method))
+        data = np.full((regrid_hdr['NAXIS2'], regrid_hdr['NAXIS1']), np.nan, dtype=float_type())
+        if method == 'interp':
+            # the map from output to input pixels depends only on the grids
+            plan = regrid_map(self.img_hdr, regrid_hdr, cache=cache)
+            if plan['bbox'] is not None:
+                y0, y1, x0, x1 = plan['bbox']
+                data[y0:y1, x0:x1] = map_coordinates(self.img_data.astype(float_type()), plan['coords'], order=1, cval=np.nan)
+        else:
+            key = None
+            if cache is not None:
+                key = cache.key('regrid', method, self.img_data, self.img_hdr, regrid_hdr)
+                cached = cache.get(key, None)
+            if key is not None and cached is not None:
+                data = cached
+            else:
+                bbox = regrid_footprint(self.img_hdr, regrid_hdr)
+                if bbox is not None:
+                    # reproject only on the part of the output grid covered by the image
+                    y0, y1, x0, x1 = bbox
+                    wcs_box = pywcs(regrid_hdr)[y0:y1, x0:x1]
+                    if method == 'exact':
+                        data[y0:y1, x0:x1] = reproject_exact((self.img_data, self.img_hdr), wcs_box, shape_out=(y1-y0, x1-x0), parallel=parallel, return_footprint=False)
+                    else:
+                        data[y0:y1, x0:x1] = reproject_adaptive((self.img_data, self.img_hdr), wcs_box, shape_out=(y1-y0, x1-x0), boundary_mode='ignore_threshold', return_footprint=False)
+                if key is not None: cache.set(key, data)
+        self.img_data = data
         # update headers
         self.img_hdr = copy.copy(regrid_hdr)
         self.set_freq(freq)
         self.set_beam(beam)
         self.get_degperpixel() # update
 
+    def get_tile(self, tile_hdr, target_beam=None, method='exact', conv_method='fft'):
+        """
+        Return the data convolved to target_beam (None: do not convolve) and regridded to tile_hdr, a part of the common grid.
+        Only the part of the image under the tile is read, with a halo of half kernel (plus a margin for the
+        reprojection) so that the result is the same of convolving and regridding the whole image.
+        The image itself is not changed.
+        """
+        bbox = regrid_footprint(tile_hdr, self.img_hdr)
+        if bbox is None:
+            return np.full((tile_hdr['NAXIS2'], tile_hdr['NAXIS1']), np.nan, dtype=float_type())
+        halo = 8
+        kernel_pars = None if target_beam is None else self.kernel_pars(target_beam)
+        if kernel_pars is not None:
+            halo += max(kernel_halfsize(*kernel_pars))
+        ny, nx = self.shape
+        box = (max(0, bbox[0]-halo), min(ny, bbox[1]+halo), max(0, bbox[2]-halo), min(nx, bbox[3]+halo))
+        tile = copy.copy(self)
+        tile.img_hdr = sub_header(self.img_hdr, box)
+        tile.img_data = np.array(self.get_data(np.s_[box[0]:box[1], box[2]:box[3]]))
+        if kernel_pars is not None:
+            tile.convolve(target_beam, method=conv_method)
+        tile.regrid(tile_hdr, method=method, parallel=False)
+        return tile.img_data
+
     def apply_shift(self, dra, ddec):
         """
         Shift header by dra/ddec
@@ -647,6 +1377,7 @@ class Image(object):
         dec = self.img_hdr['CRVAL2']
         self.img_hdr['CRVAL1'] += dra
         self.img_hdr['CRVAL2'] += ddec
+        self._wcs = None
 
     def pixel_covariance(self, pix1, pix2):
         """
@@ -685,17 +1416,12 @@ class Image(object):
         """
         Create catalogue for image alignmnt
         """
-        import bdsf
         import lsmtool as lsm
         from astropy.table import Table
 
         img_cat = self.imagefile+'.cat'
         if not os.path.exists(img_cat):
-            bdsf_img = bdsf.process_image(self.imagefile, rms_box=(100,30), \
-                                          thresh_pix=5, thresh_isl=3, atrous_do=False, \
-                                          adaptive_rms_box=True, adaptive_thresh=100, rms_box_bright=(30,10), quiet=True)
-            bdsf_img.write_catalog(outfile=img_cat, catalog_type='srl', format='fits', clobber=True)
-            bdsf_img.write_catalog(outfile=img_cat.replace('.cat', '.skymodel'), catalog_type='gaul', format='bbs', bbs_patches='source', clobber=True, srcroot='src')
+            run_bdsf(self.imagefile, img_cat)
         else:
             logging.warning('%s already exists, using it.' % img_cat)
 
@@ -704,11 +1430,12 @@ class Image(object):
         extended_src = (cat['Peak_flux'] / cat['Total_flux']) < 0.1 # ~extended source
         extended_src[cat['S_Code'] == 'M'] = True # multiple-gaussian source
         extended_src[cat['S_Code'] == 'C'] = True # one gaussian + other sources island
-        # remove same sources from skymodel
+        # remove same sources from skymodel, all at once
         cat_lsm = lsm.load(img_cat.replace('.cat', '.skymodel'))
-        # TODO this spams the logging
-        for srcid in cat[extended_src]['Source_id']:
-            cat_lsm.remove(f'Patch == src_patch_s{srcid}')
+        extended_patches = ['src_patch_s%i' % srcid for srcid in cat[extended_src]['Source_id']]
+        idx_extended = np.flatnonzero(np.isin(cat_lsm.getColValues('Patch'), extended_patches))
+        if len(idx_extended) > 0:
+            cat_lsm.remove(idx_extended)
         cat.remove_rows(np.argwhere(extended_src))
         self.cat = cat
         self.cat_lsm = cat_lsm
@@ -721,8 +1448,8 @@ class Image(object):
         -------
         degperpixel: float
         """
-        wcs = self.get_wcs()
-        self.degperpixel = np.abs(wcs.all_pix2world(0, 0, 0)[1] - wcs.all_pix2world(0, 1, 0)[1])
+        dec = self.get_wcs().all_pix2world([0, 0], [0, 1], 0)[1]
+        self.degperpixel = np.abs(dec[0] - dec[1])
         return self.degperpixel
 
     def get_degperkpc(self, z):
@@ -749,4 +1476,3 @@ class Image(object):
         pixelperkpc: float
         """
         return self.get_degperkpc(z) / self.get_degperpixel()
-
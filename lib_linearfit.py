@@ -129,46 +129,95 @@ def linear_fit_bootstrap(x, y, yerr, niter=1000, tolog=False):
     # tolog : convert in log space x, y, and yerr before doing linear regression
     # use: (a, b, sa, sb) = linear_fit_bootstrap(x, y, yerr)
 
-    from scipy import optimize
-    errfunc = lambda B, x, y: f(x, B[0], B[1]) - y
+    return linear_fit_bootstrap_batch(x, y, yerr, niter=niter, tolog=tolog)
 
-    x = np.array(x)
-    y = np.array(y)
-    if yerr is not None: yerr = np.array(yerr)
 
-    if tolog:
-        if yerr is not None: yerr = 0.434*yerr/y
-        x=np.log10(x)
-        y=np.log10(y)
+def linear_fit_bootstrap_batch(x, y, yerr, niter=1000, tolog=False, maxsize=int(1e7)):
+    """
+    Same as linear_fit_bootstrap() but for many independent datasets sharing the same x.
+    All the random realisations are drawn at once and fitted in closed form.
+    Points that are NaN (or <= 0 if tolog) are masked, datasets with less than 2 valid
+    points return NaN.
 
-    pfit, pcov, infodict, errmsg, success = optimize.leastsq( errfunc, [-1, 0], args=(x, y), full_output=1)
+    Parameters
+    ----------
+    x: (n,) array of floats
+    y: (n,) or (n,m) array of floats
+    yerr: (n,) or (n,m) array of floats or None
+    niter: number of random realisations per dataset
+    maxsize: max number of random values (niter*n*m) to keep in memory at once
 
-    # 2 vals without error, cannot estimate sigmas
-    if len(y) == 2 and yerr is None: return (pfit[0], pfit[1], 0, 0)
+    Returns
+    -------
+    B0, B1, errB0, errB1: float or (m,) arrays of floats (err are in std dev)
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if y.ndim == 1:
+        return tuple(r[0] for r in linear_fit_bootstrap_batch(x, y[:,np.newaxis], \
+                        yerr if yerr is None else np.asarray(yerr)[:,np.newaxis], niter, tolog, maxsize))
+    n, m = y.shape
+    x = np.broadcast_to(x[:,np.newaxis], y.shape)
+
+    valid = np.isfinite(y)
+    if tolog: valid &= (y > 0)
+    if yerr is not None:
+        yerr = np.asarray(yerr, dtype=float)
+        if yerr.ndim == 1: yerr = yerr[:,np.newaxis]
+        yerr = np.broadcast_to(yerr, y.shape)
+        valid &= np.isfinite(yerr)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if tolog:
+            if yerr is not None: yerr = 0.434*yerr/y
+            x = np.log10(x)
+            y = np.log10(y)
+        w = valid.astype(float)
+        x = np.where(valid, x, 0.)
+        y = np.where(valid, y, 0.)
+        npoints = np.sum(valid, axis=0)
+
+        # the random variation is the given error or the std of the residuals of the best fit
+        if yerr is None:
+            B0, B1, D = _linear_lsq(x, y, w)
+            sigma = np.sqrt(np.sum(w*(y - B0*x - B1)**2, axis=0)/npoints)
+            sigma = np.broadcast_to(sigma, y.shape)
+        else:
+            sigma = np.where(valid, yerr, 0.)
 
-    residuals = errfunc( pfit, x, y )
-    s_res = np.std(residuals)
-    ps = []
-    # TODO: remove cycle and use only array shapes
-    # n random data sets are generated and fitted
-    for i in range(niter):
-      if yerr is None:
-          randomDelta = np.random.normal(0., s_res, len(y))
-          randomdataY = y + randomDelta
-      else:
-          randomDelta = np.array( [ np.random.normal(0., derr, 1)[0] for derr in yerr ] ) 
-          randomdataY = y + randomDelta
-      randomfit, randomcov = optimize.leastsq( errfunc, [-1, 0], args=(x, randomdataY), full_output=0)
-      ps.append( randomfit ) 
+        Nsigma = 1. # 1sigma gets approximately the same as methods above
+                    # 1sigma corresponds to 68.3% confidence interval
+                    # 2sigma corresponds to 95.44% confidence interval
+        B0, B1, errB0, errB1 = [np.empty(m) for i in range(4)]
+        step = max(1, maxsize//(niter*n))
+        for i in range(0, m, step):
+            c = slice(i, i+step)
+            randomdataY = y[:,c] + sigma[:,c]*np.random.normal(0., 1., size=(niter,n,y[:,c].shape[1]))
+            randomB0, randomB1, D = _linear_lsq(x[np.newaxis,:,c], randomdataY, w[np.newaxis,:,c], axis=1)
+            B0[c], B1[c] = np.mean(randomB0, axis=0), np.mean(randomB1, axis=0)
+            errB0[c], errB1[c] = Nsigma*np.std(randomB0, axis=0), Nsigma*np.std(randomB1, axis=0)
 
-    ps = np.array(ps)
-    mean_pfit = np.mean(ps,0)
-    Nsigma = 1. # 1sigma gets approximately the same as methods above
-                # 1sigma corresponds to 68.3% confidence interval
-                # 2sigma corresponds to 95.44% confidence interval
-    err_pfit = Nsigma * np.std(ps,0) 
+    bad = (npoints < 2) | np.isnan(B0)
+    for B in (B0, B1, errB0, errB1):
+        B[bad] = np.nan
 
-    return (mean_pfit[0], mean_pfit[1], err_pfit[0], err_pfit[1])
+    return (B0, B1, errB0, errB1)
+
+
+def _linear_lsq(x, y, w, axis=0):
+    """
+    Closed-form weighted least squares of y = B0*x + B1 along the given axis
+    Returns B0, B1 and the determinant of the normal equations
+    """
+    S = np.sum(w, axis=axis)
+    Sx = np.sum(w*x, axis=axis)
+    Sy = np.sum(w*y, axis=axis)
+    Sxx = np.sum(w*x*x, axis=axis)
+    Sxy = np.sum(w*x*y, axis=axis)
+    D = S*Sxx - Sx**2
+    B0 = (S*Sxy - Sx*Sy)/D
+    B1 = (Sxx*Sy - Sx*Sxy)/D
+    return B0, B1, D
 
 
 # extimate errors and accept errors on ydata
@@ -196,6 +245,77 @@ def linear_fit(x, y, yerr=None, tolog=False):
         return (out[0][0], out[0][1], 0, 0)
 
 
+def linear_fit_batch(x, y, yerr=None, tolog=False, maxsize=int(1e7)):
+    """
+    Weighted least squares (X|Y) for many independent datasets sharing the same x.
+    Same results of linear_fit() (errors scaled by the reduced chi^2) but in closed form,
+    so that e.g. all pixels of a spectral index map are fitted in one go.
+    Points that are NaN (or <= 0 if tolog) are masked, datasets with less than 2 valid
+    points return NaN.
+
+    Parameters
+    ----------
+    x: (n,) array of floats
+    y: (n,) or (n,m) array of floats
+    yerr: (n,) or (n,m) array of floats, optional
+    maxsize: max number of values (n*m) of the temporary arrays, larger y are fitted in chunks of datasets
+
+    Returns
+    -------
+    B0, B1, errB0, errB1: float or (m,) arrays of floats (err are in std dev)
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if y.ndim == 1:
+        return tuple(r[0] for r in linear_fit_batch(x, y[:,np.newaxis], \
+                        yerr if yerr is None else np.asarray(yerr)[:,np.newaxis], tolog, maxsize))
+    n, m = y.shape
+    step = max(1, maxsize//n)
+    if m > step:
+        if yerr is not None:
+            yerr = np.asarray(yerr, dtype=float)
+            if yerr.ndim == 1: yerr = yerr[:,np.newaxis]
+            yerr = np.broadcast_to(yerr, y.shape)
+        fits = [linear_fit_batch(x, y[:,i:i+step], None if yerr is None else yerr[:,i:i+step], tolog, maxsize) \
+                for i in range(0, m, step)]
+        return tuple(np.concatenate(r) for r in zip(*fits))
+    x = np.broadcast_to(x[:,np.newaxis], y.shape)
+
+    valid = np.isfinite(y)
+    if tolog: valid &= (y > 0)
+    if yerr is not None:
+        yerr = np.asarray(yerr, dtype=float)
+        if yerr.ndim == 1: yerr = yerr[:,np.newaxis]
+        yerr = np.broadcast_to(yerr, y.shape)
+        valid &= np.isfinite(yerr) & (yerr > 0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if tolog:
+            if yerr is not None: yerr = 0.434*yerr/y
+            x = np.log10(x)
+            y = np.log10(y)
+        if yerr is None: w = valid.astype(float)
+        else: w = np.where(valid, 1./yerr**2, 0.)
+        x = np.where(valid, x, 0.)
+        y = np.where(valid, y, 0.)
+
+        B0, B1, D = _linear_lsq(x, y, w)
+
+        # as curve_fit with absolute_sigma=False: rescale covariance by the reduced chi^2
+        npoints = np.sum(valid, axis=0)
+        dof = npoints - 2
+        chi2 = np.sum(w*(y - B0*x - B1)**2, axis=0)
+        redchi2 = np.where(dof > 0, chi2/dof, np.inf)
+        errB0 = np.sqrt(np.sum(w, axis=0)/D*redchi2)
+        errB1 = np.sqrt(np.sum(w*x*x, axis=0)/D*redchi2)
+
+    bad = (npoints < 2) | (D == 0)
+    for B in (B0, B1, errB0, errB1):
+        B[bad] = np.nan
+
+    return (B0, B1, errB0, errB1)
+
+
 # extimate errors and accept errors on x and y-data
 def linear_fit_odr(x, y, xerr=None, yerr=None, tolog=False):
     from scipy import odr
@@ -20,6 +20,18 @@
 
 # Parallelizator
 # USAGE:
+# from lib_multiproc import multiprocPool, sharedArray
+# def funct(funct_param, big_array):
+#     return funct_output
+#
+# # start processes for multi-thread, the same workers can be used for many calls
+# with multiprocPool(ncpu, funct) as pool:
+#     big_array = sharedArray(big_array) # workers get a view of the same memory, no pickling
+#     for r in pool.imap([[funct_params, big_array[i]] for i in ...], ordered=False, chunksize=8):
+#         print("funct_output:", r)
+#     big_array.close()
+#
+# Old interface (still working):
 # from lib_multiproc import multiprocManager
 # def funct(funct_param, outQueue=None):
 #     pass
@@ -32,81 +44,280 @@
 # for r in mpm.get():
 #     print "funct_output:", r
 
-import sys
+import os, sys, atexit
 import logging
+import tempfile
 import multiprocessing
+import numpy as np
 
+# worker-side state, set by the pool initializer
+_worker_funct = None
+
+
+def _init_worker(funct):
+    global _worker_funct
+    _worker_funct = funct
+
+
+# scratch files of sharedArray that cannot be removed at creation, see sharedArray
+_scratch_files = set()
+
+@atexit.register
+def _remove_scratch_files():
+    for filename in list(_scratch_files):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+
+def _attach_shared(filename, shape, dtype, key):
+    """
+    Called when a sharedArray is unpickled in a worker: return a view of the shared memory
+    The mapping is released as soon as the view is not used anymore
+    """
+    array = np.memmap(filename, dtype=np.dtype(dtype), mode='r+', shape=shape)
+    if key is None: return array
+    return array[key]
+
+
+def _call(funct, args):
+    if funct is None: funct = _worker_funct
+    return funct(*args)
+
+
+def _call_task(task):
+    return _call(*task)
 
-class multiprocManager(object):
 
-    class multiThread(multiprocessing.Process):
+class _listQueue(list):
+    """
+    Collect what the function puts in the outQueue of the old interface
+    """
+    def put(self, item):
+        self.append(item)
+
+
+def _call_queue(funct, args):
+    if funct is None: funct = _worker_funct
+    outQueue = _listQueue()
+    funct(*args, outQueue=outQueue)
+    return outQueue
+
+
+class sharedArray(object):
+    """
+    Numpy array stored in a memory-mapped scratch file (in /dev/shm if available, i.e. in RAM).
+    When passed to the workers of a multiprocPool only a handle is pickled
+    and the worker receives a numpy array using the same memory (changes are seen by everyone).
+    Index it (e.g. sa[:,3]) to pass to the workers only a view of the array.
+    Use .array in the main process and call close() when done.
+    On Linux the scratch file is removed as soon as it is made and the workers open it through
+    /proc/<pid>/fd of the creator, so nothing is left behind even if the run is killed.
+    Elsewhere it is removed by close() or at exit.
+    """
+
+    class sharedView(object):
+
+        def __init__(self, parent, key):
+            self.parent = parent
+            self.key = key
+
+        def __reduce__(self):
+            p = self.parent
+            return (_attach_shared, (p.filename, p.shape, p.dtype.str, self.key))
+
+    def __init__(self, array=None, shape=None, dtype=float, tmpdir=None):
         """
-        This class is a working thread which load parameters from a queue and
-        return in the output queue
+        array: numpy array to copy in shared memory
+        shape, dtype: if array is not given, create an empty (zeros) array
+        tmpdir: where to put the scratch file (default: /dev/shm if there is room for the array, else the system tmp dir)
         """
+        if array is not None:
+            array = np.asarray(array)
+            shape, dtype = array.shape, array.dtype
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        if tmpdir is None:
+            tmpdir = tempfile.gettempdir()
+            if os.access('/dev/shm', os.W_OK):
+                st = os.statvfs('/dev/shm')
+                if st.f_bavail*st.f_frsize >= int(np.prod(self.shape))*self.dtype.itemsize: tmpdir = '/dev/shm'
+                else: logging.debug('Not enough space in /dev/shm for a shared array, using %s.' % tmpdir)
+        self.pid = os.getpid() # only the creator removes the file
+        fd, filename = tempfile.mkstemp(prefix='sharedArray_', suffix='.dat', dir=tmpdir)
+        self.array = np.memmap(filename, dtype=self.dtype, mode='w+', shape=self.shape)
+        if os.path.isdir('/proc/self/fd'):
+            # keep only the open file: the memory is freed when the creator closes it and no one maps it anymore
+            os.remove(filename)
+            self.fd = fd
+            self.filename = '/proc/%i/fd/%i' % (self.pid, fd)
+        else:
+            os.close(fd)
+            self.fd = None
+            self.filename = filename
+            _scratch_files.add(filename)
+        if array is not None: self.array[...] = array
+
+    def __getitem__(self, key):
+        return self.sharedView(self, key)
+
+    def __reduce__(self):
+        return (_attach_shared, (self.filename, self.shape, self.dtype.str, None))
 
-        def __init__(self, inQueue, outQueue, funct):
-            multiprocessing.Process.__init__(self)
-            self.inQueue = inQueue
-            self.outQueue = outQueue
-            self.funct = funct
+    def __enter__(self):
+        return self
 
-        def run(self):
+    def __exit__(self, exit_type, value, tb):
+        self.close()
 
-            while True:
-                parms = self.inQueue.get()
+    def __del__(self):
+        self.close()
 
-                # poison pill
-                if parms is None:
-                    self.inQueue.task_done()
-                    break
+    def close(self):
+        """
+        Remove the scratch file, the memory is freed once no process is using the array anymore
+        """
+        if getattr(self, 'filename', None) is None or self.pid != os.getpid(): return
+        del self.array
+        if self.fd is not None:
+            os.close(self.fd)
+        else:
+            os.remove(self.filename)
+            _scratch_files.discard(self.filename)
+        self.filename = None
 
-                self.funct(*parms, outQueue=self.outQueue)
-                self.inQueue.task_done()
 
+class multiprocPool(object):
+    """
+    Pool of workers which can be re-used for many calls.
+    Arguments are sent in batches (chunksize), large arrays should be passed as sharedArray.
+    """
 
     def __init__(self, procs=1, funct=None):
+        """
+        procs: number of processors
+        funct: default function to run in the workers, it is inherited by the workers
+        so it does not need to be pickable (on systems with fork)
+        """
+        self.procs = procs
+        if 'fork' in multiprocessing.get_all_start_methods():
+            ctx = multiprocessing.get_context('fork')
+        else:
+            ctx = multiprocessing.get_context()
+        logging.debug('Spawning %i processes...' % self.procs)
+        self.pool = ctx.Pool(self.procs, initializer=_init_worker, initargs=(funct,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exit_type, value, tb):
+        if exit_type is None: self.close()
+        else: self.terminate()
+
+    def submit(self, args, funct=None):
+        """
+        Run funct(*args) (default funct if None) in a worker.
+        Return an AsyncResult, use .get() to retrieve the output
+        """
+        return self.pool.apply_async(_call, (funct, args))
+
+    def imap(self, args_list, funct=None, ordered=True, chunksize=1):
+        """
+        Run funct(*args) for all args in args_list (default funct if None).
+        Return an iterator on the outputs, in the same order of args_list if ordered
+        else as soon as they are ready.
+        chunksize: number of tasks sent at once to each worker
+        """
+        tasks = ((funct, args) for args in args_list)
+        if ordered:
+            return self.pool.imap(_call_task, tasks, chunksize)
+        else:
+            return self.pool.imap_unordered(_call_task, tasks, chunksize)
+
+    def map(self, args_list, funct=None, chunksize=1):
+        """
+        As imap, but return the list of all (ordered) outputs
+        """
+        return list(self.imap(args_list, funct=funct, ordered=True, chunksize=chunksize))
+
+    def cpu_time(self):
+        """
+        Total cpu time (s) used so far by the workers, from /proc (0 where not available)
+        """
+        ticks = os.sysconf('SC_CLK_TCK')
+        total = 0.
+        for proc in self.pool._pool:
+            try:
+                with open('/proc/%i/stat' % proc.pid) as f:
+                    # fields after the command name (that can contain spaces): utime and stime are the 12th and 13th
+                    fields = f.read().rsplit(')', 1)[1].split()
+                total += (int(fields[11]) + int(fields[12])) / ticks
+            except (OSError, IndexError, ValueError):
+                pass
+        return total
+
+    def close(self):
+        """
+        Wait for all tasks to finish and stop the workers
+        """
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+class multiprocManager(object):
+    """
+    Old interface, now running on a multiprocPool
+    """
+
+    def __init__(self, procs=1, funct=None, pool=None):
         """
         Manager for multiprocessing
         procs: number of processors
         funct: function to parallelize / note that the last parameter of this function must be the outQueue
         and it will be linked to the output queue
+        pool: optional multiprocPool to use instead of spawning new processes,
+        in this case funct must be pickable
         """
         self.procs = procs
-        self._threads = []
-        self.inQueue = multiprocessing.JoinableQueue()
-        self.outQueue = multiprocessing.Queue()
         self.runs = 0
-        
-        logging.debug('Spawning %i threads...' % self.procs)
-        for proc in range(self.procs):
-            t = self.multiThread(self.inQueue, self.outQueue, funct)
-            self._threads.append(t)
-            t.start()
+        self._results = []
+        if pool is None:
+            self._pool = multiprocPool(procs, funct)
+            self._funct = None # default funct of the pool
+            self._ownpool = True
+        else:
+            self._pool = pool
+            self._funct = funct
+            self._ownpool = False
 
     def put(self, args):
         """
         Parameters to give to the next jobs sent into queue
         """
-        self.inQueue.put(args)
+        self._results.append(self._pool.pool.apply_async(_call_queue, (self._funct, args)))
         self.runs += 1
 
     def get(self):
         """
         Return all the results as an iterator
         """
-        # NOTE: do not use queue.empty() check which is unreliable
-        # https://docs.python.org/2/library/multiprocessing.html
-        for run in range(self.runs):
-            yield self.outQueue.get()
+        for result in self._results:
+            for r in result.get():
+                yield r
+        self._results = []
+        self.runs = 0
 
     def wait(self):
         """
-        Send poison pills to jobs and wait for them to finish
-        The join() should kill all the processes
+        Wait for all jobs to finish
+        If the pool was created by this manager, stop the processes
         """
-        for t in self._threads:
-            self.inQueue.put(None)
-
-        # wait for all jobs to finish
-        self.inQueue.join()
+        for result in self._results:
+            result.wait()
+        if self._ownpool:
+            self._pool.close()
@@ -18,29 +18,222 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
 
-import time, logging
+# use:
+#
+# from lib_timer import Timer, timed, report
+# with Timer('read'):
+#     with Timer('header'):  # spans can be nested, this is "read/header"
+#         ...
+#
+# @timed('fit')  # time all calls of a function
+# def fit(...):
+#     ...
+#
+# with Timer('regrid', profile=True, trace_memory=True): # opt-in cProfile/tracemalloc for this span
+#     ...
+#
+# timer = Timer('write').start() # or without a with block
+# ...
+# timer.stop()
+#
+# report('timing.json') # or .csv, one line per span and a summary per span name
+
+import os, io, sys, time, json, csv, logging, resource, threading
+from functools import wraps
+
+# spans completed in this run and options for all spans
+_spans = []
+_local = threading.local()
+_options = {'profile':False, 'trace_memory':False}
+
+def configure(profile=None, trace_memory=None):
+    """
+    Enable cProfile/tracemalloc capture for all spans.
+    """
+    if profile is not None: _options['profile'] = profile
+    if trace_memory is not None: _options['trace_memory'] = trace_memory
+
+def _stack():
+    if not hasattr(_local, 'stack'): _local.stack = []
+    return _local.stack
+
+def _maxrss():
+    """ High-water mark of the resident memory of the process (since it started) in MB """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024.**2 if sys.platform == 'darwin' else rss / 1024.
+
+def _rss():
+    """ Current resident memory of the process in MB (None if /proc is not available) """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024.**2
+    except (OSError, ValueError):
+        return None
 
 class Timer(object):
     """
     context manager used to time the operations
+    Each Timer is a span: wall time, cpu time and memory are recorded and collected in a per-run report
+    (see report()). Timers inside another Timer are nested spans.
+    Memory is the high-water mark of the process RSS when the span ends (maxrss), the current RSS when it ends (rss)
+    and its change during the span (rss_change, Linux only), the peak of the span itself is known only with
+    trace_memory (tracemalloc_peak, python allocations).
+    With profile, a span inside a profiled span is part of the profile of the outer one (one profiler at a time).
+    It can also be used as decorator.
     """
 
-    def __init__(self, step = 'undefined', log = None):
+    def __init__(self, step = 'undefined', log = None, profile = None, trace_memory = None):
         """
         log: is a logging istance to print the correct log format
         if nothing is passed, root is used
+        profile: run cProfile during the span (default: see configure())
+        trace_memory: trace python allocations with tracemalloc during the span (default: see configure())
         """
         if log is None: self.log = logging
         else: self.log = log
         self.step = step
+        self.profile = profile
+        self.trace_memory = trace_memory
 
     def __enter__(self):
+        stack = _stack()
+        self.path = '/'.join([t.step for t in stack] + [self.step])
+        stack.append(self)
+        self.record = {'name':self.path, 'step':self.step, 'depth':len(stack)-1}
         self.log.debug("--> Starting \'" + self.step + "\'.")
-        self.start = time.time()
-        self.startcpu = time.clock()
+        self.profiler = None
+        self.profiled_in = None
+        if self.profile or (self.profile is None and _options['profile']):
+            outer = [t for t in stack[:-1] if getattr(t, 'profiler', None) is not None]
+            if outer:
+                # only one profiler can be active: this span is profiled by the outer one
+                self.profiled_in = outer[-1].path
+            else:
+                import cProfile
+                self.profiler = cProfile.Profile()
+        self.tracing = False
+        if self.trace_memory or (self.trace_memory is None and _options['trace_memory']):
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.tracing = True
+            # the peak is global: keep it for the enclosing spans before resetting it
+            for t in stack[:-1]:
+                if hasattr(t, 'snapshot'): t.peak = max(t.peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self.peak = 0
+            self.snapshot = tracemalloc.take_snapshot()
+        self.startrss = _rss()
+        self.starttime = time.time()
+        self.startcpu = time.process_time()
+        self.othercpu = 0.
+        if self.profiler is not None:
+            try:
+                self.profiler.enable()
+            except ValueError: # another profiler is active (python >= 3.12)
+                self.log.warning('Cannot profile %s: another profiler is active.' % self.path)
+                self.profiler = None
+        return self
 
     def __exit__(self, exit_type, value, tb):
+        if self.profiler is not None: self.profiler.disable()
+        rec = self.record
+        rec['start'] = self.starttime
+        rec['wall'] = time.time() - self.starttime
+        rec['cpu'] = time.process_time() - self.startcpu + self.othercpu
+        rec['cpu_other'] = self.othercpu
+        rec['maxrss'] = _maxrss() # MB, process high-water mark
+        rec['rss'] = _rss() # MB, at the end of the span
+        rec['rss_change'] = None if rec['rss'] is None or self.startrss is None else rec['rss'] - self.startrss
+        rec['error'] = exit_type is not None
+        if self.profiler is not None:
+            import pstats
+            out = io.StringIO()
+            pstats.Stats(self.profiler, stream=out).sort_stats('cumulative').print_stats(15)
+            rec['profile'] = out.getvalue()
+            self.log.debug("Profile of %s:\n%s" % (self.path, rec['profile']))
+        elif self.profiled_in is not None:
+            rec['profiled_in'] = self.profiled_in
+        if hasattr(self, 'snapshot'):
+            import tracemalloc
+            rec['tracemalloc_peak'] = max(self.peak, tracemalloc.get_traced_memory()[1]) / 1024.**2 # MB
+            stats = tracemalloc.take_snapshot().compare_to(self.snapshot, 'lineno')[:10]
+            rec['tracemalloc_top'] = [str(stat) for stat in stats]
+            del self.snapshot
+            if self.tracing: tracemalloc.stop()
+        stack = _stack()
+        if stack and stack[-1] is self: stack.pop()
+        _spans.append(rec)
 
         # if not an error
         if exit_type is None:
-            self.log.debug("<-- Time for %s step: %i s (cpu: %i s)." % ( self.step, ( time.time() - self.start), (time.clock() - self.startcpu) ))
+            self.log.debug("<-- Time for %s step: %i s (cpu: %i s, process max mem: %i MB)." % ( self.step, rec['wall'], rec['cpu'], rec['maxrss'] ))
+
+    def add_cpu(self, seconds):
+        """
+        Add cpu time used for this span by other processes (e.g. the workers of a pool), call it before the span ends.
+        """
+        self.othercpu += seconds
+
+    def start(self):
+        """
+        Start the span without a with block (call stop() to end it).
+        """
+        return self.__enter__()
+
+    def stop(self):
+        self.__exit__(None, None, None)
+
+    def __call__(self, fn):
+        @wraps(fn)
+        def timedfn(*args, **kwargs):
+            with Timer(self.step, self.log, self.profile, self.trace_memory):
+                return fn(*args, **kwargs)
+        return timedfn
+
+def timed(step = None, **kwargs):
+    """
+    Decorator to time all calls of a function, the span name is the function name if not given.
+    """
+    if callable(step): # used as @timed
+        return Timer(step.__name__)(step)
+    def decorator(fn):
+        return Timer(step or fn.__name__, **kwargs)(fn)
+    return decorator
+
+def spans():
+    return list(_spans)
+
+def reset():
+    del _spans[:]
+
+def summary():
+    """
+    Aggregate spans by name: number of calls, total wall/cpu time and process max memory.
+    """
+    summ = {}
+    for rec in _spans:
+        s = summ.setdefault(rec['name'], {'name':rec['name'], 'calls':0, 'wall':0., 'cpu':0., 'maxrss':0.})
+        s['calls'] += 1
+        s['wall'] += rec['wall']
+        s['cpu'] += rec['cpu']
+        s['maxrss'] = max(s['maxrss'], rec['maxrss'])
+    return sorted(summ.values(), key=lambda s: s['name'])
+
+def report(filename, log = None):
+    """
+    Write the spans of this run in a JSON (.json) or CSV (any other extension) file.
+    The CSV has the summary per span name, the JSON both the summary and all spans.
+    """
+    if log is None: log = logging
+    summ = summary()
+    if os.path.splitext(filename)[1] == '.json':
+        with open(filename, 'w') as f:
+            json.dump({'argv':sys.argv, 'pid':os.getpid(), 'summary':summ, 'spans':_spans}, f, indent=1)
+    else:
+        with open(filename, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['name', 'calls', 'wall', 'cpu', 'maxrss'])
+            writer.writeheader()
+            writer.writerows(summ)
+    for s in summ:
+        log.info("Timing %s: %i calls, %.1f s (cpu: %.1f s, process max mem: %i MB)." % (s['name'], s['calls'], s['wall'], s['cpu'], s['maxrss']))
@@ -19,12 +19,16 @@
 
 # Mosaic images
 
-import os.path, sys, pickle, glob, argparse, re, logging
+import os.path, sys, pickle, glob, argparse, re, logging, tempfile, json
 import numpy as np
-from lib_fits import flatten, Image
+from lib_fits import flatten, flatten_header, Image, get_catalogue_index, match_catalogues, isolation, angular_sep, set_precision, float_type, regrid_footprint, sub_header, create_fits
+from lib_cache import diskCache, hash_args, default_cachedir
+import lib_timer
+from lib_timer import Timer
 from astropy.io import fits as pyfits
 from astropy.wcs import WCS as pywcs
 from astropy.table import Table
+import astropy.units as u
 import pyregion
 # https://github.com/astrofrog/reproject
 from reproject import reproject_interp, reproject_exact
@@ -36,7 +40,8 @@ parser = argparse.ArgumentParser(description='Mosaic for LiLF dd-pipeline.')
 parser.add_argument('--images', dest='images', nargs='+', help='List of images to combine')
 parser.add_argument('--regions', dest='regions', nargs='+', help='List of regions to blank images')
 parser.add_argument('--mask', dest='mask', help='One mask with a number per direction, numbers must be in the same order of those given in the "images" parameter.')
-parser.add_argument('--beams', dest='beams', nargs='+', help='List of beams')
+parser.add_argument('--beams', dest='beams', nargs='+', help='List of beams: fits files or analytic beams "gauss:FWHM[:FREQ]" (FWHM in deg at the phase centre, scaled with the image frequency if FREQ in Hz is given)')
+parser.add_argument('--beamcache', dest='beamcache', help='Directory to cache beams regridded on the image grids, shared by all images with the same beam and grid, e.g. %s (default: no cache)' % os.path.join(default_cachedir, 'beams'))
 parser.add_argument('--beamcut', dest='beamcut', type=float, default=0.3, help='Beam level to cut at (default: 0.3, use 0.0 to deactivate)')
 parser.add_argument('--beamcorr', dest='beamcorr', action='store_true', help='Pre-correct for beam before combining (default: do not apply)')
 parser.add_argument('--beamarm', dest='beamarm', action='store_true', help='Convolve all images to minimum common beam (default: False)')
@@ -45,72 +50,110 @@ parser.add_argument('--header', dest='header', help='An image/header to use for
 parser.add_argument('--noises', dest='noises', type=float, nargs='+', help='UNSCALED Central noise level for weighting: must match numbers of maps')
 parser.add_argument('--scales', dest='scales', type=float, nargs='+', help='Scale factors by which maps should be multiplied: must match numbers of maps')
 parser.add_argument('--shift', dest='shift', action='store_true', help='Shift images before mosaicing')
+parser.add_argument('--catcache', dest='catcache', help='Directory to keep the index of the reference catalogue used by --shift, so it is built only once, e.g. %s (default: rebuild it in every run)' % os.path.join(default_cachedir, 'catalogues'))
 parser.add_argument('--find_noise', dest='find_noise', action='store_true', help='Find noise from image (default: assume equal weights, ignored if noises are given)')
 parser.add_argument('--use_channel', dest='use_channel', type=int, default=0, help='Channel to be used in a cube image (default: 0)')
 parser.add_argument('--use_stokes', dest='use_stokes', type=int, default=0, help='Stokes to be used in a cube image (default: 0)')
 parser.add_argument('--save', dest='save', action='store_true', help='Save intermediate results (default: False)')
+parser.add_argument('--store', dest='store', help='Directory where to keep the reprojected contribution of each image, so that the mosaic is updated incrementally: only new or changed images (or options) are reprojected and images no longer given are subtracted. Requires --header (default: do not keep)')
+parser.add_argument('--storemaxsize', dest='storemaxsize', default=100, type=float, help='Max size of the contributions kept in --store in GB, the least recently used are removed (default: 100)')
+parser.add_argument('--storemaxage', dest='storemaxage', default=90, type=float, help='Remove contributions in --store not used for this number of days (default: 90)')
+parser.add_argument('--ncpu', dest='ncpu', default=1, type=int, help='Number of directions to reproject at the same time (default: 1)')
+parser.add_argument('--precision', dest='precision', default='double', choices=['single','double'], help='Precision of images, weights and reprojections, single halves memory and writes a 32-bit mosaic, sums are always in double (default: double)')
 parser.add_argument('--output', dest='output', default='mosaic.fits', help='Name of output mosaic (default: mosaic.fits)')
-
-args = parser.parse_args()
-logging.root.setLevel(logging.DEBUG)
-
-#######################################################
-# input check
-
-if args.scales is not None:
-    if len(args.scales) != len(args.images):
-        logging.error('Scales provided must match images.')
-        sys.exit(1)
-
-if args.noises is not None:
-    if len(args.noises) != len(args.imagess):
-        logging.error('Noises provided must match images.')
-        sys.exit(1)
-
-if args.beamcirc and not args.beamarm:
-        logging.error('--beamcirc requires --beamarm.')
-        sys.exit(1)
-
-if args.images is None or len(args.images) < 2:
-    logging.error('Requires at lest 2 images.')
-    sys.exit(1)
-
-if args.mask is not None:
-    logging.debug('Reading mask: %s.' % args.mask)
-    mask_n = pyfits.open(args.mask)[0]
-
-if args.shift and not args.beamcorr:
-    logging.warning('Attempting shift calculation on beam corrected images, this is not the best.')
+parser.add_argument('--timing', dest='timing', help='Write a timing report of the main steps in this file (.json or .csv)')
+parser.add_argument('--profile', dest='profile', action='store_true', help='Profile (cProfile and tracemalloc) the main steps, slow (default: False)')
+
+def get_options(**kwargs):
+    """
+    Options for make_mosaic: the defaults of the command line updated with kwargs (same names as the parser dest)
+    """
+    options = parser.parse_args([])
+    for key, value in kwargs.items():
+        if not hasattr(options, key):
+            raise ValueError('Unknown mosaic option: %s.' % key)
+        setattr(options, key, value)
+    return options
+
+def check_options(options, nimages, header=None):
+    """
+    Raise ValueError if options are not consistent (nimages: number of images to combine, header: output header if given)
+    """
+    if nimages < 2:
+        raise ValueError('Requires at lest 2 images.')
+    for name in ['beams', 'regions', 'scales', 'noises']:
+        if getattr(options, name) is not None and len(getattr(options, name)) != nimages:
+            raise ValueError('%s provided must match images.' % name.capitalize())
+    if options.beamcirc and not options.beamarm:
+        raise ValueError('--beamcirc requires --beamarm.')
+    if options.store is not None and header is None:
+        raise ValueError('--store requires --header.')
 
 #############################################################
 
+def analytic_beam(model, wcs, shape, freq=None):
+    """
+    Evaluate an analytic primary beam on an image grid: "gauss:FWHM[:FREQ]" is a gaussian of FWHM (deg)
+    centred on the reference pixel (phase centre), with FWHM*FREQ/freq if the reference FREQ (Hz) is given.
+    """
+    pars = model.split(':')
+    if pars[0] != 'gauss' or len(pars) not in [2,3]:
+        raise ValueError('Unknown analytic beam: %s.' % model)
+    fwhm = float(pars[1])
+    if len(pars) == 3:
+        if freq is None: raise ValueError('Analytic beam %s needs the image frequency.' % model)
+        fwhm *= float(pars[2])/freq
+    ra, dec = wcs.all_pix2world(*np.meshgrid(np.arange(shape[1]), np.arange(shape[0])), 0)
+    dist = angular_sep(wcs.wcs.crval[0], wcs.wcs.crval[1], ra, dec)
+    return np.exp(-4*np.log(2) * dist**2 / fwhm**2)
+
 class Direction(Image):
 
-    def __init__(self, imagefile, channel=0, stokes=0):
+    def __init__(self, imagefile, channel=0, stokes=0, lazy=False):
         logging.debug('Create direction for %s' % imagefile)
-        Image.__init__(self, imagefile, channel, stokes)
+        Image.__init__(self, imagefile, channel, stokes, lazy=lazy)
         self.scale = 1.
         self.shift = 0.
         self.beamfile = None
         self.noise = 1.
         self.imagefile = imagefile
+        self.channel = channel
+        self.stokes = stokes
+        self.prepared = None # key of the options used in make_mosaic
+        self.native_beam = self.get_beam() # before any convolution
 
-    def set_beam_file(self, beamfile):
+    def set_beam_file(self, beamfile, cache=None):
+        """
+        Set the primary beam from a fits file, regridded on the image grid if needed, or from an analytic model
+        (see analytic_beam). cache: diskCache of the regridded beams, keyed on the beam file and the image grid.
+        """
+        if beamfile.startswith('gauss:'):
+            self.beamfile = beamfile
+            self.beam_hdr, self.beam_data = self.img_hdr, analytic_beam(beamfile, self.get_wcs().celestial, self.img_data.shape, self.get_freq())
+            logging.debug('%s: set analytic beam %s' % (self.imagefile, beamfile))
+            return
         if not os.path.exists(beamfile):
             logging.error('Beam file %s not found.' % beamfile)
             sys.exit(1)
         self.beamfile = beamfile
-        self.beam_hdr, self.beam_data = flatten(self.beamfile)
-        if self.beam_data.shape != self.img_data.shape:
-            beamfile = self.imagefile+'__beam.fits'
-            logging.warning('Beam and image shape are different, regrid beam...')
-            if not os.path.exists(beamfile):
-                beam_data, footprint = reproj((self.beam_data, self.beam_hdr), self.img_hdr,
-                                            order='bilinear')  # , parallel=True)
-                # save temp regridded beam
-                pyfits.writeto(beamfile, header=self.img_hdr, data=beam_data, overwrite=True)
-            self.beamfile = beamfile
+        beam_hdr, _ = flatten_header(pyfits.getheader(beamfile))
+        if (beam_hdr['NAXIS2'], beam_hdr['NAXIS1']) == self.img_data.shape:
             self.beam_hdr, self.beam_data = flatten(self.beamfile)
+        else:
+            # the same beam on the same grid is the same whatever the channel/pointing it is used for
+            wcs = self.get_wcs().celestial
+            key = hash_args(os.path.abspath(beamfile), list(wcs.wcs.ctype), wcs.wcs.crval, wcs.wcs.crpix, \
+                            wcs.wcs.cdelt, wcs.wcs.get_pc(), self.img_data.shape)
+            beam_data = None if cache is None else cache.get(key, None)
+            if beam_data is None:
+                logging.warning('Beam and image shape are different, regrid beam...')
+                beam_hdr, beam_data = flatten(self.beamfile)
+                beam_data, footprint = reproj((beam_data, beam_hdr), self.img_hdr,
+                                              order='bilinear')  # , parallel=True)
+                if cache is not None: cache.set(key, beam_data)
+            else:
+                logging.debug('%s: regridded beam from cache.' % self.imagefile)
+            self.beam_hdr, self.beam_data = self.img_hdr, beam_data
         logging.debug('%s: set beam file %s' % (self.imagefile, beamfile))
 
     def apply_beam_cut(self, beamcut=0.3):
@@ -132,16 +175,12 @@ class Direction(Image):
         # https://en.wikipedia.org/wiki/Inverse-variance_weighting
         self.weight_data = self.weight_data**2.0
 
-    def calc_shift(self, ref_cat, separation=15):
+    def calc_shift(self, ref_cat, separation=15, cachedir=None):
         """
         Find a shift cross-matching source extracted from the image and a given catalog
-        separation in arcsec
+        separation in arcsec: minimum margin around the image where reference sources are considered
+        The reference catalog is read through an index (lib_fits.catalogueIndex, kept in cachedir if given), only around the image.
         """
-        import bdsf
-        from astropy.coordinates import match_coordinates_sky
-        from astropy.coordinates import SkyCoord
-        import astropy.units as u
-        from scipy.stats import gaussian_kde
         from astropy.stats import median_absolute_deviation
 
         # if there are no data in the image prevent the crash of bdsf
@@ -149,69 +188,73 @@ class Direction(Image):
 
         img_cat = self.imagefile+'.cat'
         if not os.path.exists(img_cat):
+            import bdsf
             bdsf_img = bdsf.process_image(self.imagefile, rms_box=(100,30), \
                 thresh_pix=5, thresh_isl=3, atrous_do=False, \
                 adaptive_rms_box=True, adaptive_thresh=100, rms_box_bright=(30,10))
             bdsf_img.write_catalog(outfile=img_cat, catalog_type='srl', format='fits', clobber=True)
 
         # read catlogue
-        ref_t = Table.read(ref_cat)
         img_t = Table.read(img_cat)
-        logging.debug('SHIFT: Initial len: %i (ref:%i)' % (len(img_t),len(ref_t)))
- 
+        img_ra, img_dec = np.asarray(img_t['RA'], dtype=float), np.asarray(img_t['DEC'], dtype=float)
+        # reference sources around the image, with isolation computed on the whole catalogue
+        ref_index = get_catalogue_index(ref_cat, ('FINT', 'FPEAK'), cachedir)
+        ra_c, dec_c = self.get_wcs().all_pix2world((self.shape[1]-1)/2., (self.shape[0]-1)/2., 0)
+        ra_corners, dec_corners = self.get_corners()
+        radius = np.max(angular_sep(ra_c, dec_c, ra_corners, dec_corners)) + max(separation/3600., 3*self.get_beam()[0])
+        ref_t = ref_index.cone(ra_c, dec_c, radius)
+        logging.debug('SHIFT: Initial len: %i (ref:%i of %i)' % (len(img_ra),len(ref_t['RA']),len(ref_index)))
+
         # reduce to isolated sources LOFAR
-        idx_match, sep, _ = match_coordinates_sky(SkyCoord(img_t['RA'], img_t['DEC']),\
-                                                  SkyCoord(img_t['RA'], img_t['DEC']), nthneighbor=2)
-    
-        idx_match_img = np.arange(0,len(img_t))[sep>3*self.get_beam()[0]*u.arcsec]
-        img_t = img_t[idx_match_img]
+        sel = isolation(img_ra, img_dec) > 3*self.get_beam()[0]/3600.
+        img_t, img_ra, img_dec = img_t[sel], img_ra[sel], img_dec[sel]
         # reduce to isolated sources REF
-        idx_match, sep, _ = match_coordinates_sky(SkyCoord(ref_t['RA'], ref_t['DEC']),\
-                                                  SkyCoord(ref_t['RA'], ref_t['DEC']), nthneighbor=2)
-    
-        idx_match_ref = np.arange(0,len(ref_t))[sep>self.get_beam()[0]*u.arcsec]
-        ref_t = ref_t[idx_match_ref]
-        logging.debug('SHIFT: After isaolated sources len: %i (ref:%i)' % (len(img_t),len(ref_t)))
-    
+        ref_t = {name: col[ref_t['ISOL'] > self.get_beam()[0]/3600.] for name, col in ref_t.items()}
+        logging.debug('SHIFT: After isaolated sources len: %i (ref:%i)' % (len(img_ra),len(ref_t['RA'])))
+
         # reduce to compact sources
-        img_t = img_t[ (img_t['S_Code'] == 'S') ]
-        img_t = img_t[ (img_t['Total_flux']/img_t['Peak_flux']) < 2 ]
-        ref_t = ref_t[ (ref_t['FINT']/ref_t['FPEAK']) < 1.2 ]
-        logging.debug('SHIFT: After compact source len: %i (ref:%i)' % (len(img_t),len(ref_t)))
-    
-        # cross match
-        idx_match, sep, _ = match_coordinates_sky(SkyCoord(img_t['RA'], img_t['DEC']),\
-                                                  SkyCoord(ref_t['RA'], ref_t['DEC']))
-    
-        sep_mad = median_absolute_deviation(sep[np.where(sep < (3*self.get_beam()[0])*u.deg)])
-        sep_med = np.median(sep[np.where(sep < (3*self.get_beam()[0])*u.deg)])
-        logging.debug('SHIFT: Sep init Med: %f" - MAD: %f"' % (sep_med.arcsec, sep_mad.arcsec))
+        sel = (img_t['S_Code'] == 'S') & ((img_t['Total_flux']/img_t['Peak_flux']) < 2)
+        img_t, img_ra, img_dec = img_t[sel], img_ra[sel], img_dec[sel]
+        ref_t = {name: col[(ref_t['FINT']/ref_t['FPEAK']) < 1.2] for name, col in ref_t.items()}
+        logging.debug('SHIFT: After compact source len: %i (ref:%i)' % (len(img_ra),len(ref_t['RA'])))
+
+        if len(img_ra) == 0 or len(ref_t['RA']) == 0:
+            logging.warning('No match found in the reference catalogue.')
+            return
+
+        # cross match (sep in deg)
+        (idx_match, sep), = match_catalogues(img_ra, img_dec, [(ref_t['RA'], ref_t['DEC'])])
+
+        close = sep < 3*self.get_beam()[0]
+        sep_mad = median_absolute_deviation(sep[close])
+        sep_med = np.median(sep[close])
+        logging.debug('SHIFT: Sep init Med: %f" - MAD: %f"' % (sep_med*3600, sep_mad*3600))
         sep_mad_old = 0
         i = 0
         while sep_mad != sep_mad_old and not i > 100:
             sep_mad_old = sep_mad
-            idx = np.where(sep-sep_med < 7 * sep_mad)
+            idx = sep-sep_med < 7 * sep_mad
             sep_mad = median_absolute_deviation(sep[idx])
             sep_med = np.median(sep[idx])
             logging.debug('SHIFT: Sep Med: %.2f" - MAD: %.2f" (n sources:%i)' % \
-                    (sep_med.arcsec, sep_mad.arcsec, len(sep[idx])))
+                    (sep_med*3600, sep_mad*3600, np.count_nonzero(idx)))
             if np.isnan(sep_mad):
                 sys.exit('MAD diverged')
             i+=1
-    
-        idx_match_ref = idx_match[sep-sep_med < 3*sep_mad]
-        idx_match_img = np.arange(0,len(img_t))[sep-sep_med < 3*sep_mad]
-        img_t = img_t[idx_match_img]
-    
-        logging.debug('SHIFT: After match source len: %i' % len(img_t))
-    
+
+        good = sep-sep_med < 3*sep_mad
+        idx_match_ref = idx_match[good]
+        img_ra, img_dec = img_ra[good], img_dec[good]
+
+        logging.debug('SHIFT: After match source len: %i' % len(img_ra))
+
         # find & apply shift
-        if len(idx_match) == 0:
+        if len(idx_match_ref) == 0:
             logging.warning('No match found in the reference catalogue.')
             return
 
-        ddec = ref_t['DEC'][idx_match_ref] - img_t['DEC']
-        dra = ref_t['RA'][idx_match_ref] - img_t['RA']
+        ddec = ref_t['DEC'][idx_match_ref] - img_dec
+        dra = ref_t['RA'][idx_match_ref] - img_ra
         dra[ dra>180 ] -= 360
         dra[ dra<-180 ] += 360
 
@@ -228,192 +271,429 @@ class Direction(Image):
         #if not args.save:
         #    os.system('rm '+img_cat)
 
-logging.info('Reading files...')
-directions = []
-beams = []
-for i, image in enumerate(args.images):
-    d = Direction(image, channel=args.use_channel, stokes=args.use_stokes)
-    beams.append(d.get_beam()) 
-    directions.append(d)
+class mosaicStore(object):
+    """
+    Persistent state of a mosaic for incremental updates. The contribution (box, data*weight, weight, valid)
+    of each image is kept in a diskCache under a key of the image and of everything that changes it. The sums on
+    the output grid are memory mapped .npy files, with per-pixel counts of the valid and weighted contributions
+    instead of a mask so that a contribution can be subtracted.
+    Each output mosaic has its own state and contributions, also if on the same grid of another one.
+    """
+
+    def __init__(self, storedir, regrid_hdr, output, maxsize=None, maxage=None):
+        """
+        storedir: directory of the store, shared by all mosaics
+        regrid_hdr: header of the output grid
+        output: name of the output mosaic
+        maxsize, maxage: limits (bytes, seconds) of the contributions kept, see diskCache
+        """
+        # the output by name (not by mtime, it changes at every update) and the grid only,
+        # other keywords of the header (e.g. beam) change when the mosaic is written
+        self.mosaic_key = hash_args(os.path.abspath(output).encode(), \
+                                    pywcs(regrid_hdr).to_header_string(), regrid_hdr['NAXIS1'], regrid_hdr['NAXIS2'])
+        self.contributions = diskCache(os.path.join(storedir, 'contributions'), maxsize=maxsize, maxage=maxage)
+        self.statedir = os.path.join(storedir, 'mosaic-'+self.mosaic_key)
+        os.makedirs(self.statedir, exist_ok=True)
+        self.shape = (regrid_hdr['NAXIS2'], regrid_hdr['NAXIS1'])
+        state = None
+        if os.path.exists(os.path.join(self.statedir, 'state.json')):
+            with open(os.path.join(self.statedir, 'state.json')) as f:
+                state = json.load(f)
+        if state is None or state['dirty']:
+            if state is not None:
+                logging.warning('Incomplete update of the mosaic store, start again.')
+                self.keys = state['keys']
+            self._reset()
+        else:
+            self.keys = state['keys']
+            self._open('r+')
+
+    def _open(self, mode):
+        self.isum, self.wsum, self.nvalid, self.nweight = \
+            [np.lib.format.open_memmap(os.path.join(self.statedir, name+'.npy'), mode=mode, dtype=dtype, shape=self.shape) \
+             for name, dtype in [('isum', np.float64), ('wsum', np.float64), ('nvalid', np.int32), ('nweight', np.int32)]]
+
+    def _reset(self):
+        # contributions already in the sums are not needed anymore
+        for key in getattr(self, 'keys', {}).values():
+            self.contributions.delete(key)
+        self.keys = {}
+        self._open('w+')
+
+    def _save_state(self, dirty):
+        for array in [self.isum, self.wsum, self.nvalid, self.nweight]: array.flush()
+        statefile = os.path.join(self.statedir, 'state.json')
+        with open(statefile+'.tmp', 'w') as f:
+            json.dump({'dirty':dirty, 'keys':self.keys}, f)
+        os.replace(statefile+'.tmp', statefile)
+
+    def _accumulate(self, contribution, sign):
+        if contribution is None: return
+        box, rw, w, valid = contribution
+        if sign > 0:
+            self.isum[box] += rw
+            self.wsum[box] += w
+            self.nvalid[box] += valid
+            self.nweight[box] += (w != 0)
+        else:
+            self.isum[box] -= rw
+            self.wsum[box] -= w
+            self.nvalid[box] -= valid
+            self.nweight[box] -= (w != 0)
+            # no rounding residuals where nothing is left
+            empty = (self.nweight[box] == 0)
+            self.isum[box][empty] = 0
+            self.wsum[box][empty] = 0
+
+    def update(self, imagefiles, keys):
+        """
+        Subtract the contributions of images that are not in imagefiles or whose key changed,
+        return the indices of the images whose contribution must be (re)made and added.
+        """
+        stale = [(imagefile, key) for imagefile, key in self.keys.items() if dict(zip(imagefiles, keys)).get(imagefile) != key]
+        self._save_state(dirty=True)
+        for imagefile, key in stale:
+            try:
+                contribution = self.contributions.get(key)
+            except KeyError:
+                logging.warning('Missing contribution of %s in the store, redo the whole mosaic.' % imagefile)
+                self._reset()
+                return list(range(len(imagefiles)))
+            logging.info('Subtracting old contribution of %s...' % imagefile)
+            self._accumulate(contribution['contribution'], -1)
+            self.contributions.delete(key)
+            del self.keys[imagefile]
+        return [i for i, (imagefile, key) in enumerate(zip(imagefiles, keys)) if self.keys.get(imagefile) != key]
+
+    def add(self, imagefile, key, contribution):
+        """
+        Keep the contribution of an image (None if it does not cover the mosaic) and add it
+        """
+        self.contributions.set(key, {'contribution':contribution})
+        self._accumulate(contribution, +1)
+        self.keys[imagefile] = key
+
+    def commit(self):
+        self._save_state(dirty=False)
+
+def make_mosaic(directions, header=None, options=None):
+    """
+    Combine directions (list of Direction) in a mosaic and write it in options.output.
+    Directions are prepared in place (convolution, beam, noise, weights, shift) and can be passed again
+    to other mosaics: directions already prepared with the same options are not prepared again.
+
+    Parameters
+    ----------
+    directions : list of Direction
+    header : fits header, optional
+        Header of the output grid, by default it is made to contain all directions
+    options : argparse.Namespace, optional
+        See get_options(), default options if not given
+
+    Returns
+    -------
+    The header of the mosaic.
+    """
+    if options is None: options = get_options()
+    check_options(options, len(directions), header)
+    set_precision(options.precision)
+
+    beamcache = None if options.beamcache is None else diskCache(options.beamcache, maxsize=5*1024**3, maxage=30*86400)
+
+    if options.shift and not options.beamcorr:
+        logging.warning('Attempting shift calculation on beam corrected images, this is not the best.')
+
+    logging.info("Working on %i images..." % len(directions))
+
+    common_beam = None
+    if options.beamarm:
+        # native beams: directions already prepared for another mosaic are convolved
+        beams = [d.native_beam for d in directions]
+
+        if beams.count(beams[0]) == len(beams):
+            # all beams are already exactly the same
+            common_beam = beams[0]
+        elif options.beamcirc:
+            maxmaj = np.max([b[0] for b in beams])
+            common_beam = [maxmaj*1.01, maxmaj*1.01, 0.] # add 1% to prevent crash in convolution
+        else:
+            from radio_beam import Beams
+            my_beams = Beams([b[0] for b in beams] * u.deg, [b[1] for b in beams] * u.deg, [b[2] for b in beams] * u.deg)
+            common_beam = my_beams.common_beam()
+            common_beam = [common_beam.major.value, common_beam.minor.value, common_beam.pa.value]
+
+        logging.debug('Minimum common beam: %.1f" %.1f" (pa %.1f deg)' % \
+                 (common_beam[0]*3600., common_beam[1]*3600., common_beam[2]))
+
+    def direction_key(i):
+        """
+        Key of everything that changes direction i once prepared (files by path, mtime and size)
+        """
+        return hash_args(os.path.abspath(directions[i].imagefile), directions[i].channel, directions[i].stokes, \
+                         None if options.beams is None else options.beams[i] if options.beams[i].startswith('gauss:') \
+                              else os.path.abspath(options.beams[i]), \
+                         None if options.regions is None else os.path.abspath(options.regions[i]), \
+                         None if options.noises is None else options.noises[i], \
+                         None if options.scales is None else options.scales[i], \
+                         common_beam, ref_catalog if options.shift else None, \
+                         options.beamcut, options.beamcorr, options.find_noise, options.precision)
+
+    def prepare_direction(i):
+        """
+        Convolve, apply beam and masks, find noise, weights and shift of direction i
+        """
+        d = directions[i]
+        key = direction_key(i)
+        if d.prepared == key:
+            logging.debug('%s: already prepared.' % d.imagefile)
+            return
+        if d.prepared is not None:
+            # prepared for other options, start again from the image
+            d = directions[i] = Direction(d.imagefile, channel=d.channel, stokes=d.stokes, lazy=True)
+
+        if options.beamarm:
+            with Timer('convolve'):
+                d.convolve(common_beam)
+
+        if options.beams is not None:
+            with Timer('beam'):
+                d.set_beam_file(options.beams[i], cache=beamcache)
+                d.apply_beam_cut(beamcut = options.beamcut)
+
+        if options.regions is not None:
+            d.apply_region(options.regions[i], blankvalue=0, invert=True)
+
+        if options.noises is not None: d.noise = options.noises[i]
+        elif options.find_noise:
+            with Timer('noise'):
+                d.calc_noise(force_recalc=True) # after beam cut/mask
+
+        if options.scales is not None: d.scale = options.scales[i]
+
+        if options.beamcorr: d.apply_beam_corr() # after noise calculation
+
+        d.calc_weight() # after setting: beam, noise, scale
+
+        if options.shift:
+            with Timer('shift'):
+                d.calc_shift(ref_catalog, cachedir=options.catcache)
+
+        d.prepared = key
+
+    if options.store is None:
+        for i in range(len(directions)):
+            prepare_direction(i)
+
+    # prepare header for final gridding
+    if header is None:
+        logging.warning('Calculate output headers...')
+        mra = np.mean( np.array([d.get_wcs().wcs.crval[0]%360 for d in directions]) )
+        mdec = np.mean( np.array([d.get_wcs().wcs.crval[1] for d in directions]) )
+
+        logging.info('Will make mosaic at %f %f' % (mra,mdec))
+
+        # we make a reference WCS and use it to find the extent in pixels
+        # needed for the combined image
+
+        rwcs = pywcs(naxis=2)
+        rwcs.wcs.ctype = directions[0].get_wcs().wcs.ctype
+        rwcs.wcs.cdelt = directions[0].get_wcs().wcs.cdelt
+        rwcs.wcs.crval = [mra,mdec]
+        rwcs.wcs.crpix = [1,1]
+
+        xmin=0
+        xmax=0
+        ymin=0
+        ymax=0
+        for d in directions:
+            # corners of the part of the image with data
+            corners = d.get_corners(nonzero=True)
+            if corners is None: continue
+            nx, ny = rwcs.wcs_world2pix(corners[0], corners[1], 0)
+            xmin = min(xmin, nx.min())
+            xmax = max(xmax, nx.max())
+            ymin = min(ymin, ny.min())
+            ymax = max(ymax, ny.max())
 
-logging.info("Working on %i images..." % len(directions))
+        #print 'co-ord range:', xmin, xmax, ymin, ymax
 
-if args.beamarm:
+        xsize = int(xmax-xmin)
+        ysize = int(ymax-ymin)
 
-    if beams.count(beams[0]) == len(beams):
-        # all beams are already exactly the same
-        common_beam = beams[0]
+        rwcs.wcs.crpix = [-int(xmin)+1,-int(ymin)+1]
+        #print 'checking:', rwcs.wcs_world2pix(mra,mdec,0)
+
+        regrid_hdr = rwcs.to_header()
+        regrid_hdr['NAXIS'] = 2
+        regrid_hdr['NAXIS1'] = xsize
+        regrid_hdr['NAXIS2'] = ysize
 
-    if args.beamcirc:
-        maxmaj = np.max([b[0] for b in beams])
-        common_beam = [maxmaj*1.01, maxmaj*1.01, 0.] # add 1% to prevent crash in convolution
     else:
-        from radio_beam import Beams
-        my_beams = Beams([b[0] for b in beams] * u.deg, [b[1] for b in beams] * u.deg, [b[2] for b in beams] * u.deg)
-        common_beam = my_beams.common_beam()
-        common_beam = [common_beam.major.value, common_beam.minor.value, common_beam.pa.value]
-
-    logging.debug('Minimum common beam: %.1f" %.1f" (pa %.1f deg)' % \
-             (common_beam[0]*3600., common_beam[1]*3600., common_beam[2]))
-
-
-for i, d in enumerate(directions):
-
-    if args.beamarm:
-        d.convolve(common_beam)
-
-    if args.beams is not None:
-        d.set_beam_file(args.beams[i])
-        d.apply_beam_cut(beamcut = args.beamcut)
-
-    if args.regions is not None:
-        d.apply_region(args.regions[i], blankvalue=0, invert=True)
-
-    if args.noises is not None: d.noise = args.noises[i]
-    elif args.find_noise: d.calc_noise(force_recalc=True) # after beam cut/mask
-
-    if args.scales is not None: d.scale = args.scales[i]
-
-    if args.beamcorr: d.apply_beam_corr() # after noise calculation
-
-    d.calc_weight() # after setting: beam, noise, scale
-
-    if args.shift:
-        d.calc_shift(ref_catalog)
-
-
-# prepare header for final gridding
-if args.header is None:
-    logging.warning('Calculate output headers...')
-    mra = np.mean( np.array([d.get_wcs().wcs.crval[0]%360 for d in directions]) )
-    mdec = np.mean( np.array([d.get_wcs().wcs.crval[1] for d in directions]) )
-
-    logging.info('Will make mosaic at %f %f' % (mra,mdec))
-    
-    # we make a reference WCS and use it to find the extent in pixels
-    # needed for the combined image
-
-    rwcs = pywcs(naxis=2)
-    rwcs.wcs.ctype = directions[0].get_wcs().wcs.ctype
-    rwcs.wcs.cdelt = directions[0].get_wcs().wcs.cdelt
-    rwcs.wcs.crval = [mra,mdec]
-    rwcs.wcs.crpix = [1,1]
-
-    xmin=0
-    xmax=0
-    ymin=0
-    ymax=0
-    for d in directions:
-        w = d.get_wcs()
-        ys, xs = np.where(d.img_data)
-        axmin = xs.min()
-        aymin = ys.min()
-        axmax = xs.max()
-        aymax = ys.max()
-        del(xs)
-        del(ys)
-        for x,y in ((axmin,aymin),(axmax,aymin),(axmin,aymax),(axmax,aymax)):
-            ra, dec = [float(f) for f in w.wcs_pix2world(x,y,0)]
-            #print ra,dec
-            nx, ny = [float (f) for f in rwcs.wcs_world2pix(ra,dec,0)]
-            #print nx,ny
-            if nx < xmin: xmin=nx
-            if nx > xmax: xmax=nx
-            if ny < ymin: ymin=ny
-            if ny > ymax: ymax=ny
-
-    #print 'co-ord range:', xmin, xmax, ymin, ymax
-
-    xsize = int(xmax-xmin)
-    ysize = int(ymax-ymin)
-
-    rwcs.wcs.crpix = [-int(xmin)+1,-int(ymin)+1]
-    #print 'checking:', rwcs.wcs_world2pix(mra,mdec,0)
-
-    regrid_hdr = rwcs.to_header()
-    regrid_hdr['NAXIS'] = 2
-    regrid_hdr['NAXIS1'] = xsize
-    regrid_hdr['NAXIS2'] = ysize
-
-else:
-    try:
-        logging.info("Using %s header for final gridding." % args.header)
-        regrid_hdr = pyfits.open(args.header)[0].header
+        regrid_hdr = header.copy()
         xsize = regrid_hdr['NAXIS1']
         ysize = regrid_hdr['NAXIS2']
-    except:
-        logging.error("--header must be a fits file.")
-        sys.exit(1)
 
-logging.info('Making mosaic...')
-isum = np.zeros([ysize,xsize])
-wsum = np.zeros_like(isum)
-mask = np.zeros_like(isum,dtype=np.bool)
-if args.mask is not None:
-    logging.debug('Reprojecting mask...')
-    outname = args.mask.replace('.fits','-reproj.fits')
-    if os.path.exists(outname):
-        logging.debug('Loading %s...' % outname)
-        mask_n = pyfits.open(outname)[0]
+    logging.info('Making mosaic...')
+    if options.store is None:
+        # weighted sums are accumulated in double precision, in memory mapped scratch files:
+        # each direction only touches the box of the output grid it covers
+        scratchdir = os.path.dirname(os.path.abspath(options.output))
+        isum = np.memmap(tempfile.TemporaryFile(dir=scratchdir), dtype=np.float64, mode='w+', shape=(ysize,xsize))
+        wsum = np.memmap(tempfile.TemporaryFile(dir=scratchdir), dtype=np.float64, mode='w+', shape=(ysize,xsize))
+        mask = np.memmap(tempfile.TemporaryFile(dir=scratchdir), dtype=bool, mode='w+', shape=(ysize,xsize))
+        store = None
+        todo = list(range(len(directions)))
     else:
-        mask_n.data, footprint = reproj((mask_n.data, mask_n.header), regrid_hdr, order='bilinear')#, parallel=True)
-        if args.save:
-            pyfits.writeto(outname, header=regrid_hdr, data=mask_n.data, overwrite=True)
+        # sums and contributions are kept, only new/changed directions are made
+        store = mosaicStore(options.store, regrid_hdr, options.output, \
+                            maxsize=options.storemaxsize*1024**3, maxage=options.storemaxage*86400)
+        imagefiles = [os.path.abspath(d.imagefile) for d in directions]
+        keys = [hash_args(direction_key(i), None if options.mask is None else (os.path.abspath(options.mask), i), store.mosaic_key) \
+                for i in range(len(directions))]
+        todo = store.update(imagefiles, keys)
+        logging.info('Update mosaic with %i of %i images...' % (len(todo), len(directions)))
+        for i in todo:
+            prepare_direction(i)
+        isum, wsum, mask = store.isum, store.wsum, store.nvalid
+
+    if options.mask is not None:
+        logging.debug('Reading mask: %s.' % options.mask)
+        mask_n = pyfits.open(options.mask)[0]
+        logging.debug('Reprojecting mask...')
+        outname = options.mask.replace('.fits','-reproj.fits')
+        if os.path.exists(outname):
+            logging.debug('Loading %s...' % outname)
+            mask_n = pyfits.open(outname)[0]
+        else:
+            mask_n.data, footprint = reproj((mask_n.data, mask_n.header), regrid_hdr, order='bilinear')#, parallel=True)
+            if options.save:
+                pyfits.writeto(outname, header=regrid_hdr, data=mask_n.data, overwrite=True)
+
+        # get numbers into mask in increasing order
+        mask_numbers = sorted(np.unique(mask_n.data))
+
+    def reproject_direction(i):
+        """
+        Reproject data and weights of direction i on the box of the output grid it covers
+        (or load them if saved). Return the box, data*weight, weight and where the weight is defined,
+        None if the direction is outside the mosaic.
+        """
+        d = directions[i]
+        logging.info('Working on: %s' % d.imagefile)
+
+        outname = d.imagefile.replace('.fits','-reproj.fits')
+        outnameW = d.imagefile.replace('.fits','-reprojW.fits')
+        if os.path.exists(outname) and os.path.exists(outnameW):
+            logging.debug('Loading %s and %s...' % (outname, outnameW))
+            r = pyfits.getdata(outname)
+            w = pyfits.getdata(outnameW)
+            # saved files cover only the box of the direction (or the whole grid)
+            hdr = pyfits.getheader(outname)
+            y0 = int(np.rint(regrid_hdr['CRPIX2'] - hdr['CRPIX2']))
+            x0 = int(np.rint(regrid_hdr['CRPIX1'] - hdr['CRPIX1']))
+            box = np.s_[y0:y0+r.shape[0], x0:x0+r.shape[1]]
+            valid = (w>0)
+        else:
+            bbox = regrid_footprint(d.img_hdr, regrid_hdr)
+            if bbox is None:
+                logging.warning('%s: outside of the mosaic, skip.' % d.imagefile)
+                return None
+            y0, y1, x0, x1 = bbox
+            box = np.s_[y0:y1, x0:x1]
+            box_hdr = sub_header(regrid_hdr, bbox)
+            logging.debug('Reprojecting data and weights (%i x %i pixels)...' % (y1-y0, x1-x0))
+            # data and weights together
+            rw, footprint = reproj((np.array([d.img_data, d.weight_data], dtype=float_type()), d.img_hdr), box_hdr, \
+                                   output_array=np.empty((2, y1-y0, x1-x0), dtype=float_type()))
+            r, w = rw
+            r[ np.isnan(r) ] = 0
+            valid = ~np.isnan(w)
+            w[ np.isnan(w) ] = 0
+            if options.mask is not None:
+                w[mask_n.data[box] != mask_numbers[i]] = 0
+            if options.save:
+                pyfits.writeto(outname, header=box_hdr, data=r, overwrite=True)
+                pyfits.writeto(outnameW, header=box_hdr, data=w, overwrite=True)
+        return box, r*w, w, valid
+
+    with Timer('regrid'):
+        if options.ncpu > 1:
+            # workers get the directions at start (fork), they return the boxes in order
+            from lib_multiproc import multiprocPool
+            pool = multiprocPool(max(1, min(options.ncpu, len(todo))), reproject_direction)
+            results = pool.imap([[i] for i in todo], ordered=True)
+        else:
+            pool = None
+            results = map(reproject_direction, todo)
+        # add to the mosaic always in the order of the directions, so the result does not depend on ncpu
+        for i, result in zip(todo, results):
+            if store is not None:
+                store.add(imagefiles[i], keys[i], result)
+                continue
+            if result is None: continue
+            box, rw, w, valid = result
+            mask[box] |= valid
+            isum[box] += rw
+            wsum[box] += w
+        if pool is not None: pool.close()
+        if store is not None: store.commit()
+
+    #set beam
+    if common_beam is not None:
+        regrid_hdr['BMAJ'] = common_beam[0]
+        regrid_hdr['BMIN'] = common_beam[1]
+        regrid_hdr['BPA'] = common_beam[2]
+    else:
+        logging.warning('Setting beam in the headers equal to: %s' % directions[0].imagefile)
+        for ch in ('BMAJ', 'BMIN', 'BPA'):
+            regrid_hdr[ch] = pyfits.open(directions[0].imagefile)[0].header[ch]
 
-    # get numbers into mask in increasing order
-    mask_numbers = sorted(np.unique(mask_n.data))
+    regrid_hdr['ORIGIN'] = 'LiLF-pipeline-mosaic'
+    regrid_hdr['UNITS'] = 'Jy/beam'
 
-for i, d in enumerate(directions):
-    logging.info('Working on: %s' % d.imagefile)
+    logging.debug('Write mosaic: %s...' % options.output)
+    with Timer('write'):
+        mosaic = create_fits(options.output, regrid_hdr, dtype=float_type())
+        for y0 in range(0, ysize, 1024):
+            rows = np.s_[y0:y0+1024]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                block = np.where(wsum[rows] != 0, isum[rows] / wsum[rows], np.nan)
+            # mask is not 0 where a non-nan region was present in either map
+            block[mask[rows] == 0] = np.nan
+            mosaic[rows] = block
+        mosaic.flush()
 
-    outname = d.imagefile.replace('.fits','-reproj.fits')
-    if os.path.exists(outname):
-        logging.debug('Loading %s...' % outname)
-        r = pyfits.open(outname)[0].data
-    else:
-        logging.debug('Reprojecting data...')
-        r, footprint = reproj((d.img_data, d.img_hdr), regrid_hdr)#, parallel=True)
-        r[ np.isnan(r) ] = 0
-        if args.save:
-            pyfits.writeto(outname, header=regrid_hdr, data=r, overwrite=True)
-
-    outname = d.imagefile.replace('.fits','-reprojW.fits')
-    if os.path.exists(outname):
-        logging.debug('Loading %s...' % outname)
-        w = pyfits.open(outname)[0].data
-        mask |= (w>0)
-    else:
-        logging.debug('Reprojecting weights...')
-        w, footprint = reproj((d.weight_data, d.img_hdr), regrid_hdr)#, parallel=True)
-        mask |= ~np.isnan(w)
-        w[ np.isnan(w) ] = 0
-        if args.mask is not None:
-            w[mask_n.data != mask_numbers[i]] = 0
-        if args.save:
-            pyfits.writeto(outname, header=regrid_hdr, data=w, overwrite=True)
-    logging.debug('Add to mosaic...')
-    isum += r*w
-    wsum += w
-
-logging.debug('Write mosaic: %s...' % args.output)
-# mask now contains True where a non-nan region was present in either map
-isum[wsum != 0] /= wsum[wsum != 0]
-isum[wsum == 0] = np.nan
-isum[~mask] = np.nan
-
-#set beam
-try:
-    regrid_hdr['BMAJ'] = common_beam[0]
-    regrid_hdr['BMIN'] = common_beam[1]
-    regrid_hdr['BPA'] = common_beam[2]
-except:
-    logging.warning('Setting beam in the headers equal to: %s' % directions[0].imagefile)
-    for ch in ('BMAJ', 'BMIN', 'BPA'):
-        regrid_hdr[ch] = pyfits.open(directions[0].imagefile)[0].header[ch]
-
-regrid_hdr['ORIGIN'] = 'LiLF-pipeline-mosaic'
-regrid_hdr['UNITS'] = 'Jy/beam'
-
-pyfits.writeto(args.output, header=regrid_hdr, data=isum, overwrite=True)
-
-logging.debug('Done.')
+    return regrid_hdr
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    logging.root.setLevel(logging.DEBUG)
+    lib_timer.configure(profile=args.profile, trace_memory=args.profile)
+
+    try:
+        check_options(args, 0 if args.images is None else len(args.images), args.header)
+    except ValueError as e:
+        logging.error(e)
+        sys.exit(1)
+
+    header = None
+    if args.header is not None:
+        try:
+            logging.info("Using %s header for final gridding." % args.header)
+            header = pyfits.open(args.header)[0].header
+        except:
+            logging.error("--header must be a fits file.")
+            sys.exit(1)
+
+    logging.info('Reading files...')
+    directions = []
+    with Timer('read'):
+        for image in args.images:
+            directions.append(Direction(image, channel=args.use_channel, stokes=args.use_stokes, lazy=True)) # data are read when needed
+
+    make_mosaic(directions, header, args)
+
+    if args.timing is not None:
+        lib_timer.report(args.timing)
+    logging.debug('Done.')
@@ -17,7 +17,7 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-import os, sys, argparse, logging
+import os, sys, argparse, logging, tempfile, shutil
 import numpy as np
 from astropy.io import fits as pyfits
 from astropy.wcs import WCS as pywcs
@@ -25,8 +25,11 @@ from astropy.coordinates import match_coordinates_sky
 from astropy.coordinates import SkyCoord
 import astropy.units as u
 import pyregion
-from lib_linearfit import linear_fit, linear_fit_bootstrap
-from lib_fits import AllImages
+from lib_linearfit import linear_fit, linear_fit_bootstrap, linear_fit_batch, linear_fit_bootstrap_batch
+from lib_fits import AllImages, make_tiles, sub_header, create_fits, set_precision, float_type
+from lib_cache import diskCache, default_cachedir
+import lib_timer
+from lib_timer import Timer
 # https://github.com/astrofrog/reproject
 from reproject import reproject_interp, reproject_exact
 reproj = reproject_exact
@@ -35,6 +38,7 @@ logging.root.setLevel(logging.DEBUG)
 parser = argparse.ArgumentParser(description='Make spectral index maps, e.g. spidxmap.py --region ds9.reg --noise --sigma 5 --save *fits')
 parser.add_argument('images', nargs='+', help='List of images to use for spidx')
 parser.add_argument('--ncpu', dest='ncpu', default=1, type=int, help='Number of cpus to use (default: 1)')
+parser.add_argument('--engine', dest='engine', default='batch', choices=['batch','pixel'], help='Fit all pixels at once or one pixel at a time (default: batch)')
 parser.add_argument('--beam', dest='beam', nargs=3, type=float, help='3 parameters final beam to convolve all images (BMAJ (arcsec), BMIN (arcsec), BPA (deg))')
 parser.add_argument('--region', dest='region', type=str, help='Ds9 region to restrict analysis')
 parser.add_argument('--noiseregion', dest='noiseregion', type=str, help='Ds9 region to calculate rms noise (default: do not use)')
@@ -49,31 +53,65 @@ parser.add_argument('--sigma', dest='sigma', type=float, help='Restrict to pixel
 parser.add_argument('--circbeam', dest='circbeam', action='store_true', help='Force final beam to be circular (default: False, use minimum common beam area)')
 parser.add_argument('--bootstrap', dest='bootstrap', action='store_true', help='Use bootstrap to estimate errors (default: use normal X|Y with errors)')
 parser.add_argument('--output', dest='output', default='spidx.fits', type=str, help='Name of output mosaic (default: spidx.fits)')
+parser.add_argument('--regrid', dest='regrid', default='exact', choices=['exact','interp','adaptive','auto'], help='Reprojection algorithm, auto chooses for each image from the pixel size ratio (default: exact)')
+parser.add_argument('--cachedir', dest='cachedir', help='Directory to cache convolved, regridded and shifted images, so re-runs with the same inputs and parameters reuse them, e.g. %s (default: no cache)' % default_cachedir)
+parser.add_argument('--cachemaxsize', dest='cachemaxsize', default=5, type=float, help='Max size of the cache in GB, the least recently used products are removed (default: 5)')
+parser.add_argument('--cachemaxage', dest='cachemaxage', default=30, type=float, help='Remove cached products not used for this number of days (default: 30)')
+parser.add_argument('--precision', dest='precision', default='double', choices=['single','double'], help='Precision of images, reprojections and output maps, single halves memory and writes 32-bit maps (default: double)')
+parser.add_argument('--tilesize', dest='tilesize', type=int, help='Process the images in tiles of this number of pixels of the final grid, for maps that do not fit in memory. Needs --engine batch, the products are not cached (default: process whole images)')
+parser.add_argument('--timing', dest='timing', help='Write a timing report of the main steps in this file (.json or .csv)')
+parser.add_argument('--profile', dest='profile', action='store_true', help='Profile (cProfile and tracemalloc) the main steps, slow (default: False)')
 
 args = parser.parse_args()
+lib_timer.configure(profile=args.profile, trace_memory=args.profile)
+set_precision(args.precision)
 
 # check input
 if len(args.images) < 2:
     logging.error('Requires at lest 2 images.')
     sys.exit(1)
+if args.tilesize and args.engine != 'batch':
+    logging.error('--tilesize works only with --engine batch.')
+    sys.exit(1)
+
+if args.output[-5:] == '.fits':
+    filename_out = args.output
+else:
+    filename_out = args.output+'.fits'
 
 ########################################################
-# prepare images and convolve+regrid if needed
-if np.all([os.path.exists(name.replace('.fits', '-conv-regrid.fits')) for name in args.images]):
-    logging.info('Found convolved+regridded image... restoring.')
-    all_images = AllImages([name.replace('.fits', '-conv-regrid.fits') for name in args.images])
-    regrid_hdr = all_images.images[0].img_hdr
+# prepare images: convolve, regrid and shift or restore them from the cache
+store = None if args.cachedir is None or args.tilesize else diskCache(args.cachedir, maxsize=args.cachemaxsize*1024**3, maxage=args.cachemaxage*86400)
+with Timer('read'):
+    all_images = AllImages(args.images, lazy=True)
+steps = []
+if args.tilesize:
+    # out-of-core: convolved+regridded images are written one tile at a time to memory mapped files
+    target_beam = all_images.target_beam(beam=args.beam, circbeam=args.circbeam)
+    regrid_hdr = all_images.regrid_common(size=args.size, region=args.region, radec=args.radec, pixscale=target_beam[1]*3600/4., action='header')
+    if args.save:
+        tiledir = None
+        filenames = [image.imagefile.replace('.fits', '-conv-regrid.fits') for image in all_images]
+    else:
+        tiledir = tempfile.mkdtemp(prefix='spidxmap-', dir=os.path.dirname(os.path.abspath(filename_out)))
+        filenames = [os.path.join(tiledir, '%i.fits' % i) for i in range(len(all_images))]
+    with Timer('regrid'):
+        all_images.convolve_regrid_tiled(regrid_hdr, filenames, target_beam=target_beam, tilesize=args.tilesize, method=args.regrid, ncpu=args.ncpu)
 else:
-    all_images = AllImages(args.images)
-    all_images.convolve_to(beam=args.beam, circbeam=args.circbeam)
-    if args.save: all_images.write('conv')
-    regrid_hdr = all_images.regrid_common(size=args.size, region=args.region, radec=args.radec, action='regrid_header')
-    if args.save: all_images.write('conv-regrid')
+    steps = [('convolve', Timer('convolve')(lambda: all_images.convolve_to(beam=args.beam, circbeam=args.circbeam)), \
+              (args.beam, args.circbeam, 'fft'), (lambda: all_images.write('conv')) if args.save else None),
+             ('regrid', Timer('regrid')(lambda: all_images.regrid_common(size=args.size, region=args.region, radec=args.radec, \
+                                        action='regrid_header', method=args.regrid, cache=store, ncpu=args.ncpu)), \
+              (args.size, args.region, args.radec, args.regrid), (lambda: all_images.write('conv-regrid')) if args.save else None)]
 
 #####################################################
 # find+apply shift w.r.t. lowest noise image
 if args.shift:
-    all_images.align_catalogue()
+    steps.append(('shift', Timer('shift')(lambda: all_images.align_catalogue(ncpu=args.ncpu)), ()))
+
+# only the products of the last cached step are read
+values = all_images.run_steps(store, steps)
+if not args.tilesize: regrid_hdr = values[1]
  
 #########################################################
 # only after regrid+convolve apply mask and find noise
@@ -81,12 +119,14 @@ for image in all_images:
     if args.noise:
         if args.sigma is not None:
             # usually the sigma used for the blanking is rather low, better to increase it for the calc_noise
-            image.calc_noise(sigma=args.noisesigma, bg_reg=args.noiseregion, force_recalc=True) # after convolution
-            image.blank_noisy(args.sigma)
+            with Timer('noise'):
+                image.calc_noise(sigma=args.noisesigma, bg_reg=args.noiseregion, force_recalc=True) # after convolution
+            if not args.tilesize: image.blank_noisy(args.sigma) # tiles are blanked in fit_tile()
         else:
-            image.calc_noise(force_recalc=True) # after mask?/convolution
+            with Timer('noise'):
+                image.calc_noise(force_recalc=True) # after mask?/convolution
 
-    if args.region is not None:
+    if args.region is not None and not args.tilesize:
         image.apply_region(args.region, invert=True) # after convolution to minimise bad pixels
 
 #########################################################
@@ -96,13 +136,86 @@ ysize = regrid_hdr['NAXIS2']
 frequencies = [ image.get_freq() for image in all_images ]
 if args.noise: 
     rmserr = np.array([ image.noise for image in all_images ])
-else: yerr = None
-spidx_data = np.empty(shape=(ysize,xsize))
-spidx_data[:] = np.nan
-spidx_err_data = np.empty(shape=(ysize,xsize))
-spidx_err_data[:] = np.nan
+else: rmserr = None
+
+if 'FREQ' in regrid_hdr.keys():
+    del regrid_hdr['FREQ']
+if 'RESTFREQ' in regrid_hdr.keys():
+    del regrid_hdr['RESTFREQ']
+regrid_hdr['BTYPE'] = 'SPIDX'
+regrid_hdr['HISTORY'] = ' '.join(sys.argv)
+
+if args.tilesize:
+    # maps are written to disk tile by tile
+    regrid_hdr['CTYPE3'] = 'ALPHA'
+    spidx_data = create_fits(filename_out, regrid_hdr)
+    regrid_hdr['CTYPE3'] = 'ALPHAERR'
+    spidx_err_data = create_fits(filename_out.replace('.fits','-err.fits'), regrid_hdr)
+else:
+    spidx_data = np.empty(shape=(ysize,xsize), dtype=float_type())
+    spidx_data[:] = np.nan
+    spidx_err_data = np.empty(shape=(ysize,xsize), dtype=float_type())
+    spidx_err_data[:] = np.nan
 
-if args.ncpu > 1:
+def get_yerr(val4reg):
+    """ Errors on the fluxes: rms noise plus (optionally) a fractional flux error in quadrature """
+    if rmserr is None:
+        if args.fluxerr: return args.fluxerr*val4reg
+        return None
+    rms = rmserr if val4reg.ndim == 1 else rmserr[:,np.newaxis]
+    if args.fluxerr:
+        return np.sqrt((args.fluxerr*val4reg)**2+rms**2)
+    return rms
+
+def fit_batch(val4reg):
+    """ Fit the (nimages, ny, nx) fluxes, return the spidx and error maps """
+    val4reg = val4reg.reshape(len(all_images),-1)
+    spidx, spidx_err = np.full(val4reg.shape[1], np.nan), np.full(val4reg.shape[1], np.nan)
+    # use only pixels that have a positive flux in all images
+    with np.errstate(invalid='ignore'):
+        valid = np.all(val4reg > 0, axis=0)
+    val4reg = val4reg[:,valid]
+    if args.bootstrap:
+        (a, b, sa, sb) = linear_fit_bootstrap_batch(x=frequencies, y=val4reg, yerr=get_yerr(val4reg), tolog=True)
+    else:
+        (a, b, sa, sb) = linear_fit_batch(x=frequencies, y=val4reg, yerr=get_yerr(val4reg), tolog=True)
+    spidx[valid] = a
+    spidx_err[valid] = sa
+    return spidx, spidx_err
+
+def fit_tile(box):
+    """ Blank, fit and write one tile (y0, y1, x0, x1) of the maps """
+    y0, y1, x0, x1 = box
+    val4reg = np.array([ image.img_data[y0:y1,x0:x1] for image in all_images ], dtype=float)
+    if args.noise and args.sigma is not None:
+        # as Image.blank_noisy()
+        for i, image in enumerate(all_images):
+            with np.errstate(invalid='ignore'):
+                val4reg[i][~(val4reg[i] > args.sigma * image.noise)] = np.nan
+    if args.region is not None:
+        mask = pyregion.open(args.region).get_mask(header=sub_header(regrid_hdr, box), shape=(y1-y0,x1-x0))
+        val4reg[:,~mask] = np.nan
+    spidx, spidx_err = fit_batch(val4reg)
+    spidx_data[y0:y1,x0:x1] = spidx.reshape(y1-y0,x1-x0)
+    spidx_err_data[y0:y1,x0:x1] = spidx_err.reshape(y1-y0,x1-x0)
+
+fit_timer = Timer('fit').start()
+if args.tilesize:
+    tiles = make_tiles((ysize, xsize), args.tilesize)
+    logging.info('Fitting %i tiles...' % len(tiles))
+    if args.ncpu > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(args.ncpu) as executor:
+            list(executor.map(fit_tile, tiles))
+    else:
+        for box in tiles:
+            fit_tile(box)
+elif args.engine == 'batch':
+    logging.info('Fitting all pixels...')
+    spidx, spidx_err = fit_batch(np.array([ image.img_data for image in all_images ]))
+    spidx_data[:] = spidx.reshape(ysize,xsize)
+    spidx_err_data[:] = spidx_err.reshape(ysize,xsize)
+elif args.ncpu > 1:
     from lib_multiproc import multiprocManager
     def funct(i,j,frequencies, val4reg, yerr, bootstrap, outQueue=None):
         if bootstrap:
@@ -118,14 +231,8 @@ if args.ncpu > 1:
         sys.stdout.flush()
         for j in range(xsize):
             val4reg = np.array([ image.img_data[i,j] for image in all_images ])
-            if np.isnan(val4reg).any() or (np.array(val4reg) < 0).any(): continue
-            # add flux error
-            if args.fluxerr: 
-                yerr = np.sqrt((args.fluxerr*val4reg)**2+rmserr**2)
-            else:
-                yerr = rmserr
-            if (np.array(val4reg) <= 0).any(): continue
-            mpm.put([i,j,frequencies, val4reg, yerr, args.bootstrap])
+            if np.isnan(val4reg).any() or (np.array(val4reg) <= 0).any(): continue
+            mpm.put([i,j,frequencies, val4reg, get_yerr(val4reg), args.bootstrap])
 
     print("Computing...")
     mpm.wait()
@@ -139,13 +246,8 @@ else:
         sys.stdout.flush()
         for j in range(xsize):
             val4reg = np.array([ image.img_data[i,j] for image in all_images ])
-            if np.isnan(val4reg).any() or (np.array(val4reg) < 0).any(): continue
-            # add flux error
-            if args.fluxerr: 
-                yerr = np.sqrt((args.fluxerr*val4reg)**2+rmserr**2)
-            else:
-                yerr = rmserr
-            if (np.array(val4reg) <= 0).any(): continue
+            if np.isnan(val4reg).any() or (np.array(val4reg) <= 0).any(): continue
+            yerr = get_yerr(val4reg)
             if args.bootstrap:
                 (a, b, sa, sb) = linear_fit_bootstrap(x=frequencies, y=val4reg, yerr=yerr, tolog=True)
             else:
@@ -153,19 +255,20 @@ else:
             spidx_data[i,j] = a
             spidx_err_data[i,j] = sa
 
-if 'FREQ' in regrid_hdr.keys():
-    del regrid_hdr['FREQ']
-if 'RESTFREQ' in regrid_hdr.keys():
-    del regrid_hdr['RESTFREQ']
-regrid_hdr['BTYPE'] = 'SPIDX'
+fit_timer.stop()
 
-if args.output[-5:] == '.fits':
-    filename_out = args.output
-else:
-    filename_out = args.output+'.fits'
 logging.info('Save %s (and errors)' % filename_out)
-regrid_hdr['HISTORY'] = ' '.join(sys.argv)
-regrid_hdr['CTYPE3'] = 'ALPHA'
-pyfits.writeto(filename_out, spidx_data, regrid_hdr, overwrite=True, output_verify='fix')
-regrid_hdr['CTYPE3'] = 'ALPHAERR'
-pyfits.writeto(filename_out.replace('.fits','-err.fits'), spidx_err_data, regrid_hdr, overwrite=True, output_verify='fix')
+with Timer('write'):
+    if args.tilesize:
+        spidx_data.flush()
+        spidx_err_data.flush()
+        del all_images
+        if tiledir is not None: shutil.rmtree(tiledir)
+    else:
+        regrid_hdr['CTYPE3'] = 'ALPHA'
+        pyfits.writeto(filename_out, spidx_data, regrid_hdr, overwrite=True, output_verify='fix')
+        regrid_hdr['CTYPE3'] = 'ALPHAERR'
+        pyfits.writeto(filename_out.replace('.fits','-err.fits'), spidx_err_data, regrid_hdr, overwrite=True, output_verify='fix')
+
+if args.timing is not None:
+    lib_timer.report(args.timing)
@@ -27,6 +27,7 @@ import astropy.units as u
 import pyregion
 from lib_linearfit import linear_fit, linear_fit_bootstrap
 from lib_fits import AllImages
+from lib_cache import diskCache, default_cachedir
 # https://github.com/astrofrog/reproject
 from reproject import reproject_interp, reproject_exact
 reproj = reproject_exact
@@ -46,6 +47,9 @@ parser.add_argument('--noise', dest='noise', action='store_true', help='Calculat
 parser.add_argument('--save', dest='save', action='store_true', help='Save intermediate results (default: false)')
 parser.add_argument('--sigma', dest='sigma', type=float, help='Restrict to pixels above this sigma in all images')
 parser.add_argument('--circbeam', dest='circbeam', action='store_true', help='Force final beam to be circular (default: False, use minimum common beam area)')
+parser.add_argument('--cachedir', dest='cachedir', help='Directory to cache convolved, regridded and shifted images, so re-runs with the same inputs and parameters reuse them, e.g. %s (default: no cache)' % default_cachedir)
+parser.add_argument('--cachemaxsize', dest='cachemaxsize', default=5, type=float, help='Max size of the cache in GB, the least recently used products are removed (default: 5)')
+parser.add_argument('--cachemaxage', dest='cachemaxage', default=30, type=float, help='Remove cached products not used for this number of days (default: 30)')
 parser.add_argument('--output', dest='output', default='sptomo.fits', type=str, help='Name of output mosaic (default: sptomo.fits)')
 
 args = parser.parse_args()
@@ -55,24 +59,21 @@ alpha_max = args.alpha[1]
 alpha_num = int(args.alpha[2])
 
 ########################################################
-# prepare images and convolve+regrid if needed
-if np.all([os.path.exists(name.replace('.fits', '-conv-regrid.fits')) for name in args.images]):
-    logging.info('Found convolved+regridded image... restoring.')
-    all_images = AllImages([name.replace('.fits', '-conv-regrid.fits') for name in args.images])
-    regrid_hdr = copy.copy(all_images.images[0].img_hdr)
-    del regrid_hdr['FREQ']
-    del regrid_hdr['RESTFREQ']
-else:
-    all_images = AllImages(args.images)
-    all_images.convolve_to(beam=args.beam, circbeam=args.circbeam)
-    if args.save: all_images.write('conv')
-    regrid_hdr = all_images.regrid_common(size=args.size, region=args.region, radec=args.radec, action='regrid_header')
-    if args.save: all_images.write('conv-regrid')
+# prepare images: convolve, regrid and shift or restore them from the cache
+store = None if args.cachedir is None else diskCache(args.cachedir, maxsize=args.cachemaxsize*1024**3, maxage=args.cachemaxage*86400)
+all_images = AllImages(args.images, lazy=True)
+steps = [('convolve', lambda: all_images.convolve_to(beam=args.beam, circbeam=args.circbeam), \
+          (args.beam, args.circbeam, 'fft'), (lambda: all_images.write('conv')) if args.save else None),
+         ('regrid', lambda: all_images.regrid_common(size=args.size, region=args.region, radec=args.radec, action='regrid_header', method='exact', cache=store), \
+          (args.size, args.region, args.radec, 'exact'), (lambda: all_images.write('conv-regrid')) if args.save else None)]
 
 #####################################################
 # find+apply shift w.r.t. lowest noise image
 if args.shift:
-    all_images.align_catalogue()
+    steps.append(('shift', all_images.align_catalogue, ()))
+
+# only the products of the last cached step are read
+regrid_hdr = all_images.run_steps(store, steps)[1]
  
 #########################################################
 # only after regrid+convolve apply mask and find noise
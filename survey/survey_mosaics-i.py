@@ -2,13 +2,16 @@
 
 # for a list of pointings, get the closest and mosaic them
 
-import os, sys, glob
+import os, sys, glob, logging
+from functools import lru_cache
 from astropy.table import Table
 from astropy.io import fits as pyfits
 from astropy.wcs import WCS as pywcs
 from astropy.coordinates import SkyCoord
 from astropy import units as u
 import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from mosaic import Direction, make_mosaic, get_options
 
 file_suffix = '-wide-v.fits' # this is used to isolate file names
 nchans = None
@@ -19,6 +22,16 @@ beam_size = 3.7 # approx beam RADIUS at the blank point, usually 30% of the beam
 grid_file = '../allsky-grid.fits'
 beamdir = '../beams/'
 stokes = 1
+store_dir = 'mosaic-store/' # keep contributions of each pointing to update existing mosaics incrementally (None: make only missing mosaics)
+cache_size = 16 # number of pointings (with their beams) kept in memory between mosaics
+beam_cache_dir = 'beam-cache/' # beams regridded on the pointing grids, reused by all the mosaics (None: regrid every time)
+
+@lru_cache(maxsize=cache_size)
+def get_direction(pointing_file, channel, stokes):
+    """
+    Open a pointing once for all the mosaics it is part of, make_mosaic keeps it prepared (beam, noise, shift)
+    """
+    return Direction(pointing_file, channel=channel, stokes=stokes, lazy=True)
 
 class Pointing():
 
@@ -60,16 +73,19 @@ class Pointing():
     def mosaic(self):
         in_pointings = [self.pointing_file]+self.pointing_closest_files
         in_beams = [self.beam_file]+self.beam_closest_files
-        if self.channel is not None:
-            print('mosaic.py --shift --images %s --beams %s --beamcorr --beamcut 0.3 --find_noise --header %s --use_channel %i --use_stokes %i --output %s > %s.log 2>&1' % \
-                (' '.join(in_pointings), ' '.join(in_beams), self.output_file, self.channel, self.stokes, self.output_file, self.output_file))
-            os.system('mosaic.py --shift --images %s --beams %s --beamcorr --beamcut 0.3 --find_noise --header %s --use_channel %i --use_stokes %i --output %s > %s.log 2>&1' % \
-                (' '.join(in_pointings), ' '.join(in_beams), self.output_file, self.channel, self.stokes, self.output_file, self.output_file))
-        else:
-            print('mosaic.py --shift --images %s --beams %s --beamcorr --beamcut 0.3 --find_noise --header %s --use_stokes %i --output %s > %s.log 2>&1' % \
-                (' '.join(in_pointings), ' '.join(in_beams), self.output_file, self.stokes, self.output_file, self.output_file))
-            os.system('mosaic.py --shift --images %s --beams %s --beamcorr --beamcut 0.3 --find_noise --header %s --use_stokes %i --output %s > %s.log 2>&1' % \
-                (' '.join(in_pointings), ' '.join(in_beams), self.output_file, self.stokes, self.output_file, self.output_file))
+        options = get_options(shift=True, beams=in_beams, beamcorr=True, beamcut=0.3, find_noise=True, \
+                              use_channel=(self.channel or 0), use_stokes=self.stokes, store=store_dir, beamcache=beam_cache_dir, output=self.output_file)
+        directions = [get_direction(pointing_file, options.use_channel, self.stokes) for pointing_file in in_pointings]
+        print('Mosaic %s (log: %s.log)' % (self.output_file, self.output_file))
+        log = logging.FileHandler(self.output_file+'.log', mode='w')
+        logging.root.addHandler(log)
+        try:
+            make_mosaic(directions, pyfits.getheader(self.output_file), options)
+        except Exception:
+            logging.exception('Mosaic %s failed.' % self.output_file)
+        finally:
+            logging.root.removeHandler(log)
+            log.close()
 
     def make_empty_mosaic(self):
         rwcs = pywcs(naxis=2)
@@ -87,6 +103,7 @@ class Pointing():
         data = np.zeros((4000,4000))
         pyfits.writeto(self.output_file, header=regrid_hdr, data=data, overwrite=True)
 
+logging.root.setLevel(logging.DEBUG)
 pointing_files = sorted(glob.glob('*'+file_suffix))
 
 # open grid file and restrict to available pointings
@@ -100,21 +117,22 @@ print('Restricting to %i pointings.' % len(grid))
 # list of pointings to mosaic
 if nchans:
     for chan in range(nchans):
-        os.system('rm *__beam.fits') # be sure we do not re-use the old beam
         for pointing_file in pointing_files:
             pointing = Pointing(pointing_file, channel=chan, stokes=stokes)
-            if not os.path.exists(pointing.output_file):
+            if not os.path.exists(pointing.output_file) or store_dir is not None:
                 # get the closest (assuming worst case: perfectly diagonally aligned pointings)
                 dist = np.sqrt(2.)/2*cutout_size+beam_size
                 pointing.add_closest(dist)
-                pointing.make_empty_mosaic()
+                if not os.path.exists(pointing.output_file):
+                    pointing.make_empty_mosaic()
                 pointing.mosaic()
 else:
     for pointing_file in pointing_files:
         pointing = Pointing(pointing_file, channel=None, stokes=stokes)
-        if not os.path.exists(pointing.output_file):
+        if not os.path.exists(pointing.output_file) or store_dir is not None:
             # get the closest (assuming worst case: perfectly diagonally aligned pointings)
             dist = np.sqrt(2.)/2*cutout_size+beam_size
             pointing.add_closest(dist)
-            pointing.make_empty_mosaic()
+            if not os.path.exists(pointing.output_file):
+                pointing.make_empty_mosaic()
             pointing.mosaic()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 - Francesco de Gasperin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# tests of lib_fits, run with: python -m pytest test_lib_fits.py
+
+import os
+import numpy as np
+from astropy.io import fits as pyfits
+from astropy.wcs import WCS as pywcs
+import lib_fits
+from lib_fits import AllImages, set_precision
+
+def test_precision(tmp_path, tol=1e-5):
+    """
+    Convolve+regrid synthetic 32-bit images in single and double precision:
+    results must agree within tol (relative to the peak) and single precision images are written with BITPIX=-32
+    """
+    rng = np.random.default_rng(0)
+    prec = lib_fits.precision
+    filenames = []
+    for i, freq in enumerate([60e6, 140e6]):
+        w = pywcs(naxis=2)
+        w.wcs.ctype = ['RA---SIN', 'DEC--SIN']
+        w.wcs.crval = [150., 30.]
+        w.wcs.crpix = [128, 128]
+        w.wcs.cdelt = [-2./3600, 2./3600]
+        header = w.to_header()
+        header['BMAJ'], header['BMIN'], header['BPA'] = (6.+2*i)/3600, 6./3600, 0.
+        header['FREQ'] = freq
+        yy, xx = np.mgrid[0:256, 0:256]
+        data = rng.normal(0, 1e-3, (256, 256)) + np.exp(-((xx-100)**2 + (yy-140)**2) / (2*3.**2))
+        filenames.append(str(tmp_path / ('img%i.fits' % i)))
+        pyfits.writeto(filenames[-1], data.astype(np.float32), header)
+    try:
+        results = {}
+        for p in ['double', 'single']:
+            set_precision(p)
+            for method in ['interp', 'exact']:
+                all_images = AllImages(filenames, lazy=True)
+                all_images.convolve_to(beam=[12, 12, 0])
+                all_images.regrid_common(size=[0.1, 0.1], pixscale=3., method=method)
+                results[p, method] = [image.img_data for image in all_images]
+        for method in ['interp', 'exact']:
+            for double, single in zip(results['double', method], results['single', method]):
+                assert single.dtype == np.float32 and double.dtype == np.float64
+                assert np.array_equal(np.isnan(double), np.isnan(single))
+                assert np.nanmax(np.abs(double - single)) < tol * np.nanmax(np.abs(double)), method
+        all_images[0].write(str(tmp_path / 'out.fits'))
+        assert pyfits.getheader(str(tmp_path / 'out.fits'))['BITPIX'] == -32
+    finally:
+        set_precision(prec)